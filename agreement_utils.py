@@ -0,0 +1,268 @@
+# agreement_utils.py
+"""
+Kundavtal (PriceAgreement) som overlay på publicerad config.
+
+Overlay per organisation (price_agreements.data):
+  {"modes": {"road_freight": {
+      "km_price_eur": 1.05,                       # ersätter modets km-pris
+      "balance_factors": {"SE-DE": 0.95},         # läggs över modets faktorer
+      "discount_pct": 4.5,                        # rabatt på totalpriset
+      "lane_prices": [{"from": "SE-21", "to": "DE", "price_eur": 890,
+                       "max_weight_kg": 25160}]   # fast pris för sträckan (ingen rabatt)
+  }}}
+
+km_price_eur och balance_factors läggs in i configen, som sedan kompileras
+till en egen PricingPlan per (publicerad version, org, avtalsrevision) – så
+prismotorn är densamma och calculate_for_mode förblir ren. Rabatt och fasta
+sträckpriser läggs på resultatet efteråt (Agreement.apply). Planens
+config_id innehåller revisionen, så offertcachen och planerna blir inaktuella
+av sig själva när basconfigen eller avtalet ändras.
+
+Avtalen hålls i minnet (agreement_store) och läses om i bakgrunden var
+AGREEMENT_REFRESH_SECONDS – /calculate och /book gör ingen extra DB-läsning.
+"""
+import logging
+import os
+import re
+import threading
+import time
+
+from models import PriceAgreement
+from pricing_utils import PricingPlan, normalize_postal
+
+logger = logging.getLogger(__name__)
+
+AGREEMENT_REFRESH_SECONDS = float(os.getenv("AGREEMENT_REFRESH_SECONDS", "30"))
+AGREEMENT_PLAN_CACHE_SIZE = int(os.getenv("AGREEMENT_PLAN_CACHE_SIZE", "256"))
+
+_end_pat = re.compile(r"^([A-Z]{2})(?:-(\d{2,5}))?$")
+_pair_pat = re.compile(r"^[A-Z]{2}-[A-Z]{2}$")
+_MODE_KEYS = {"km_price_eur", "balance_factors", "discount_pct", "lane_prices"}
+
+
+def _positive(v) -> bool:
+    return isinstance(v, (int, float)) and not isinstance(v, bool) and v > 0
+
+
+def agreement_errors(data, cfg: dict) -> list:
+    """Valideringsfel för en overlay mot publicerad config (tom lista = ok)."""
+    if not isinstance(data, dict) or not isinstance(data.get("modes"), dict):
+        return ["agreement must be an object with 'modes'"]
+    errors = []
+    for mode_key, m in data["modes"].items():
+        if mode_key not in (cfg or {}):
+            errors.append(f"{mode_key}: unknown mode")
+            continue
+        if not isinstance(m, dict):
+            errors.append(f"{mode_key}: must be object")
+            continue
+        for k in sorted(set(m) - _MODE_KEYS):
+            errors.append(f"{mode_key}.{k} not supported")
+        if "km_price_eur" in m and not _positive(m["km_price_eur"]):
+            errors.append(f"{mode_key}.km_price_eur must be > 0")
+        if "discount_pct" in m:
+            d = m["discount_pct"]
+            if not isinstance(d, (int, float)) or isinstance(d, bool) or not 0 <= d < 100:
+                errors.append(f"{mode_key}.discount_pct must be in [0, 100)")
+        bf = m.get("balance_factors", {})
+        if not isinstance(bf, dict):
+            errors.append(f"{mode_key}.balance_factors must be object")
+        else:
+            for pair, val in bf.items():
+                if not _pair_pat.match(pair or ""):
+                    errors.append(f"{mode_key}.balance_factors key '{pair}' must be CC-CC")
+                if not _positive(val):
+                    errors.append(f"{mode_key}.balance_factors[{pair}] must be > 0")
+        lanes = m.get("lane_prices", [])
+        if not isinstance(lanes, list):
+            errors.append(f"{mode_key}.lane_prices must be list")
+            continue
+        for i, lane in enumerate(lanes):
+            if not isinstance(lane, dict):
+                errors.append(f"{mode_key}.lane_prices[{i}] must be object")
+                continue
+            for end in ("from", "to"):
+                if not _end_pat.match(str(lane.get(end) or "")):
+                    errors.append(f"{mode_key}.lane_prices[{i}].{end} must be CC or CC-<2–5 digits>")
+            if not _positive(lane.get("price_eur")):
+                errors.append(f"{mode_key}.lane_prices[{i}].price_eur must be > 0")
+            if lane.get("max_weight_kg") is not None and not _positive(lane["max_weight_kg"]):
+                errors.append(f"{mode_key}.lane_prices[{i}].max_weight_kg must be > 0")
+    return errors
+
+
+class _LanePrice:
+    __slots__ = ("pc", "pp", "dc", "dp", "price", "max_weight")
+
+    def __init__(self, raw: dict):
+        self.pc, self.pp = _end_pat.match(raw["from"]).groups()
+        self.dc, self.dp = _end_pat.match(raw["to"]).groups()
+        self.price = int(round(float(raw["price_eur"])))
+        mw = raw.get("max_weight_kg")
+        self.max_weight = float(mw) if mw is not None else None
+
+    @property
+    def specificity(self) -> int:
+        return len(self.pp or "") + len(self.dp or "")
+
+    def matches(self, pc, pp, dc, dp, weight) -> bool:
+        if pc != self.pc or dc != self.dc:
+            return False
+        if self.max_weight is not None and weight > self.max_weight:
+            return False
+        # Postnumret i frågan måste ligga helt inom prefixet ("21" matchar inte "211")
+        return (self.pp is None or pp.startswith(self.pp)) and (self.dp is None or dp.startswith(self.dp))
+
+
+class Agreement:
+    """Kompilerat avtal för en organisation."""
+
+    def __init__(self, org_id: int, revision: int, data: dict):
+        self.org_id = org_id
+        self.revision = revision
+        self.data = data
+        self.discounts: dict = {}
+        self.lanes: dict = {}
+        for name, m in (data.get("modes") or {}).items():
+            d = float(m.get("discount_pct") or 0)
+            if d:
+                self.discounts[name] = d
+            lanes = [_LanePrice(l) for l in m.get("lane_prices") or []]
+            if lanes:
+                # Mest specifika sträckan vinner
+                self.lanes[name] = sorted(lanes, key=lambda l: -l.specificity)
+
+    def overlay_config(self, base_cfg: dict) -> dict:
+        """Basconfigen med avtalets km-pris och balansfaktorer (basen ändras inte)."""
+        cfg = dict(base_cfg)
+        for name, m in (self.data.get("modes") or {}).items():
+            if not isinstance(cfg.get(name), dict):
+                continue
+            mode = cfg[name] = dict(cfg[name])
+            if "km_price_eur" in m:
+                mode["km_price_eur"] = m["km_price_eur"]
+            if m.get("balance_factors"):
+                mode["balance_factors"] = {**(mode.get("balance_factors") or {}), **m["balance_factors"]}
+        return cfg
+
+    def _price(self, name: str, pc, pp, dc, dp, weight, price) -> tuple:
+        """(avtalspris, info-fält) för ett listpris; pp/dp normaliserade."""
+        lane = next((l for l in self.lanes.get(name, ()) if l.matches(pc, pp, dc, dp, weight)), None)
+        if lane is not None:
+            return lane.price, {"lane_price": True}
+        if name in self.discounts:
+            d = self.discounts[name]
+            return int(round(price * (1 - d / 100.0))), {"discount_pct": d}
+        return price, {}
+
+    def apply(self, quote: tuple, results: dict) -> dict:
+        """Rabatt och fasta sträckpriser på färska resultat (ändras på plats, som HubNetwork.apply)."""
+        _, _, pc, pp, dc, dp, weight = quote
+        pp, dp = normalize_postal(pp) or "", normalize_postal(dp) or ""
+        for name in (self.data.get("modes") or {}):
+            r = results.get(name)
+            if not r or not r.get("available"):
+                continue
+            r["total_price_eur"], extra = self._price(name, pc, pp, dc, dp, weight, r["total_price_eur"])
+            r["agreement"] = {"org_id": self.org_id, "revision": self.revision, **extra}
+        return results
+
+    def apply_curve(self, lane: tuple, weights: list, curves: dict) -> dict:
+        """Som apply, men på /calculate/curve-svar (prices[k] för weights[k], breakpoints)."""
+        _, _, pc, pp, dc, dp = lane
+        pp, dp = normalize_postal(pp) or "", normalize_postal(dp) or ""
+        for name in (self.data.get("modes") or {}):
+            c = curves.get(name)
+            if not c or not c.get("available"):
+                continue
+            c["prices"] = [p if p is None else self._price(name, pc, pp, dc, dp, w, p)[0]
+                           for w, p in zip(weights, c.get("prices") or [])]
+            for b in c.get("breakpoints") or []:
+                if b.get("price_eur") is not None:
+                    b["price_eur"] = self._price(name, pc, pp, dc, dp, b["weight_kg"], b["price_eur"])[0]
+            c["agreement"] = {"org_id": self.org_id, "revision": self.revision}
+        return curves
+
+
+class AgreementStore:
+    def __init__(self):
+        self._by_org: dict = {}        # org_id → Agreement
+        self._plans: dict = {}         # (bas-config_id, org_id) → PricingPlan
+        self._lock = threading.Lock()
+        self.loaded_at = None
+
+    def get(self, org_id) -> Agreement | None:
+        return self._by_org.get(org_id)
+
+    def set(self, org_id: int, revision: int, data: dict):
+        self._by_org[org_id] = Agreement(org_id, revision, data)
+
+    def remove(self, org_id: int):
+        self._by_org.pop(org_id, None)
+
+    def load(self, db) -> int:
+        """Läser om alla avtal; bara ändrade revisioner hämtas och kompileras om. → antal avtal."""
+        revs = dict(db.query(PriceAgreement.org_id, PriceAgreement.revision).all())
+        changed = [o for o, rev in revs.items()
+                   if (a := self._by_org.get(o)) is None or a.revision != rev]
+        if changed:
+            for org_id, rev, data in (db.query(PriceAgreement.org_id, PriceAgreement.revision, PriceAgreement.data)
+                                      .filter(PriceAgreement.org_id.in_(changed))):
+                try:
+                    self.set(org_id, rev, data or {})
+                except Exception:
+                    logger.exception("Price agreement for org %s ignored", org_id)
+        for org_id in set(self._by_org) - set(revs):
+            self.remove(org_id)
+        self.loaded_at = time.time()
+        return len(revs)
+
+    def plan_for(self, base: PricingPlan, org_id) -> PricingPlan:
+        """Planen för organisationen: basplanen om avtal saknas, annars en cachad overlay-plan."""
+        a = self._by_org.get(org_id) if org_id is not None else None
+        if a is None or base.config_id is None:
+            return base
+        key = (base.config_id, org_id)
+        plan = self._plans.get(key)
+        if plan is not None and plan.agreement is a:
+            return plan
+        plan = PricingPlan(a.overlay_config(base.raw), version=base.version,
+                           config_id=f"{base.config_id}:org{org_id}:r{a.revision}")
+        plan.agreement = a
+        if base.version is not None:
+            with self._lock:
+                self._plans.pop(key, None)
+                self._plans[key] = plan
+                while len(self._plans) > AGREEMENT_PLAN_CACHE_SIZE:
+                    self._plans.pop(next(iter(self._plans)))
+        logger.info("Compiled price agreement plan for org %s (r%s) on v%s", org_id, a.revision, base.version)
+        return plan
+
+
+agreement_store = AgreementStore()
+_refresher = None
+_refresher_lock = threading.Lock()
+
+
+def ensure_refresher(session_factory, interval: float = AGREEMENT_REFRESH_SECONDS):
+    """Läser om avtalen var interval:e sekund (andra workers ändringar). Idempotent."""
+    global _refresher
+    if interval <= 0 or _refresher is not None:
+        return
+    with _refresher_lock:
+        if _refresher is not None:
+            return
+
+        def _run():
+            while True:
+                time.sleep(interval)
+                db = session_factory()
+                try:
+                    agreement_store.load(db)
+                except Exception:
+                    logger.exception("Price agreement refresh failed")
+                finally:
+                    db.close()
+
+        _refresher = threading.Thread(target=_run, name="agreement-refresh", daemon=True)
+        _refresher.start()
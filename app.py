@@ -1,18 +1,18 @@
 from flask_cors import CORS
 from flask import Flask, request, jsonify
-from math import radians, cos, sin, sqrt, atan2, log
+from math import isfinite
 from datetime import datetime, timedelta, time
-import pytz
-import holidays
 import json
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.exc import IntegrityError
-from models import Base, Address, Booking, Organization, User, PricingConfig
+from models import Base, Address, Booking, Organization, User, PricingConfig, PriceAgreement
 import re
 from typing import Tuple, Dict, Any, List
 from sqlalchemy import func as sa_func
 import os, jwt, uuid
+import threading
+import random
 from functools import wraps
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.exceptions import BadRequest
@@ -27,6 +27,30 @@ from models import OrgAddress
 from flask import Response
 from pdf_utils import generate_cmr_pdf_bytes
 from pdf_utils import generate_cmr_pdf_bytes
+from pricing_utils import calculate_for_mode, PricingPlan, ModePlan, ZoneIndex, parse_zone_entry
+from batch_utils import calculate_batch, weight_curve
+import grid_utils
+import coverage_utils
+import routing_utils
+from routing_utils import hub_config_errors
+import capacity_utils
+from capacity_utils import capacity_counters, capacity_config_errors, booking_entry
+from cache_utils import quote_cache, quote_cache_key
+from replay_utils import (REPLAY_BATCH_SIZE, start_replay_job, get_replay_job,
+                          cancel_replay_job, job_public, booking_weight)
+from quotelog_utils import QuoteEvent, setup_quote_logging, quote_log_stats
+from sweep_utils import sweep_config
+from balance_utils import BALANCE_WINDOW_DAYS, run_balance_proposal, write_draft
+from agreement_utils import agreement_store, agreement_errors, ensure_refresher as ensure_agreement_refresher
+from quote_token_utils import QuoteTokens, QuoteTokenError
+from geocode_utils import postal_index
+from pricelist_utils import price_list, PRICE_LIST_MAX_BANDS, FORMATS as PRICE_LIST_FORMATS
+from quote_store_utils import (quote_store, conversion_report, report_window, REPORT_GROUPS,
+                               QUOTE_STORE_ENABLED)
+from trace_utils import trace_mode, timed_stage, stage_histograms, QUOTE_TRACE_SAMPLE_RATE
+from tender_utils import (read_lanes, start_tender_job, cancel_job as cancel_tender_job,
+                          read_meta as read_tender_meta, public_meta as tender_public_meta,
+                          iter_result_lines as iter_tender_lines, iter_result_csv as iter_tender_csv)
 app = Flask(__name__)
 
 # ==== AUTH CORE ====
@@ -47,12 +71,27 @@ JWT_SECRET = get_jwt_secret()
 JWT_ALG = "HS256"
 JWT_HOURS = int(os.getenv("JWT_HOURS", "8"))
 
+# Offert-id:n signeras med egen nyckel om satt, annars härledd ur JWT-hemligheten
+quote_tokens = QuoteTokens(os.getenv("QUOTE_TOKEN_SECRET") or JWT_SECRET)
+# true = /book kräver quote_id (annars tas pris m.m. ur payloaden som tidigare)
+QUOTE_ID_REQUIRED = os.getenv("QUOTE_ID_REQUIRED", "false").lower() in ("1", "true", "yes")
+
 def extract_token_from_request():
     auth = request.headers.get("Authorization", "")
     if auth.startswith("Bearer "):
         return auth.split(" ", 1)[1]
     return request.args.get("jwt") or request.args.get("token")
 
+def request_org_id():
+    """org_id ur JWT om en giltig token följer med (valfritt, t.ex. /calculate), annars None."""
+    token = extract_token_from_request()
+    if not token:
+        return None
+    try:
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG]).get("org_id")
+    except jwt.InvalidTokenError:
+        return None
+
 from functools import wraps
 from flask import request, g, make_response
 import jwt
@@ -887,6 +926,86 @@ def admin_orgs_update(org_id: int):
         db.close()
 
 
+# ========= Admin: kundavtal (overlay på publicerad config, se agreement_utils) =========
+
+def price_agreement_to_dict(a: PriceAgreement) -> dict:
+    return {
+        "org_id": a.org_id,
+        "revision": a.revision,
+        "data": a.data,
+        "comment": a.comment,
+        "updated_at": a.updated_at.isoformat() if a.updated_at else None,
+        "updated_by": a.updated_by,
+    }
+
+
+@app.get("/admin/organizations/<int:org_id>/price-agreement")
+@require_auth("superadmin")
+def admin_price_agreement_get(org_id: int):
+    db = SessionLocal()
+    try:
+        a = db.query(PriceAgreement).filter(PriceAgreement.org_id == org_id).first()
+        if not a:
+            return jsonify({"error": "Not found"}), 404
+        return jsonify(price_agreement_to_dict(a))
+    finally:
+        db.close()
+
+
+@app.put("/admin/organizations/<int:org_id>/price-agreement")
+@require_auth("superadmin")
+def admin_price_agreement_put(org_id: int):
+    payload = request.get_json(silent=True) or {}
+    data = payload.get("data", payload)
+    errs = agreement_errors(data, get_active_config(use="published"))
+    if errs:
+        return jsonify({"ok": False, "errors": errs}), 400
+
+    db = SessionLocal()
+    try:
+        if not db.query(Organization.id).filter(Organization.id == org_id).first():
+            return jsonify({"error": "Not found"}), 404
+        a = db.query(PriceAgreement).filter(PriceAgreement.org_id == org_id).first()
+        if a:
+            a.data = data
+            a.revision = (a.revision or 0) + 1
+        else:
+            a = PriceAgreement(org_id=org_id, data=data, revision=1)
+            db.add(a)
+        a.comment = payload.get("comment")
+        a.updated_by = request.user.get("user_id")
+        db.commit()
+        # Denna worker direkt; övriga vid nästa omläsning (AGREEMENT_REFRESH_SECONDS)
+        agreement_store.set(org_id, a.revision, data)
+        app.logger.info("Price agreement for org %s saved (r%s)", org_id, a.revision)
+        return jsonify({"ok": True, **price_agreement_to_dict(a)})
+    except Exception as e:
+        db.rollback()
+        app.logger.exception("PUT price agreement failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        db.close()
+
+
+@app.delete("/admin/organizations/<int:org_id>/price-agreement")
+@require_auth("superadmin")
+def admin_price_agreement_delete(org_id: int):
+    db = SessionLocal()
+    try:
+        n = db.query(PriceAgreement).filter(PriceAgreement.org_id == org_id).delete(synchronize_session=False)
+        db.commit()
+        agreement_store.remove(org_id)
+        if not n:
+            return jsonify({"error": "Not found"}), 404
+        return jsonify({"ok": True})
+    except Exception:
+        db.rollback()
+        app.logger.exception("DELETE price agreement failed")
+        return jsonify({"ok": False, "error": "Server error"}), 500
+    finally:
+        db.close()
+
+
 
 # ========= Admin: organizations (create + delete) =========
 
@@ -1017,8 +1136,10 @@ def admin_orgs_delete(org_id: int):
                 db.query(Address).filter(Address.user_id.in_(user_ids)).delete(synchronize_session=False)
                 db.query(User).filter(User.id.in_(user_ids)).delete(synchronize_session=False)
 
+        db.query(PriceAgreement).filter(PriceAgreement.org_id == org_id).delete(synchronize_session=False)
         db.delete(o)
         db.commit()
+        agreement_store.remove(org_id)
         return jsonify({"ok": True})
     except Exception:
         db.rollback(); app.logger.exception("DELETE /admin/organizations failed")
@@ -1206,6 +1327,10 @@ try:
 except Exception as e:
     app.logger.exception("DB init failed: %s", e)
 
+# Offerter skrivs till quotes i batch av en bakgrundstråd (quote_store_utils)
+if QUOTE_STORE_ENABLED:
+    quote_store.start(SessionLocal.session_factory)
+
 # =========================================================
 # Config (Pricing) – seed + helpers
 # =========================================================
@@ -1240,6 +1365,20 @@ def seed_published_config_from_file_if_empty():
 
 seed_published_config_from_file_if_empty()
 
+def load_price_agreements():
+    """Kundavtalen hålls i minnet (agreement_utils); läses om i bakgrunden."""
+    db = SessionLocal()
+    try:
+        n = agreement_store.load(db)
+        app.logger.info("Loaded %d price agreements", n)
+    except Exception:
+        app.logger.exception("Failed to load price agreements")
+    finally:
+        db.close()
+    ensure_agreement_refresher(SessionLocal.session_factory)
+
+load_price_agreements()
+
 def get_active_config(use: str = "published") -> Dict[str, Any]:
     db = SessionLocal()
     try:
@@ -1257,6 +1396,49 @@ def get_active_config(use: str = "published") -> Dict[str, Any]:
         return pub.data if pub else {}
     finally:
         db.close()
+
+# Kompilerade prisplaner per publicerad PricingConfig-rad (raderna ändras aldrig efter publish).
+# Draft kan skrivas över på samma id och kompileras därför om vid varje anrop.
+_PLAN_CACHE: Dict[str, PricingPlan] = {}
+_PLAN_CACHE_MAX = 4
+_PLAN_CACHE_LOCK = threading.Lock()
+
+def get_pricing_plan(use: str = "published") -> PricingPlan:
+    # Egen session, inte den scoped – anroparens session (t.ex. i admin_publish) ska lämnas orörd
+    db = SessionLocal.session_factory()
+    try:
+        if use == "draft":
+            draft = (db.query(PricingConfig)
+                     .filter(PricingConfig.status == "draft")
+                     .order_by(PricingConfig.created_at.desc())
+                     .first())
+            if draft and draft.data:
+                return PricingPlan(draft.data, version=None, config_id=draft.id)
+        pub = (db.query(PricingConfig.id, PricingConfig.version)
+               .filter(PricingConfig.status == "published")
+               .order_by(PricingConfig.version.desc())
+               .first())
+        if not pub:
+            return PricingPlan({})
+        plan = _PLAN_CACHE.get(pub.id)
+        if plan is not None:
+            return plan
+        data = db.query(PricingConfig.data).filter(PricingConfig.id == pub.id).scalar()
+        plan = PricingPlan(data, version=pub.version, config_id=pub.id)
+        with _PLAN_CACHE_LOCK:
+            _PLAN_CACHE[pub.id] = plan
+            while len(_PLAN_CACHE) > _PLAN_CACHE_MAX:
+                _PLAN_CACHE.pop(next(iter(_PLAN_CACHE)))
+        app.logger.info("Compiled pricing plan v%s (%d modes)", pub.version, len(plan))
+        grid_utils.schedule_rebuild(plan)
+        coverage_utils.rebuild(plan)
+        routing_utils.network_for(plan)
+        if capacity_utils.rules_for(plan).modes:
+            capacity_utils.ensure_reconciler(SessionLocal.session_factory, get_pricing_plan)
+        return plan
+    finally:
+        db.close()
+
 def _compute_allowed_cc() -> set[str]:
     """
     Samlar alla landskoder som finns i available_zones
@@ -1276,7 +1458,6 @@ app.logger.info("ALLOWED_CC initialiserat: %s", sorted(ALLOWED_CC))
 # =========================================================
 # Validation of config
 # =========================================================
-_range_pat = re.compile(r"^\d{2}(-\d{2})?$")
 _cc_pat = re.compile(r"^[A-Z]{2}$")
 _pair_pat = re.compile(r"^[A-Z]{2}-[A-Z]{2}$")
 
@@ -1321,6 +1502,8 @@ def validate_config(cfg: Dict[str, Any]) -> Tuple[bool, list]:
         if all(k in mode for k in ["default_breakpoint","max_weight_kg"]):
             if mode["default_breakpoint"] > mode["max_weight_kg"]:
                 errors.append(f"{mode_key}: default_breakpoint > max_weight_kg")
+        if mode.get("transit_day_type", "business") not in ("business", "calendar"):
+            errors.append(f"{mode_key}.transit_day_type must be 'business' or 'calendar'")
 
         # available_zones
         az = mode.get("available_zones", {})
@@ -1333,9 +1516,19 @@ def validate_config(cfg: Dict[str, Any]) -> Tuple[bool, list]:
                 if not isinstance(ranges, list) or not ranges:
                     errors.append(f"{mode_key}.available_zones[{cc}] must be non-empty list")
                 else:
+                    bad = False
                     for r in ranges:
-                        if not _range_pat.match(str(r)):
-                            errors.append(f"{mode_key}.available_zones[{cc}] bad range '{r}'")
+                        try:
+                            parse_zone_entry(r)
+                        except ValueError as e:
+                            bad = True
+                            errors.append(f"{mode_key}.available_zones[{cc}] {e}")
+                    if not bad and not len(ZoneIndex(ranges)):
+                        errors.append(f"{mode_key}.available_zones[{cc}] covers no postal codes after exclusions")
+
+        # hubs (flerbensrutter, se routing_utils) + capacity (se capacity_utils)
+        errors += hub_config_errors(mode_key, mode, cfg)
+        errors += capacity_config_errors(mode_key, mode)
 
         # balance_factors
         bf = mode.get("balance_factors", {})
@@ -1353,16 +1546,6 @@ def validate_config(cfg: Dict[str, Any]) -> Tuple[bool, list]:
 # =========================================================
 # Pricing calculation
 # =========================================================
-def haversine(coord1, coord2):
-    R = 6371
-    lat1, lon1 = map(radians, coord1)
-    lat2, lon2 = map(radians, coord2)
-    dlat = lat2 - lat1
-    dlon = lon2 - lon1
-    a = sin(dlat/2)**2 + cos(lat1)*cos(lat2)*sin(dlon/2)**2
-    c = 2 * atan2(sqrt(a), sqrt(1 - a))
-    return R * c
-
 def _fmt_time(t):
     try:
         return t.strftime("%H:%M") if t else None
@@ -1722,181 +1905,426 @@ def get_booking_by_number(booking_number: str):
 # =========================================================
 # Calculate
 # =========================================================
-def is_zone_allowed(country, postal_prefix, available_zones):
-    if country not in available_zones:
-        return False
-    try:
-        prefix = int(postal_prefix)
-    except ValueError:
+# Koppla Flask-loggningen till Gunicorns logger (så allt syns i Render)
+gunicorn_logger = logging.getLogger("gunicorn.error")
+if gunicorn_logger.handlers:
+    app.logger.handlers = gunicorn_logger.handlers
+    app.logger.setLevel(gunicorn_logger.level)
+
+# En strukturerad post per offert, skrivs från en egen tråd (se quotelog_utils)
+setup_quote_logging(app.logger.handlers or [logging.StreamHandler()])
+
+def quote_coordinate(data: dict, side: str):
+    """
+    Koordinaten för "pickup"/"delivery": klientens om den skickats, annars
+    tyngdpunkten för land + postnummer ur det lokala indexet (geocode_utils).
+    """
+    coord = data.get(f"{side}_coordinate")
+    if coord is None and postal_index is not None:
+        coord = postal_index.coordinate(data.get(f"{side}_country"), data.get(f"{side}_postal_prefix"))
+    if coord is None:
+        raise KeyError(f"{side}_coordinate")
+    return coord
+
+def parse_quote_input(data: dict) -> tuple:
+    """
+    /calculate-payload → (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+    delivery_country, delivery_postal, weight). Kastar KeyError/ValueError.
+    Koordinaterna får utelämnas om postnummerindexet är laddat.
+    """
+    return (
+        quote_coordinate(data, "pickup"), quote_coordinate(data, "delivery"),
+        data["pickup_country"], data["pickup_postal_prefix"],
+        data["delivery_country"], data["delivery_postal_prefix"],
+        float(data["chargeable_weight"]),
+    )
+
+def quote_trace_requested() -> bool:
+    """
+    True om X-Quote-Trace är satt och anroparen är superadmin.
+    Headern från någon annan ger 403 (hellre tydligt än att tyst ignorera).
+    """
+    if request.headers.get("X-Quote-Trace", "").lower() not in ("1", "true", "yes"):
         return False
-    for zone in available_zones[country]:
-        if "-" in zone:
-            start, end = map(int, zone.split("-"))
-            if start <= prefix <= end:
-                return True
-        else:
-            if int(zone) == prefix:
-                return True
-    return False
-
-def calculate_for_mode(mode_config, pickup_coord, delivery_coord, pickup_country, pickup_postal, delivery_country, delivery_postal, weight, mode_name=None):
-    # Zoner
-    if not (is_zone_allowed(pickup_country, pickup_postal, mode_config["available_zones"]) and
-            is_zone_allowed(delivery_country, delivery_postal, mode_config["available_zones"])):
-        return {"available": False, "status": "Not available for this request"}
-
-    # Viktgränser
-    min_allowed = mode_config.get("min_allowed_weight_kg", 0)
-    max_allowed = mode_config.get("max_allowed_weight_kg", 999999)
-    if weight < min_allowed or weight > max_allowed:
-        return {"available": False, "status": "Weight not allowed", "error": f"Allowed weight range: {min_allowed}–{max_allowed} kg"}
-
-    # Avstånd (aldrig 0 → undvik log(0) senare)
-    distance_km = max(1, int(round(haversine(pickup_coord, delivery_coord) * 1.2)))
-
-    balance_key = f"{pickup_country}-{delivery_country}"
-    balance_factor = float(mode_config.get("balance_factors", {}).get(balance_key, 1.0) or 1.0)
-    km_price = float(mode_config.get("km_price_eur", 0) or 0)
-    ftl_price = max(1, int(round(distance_km * km_price * balance_factor)))
-
-    # Kurvparametrar
+    token = extract_token_from_request()
     try:
-        p1  = float(mode_config["p1"]);   price_p1 = float(mode_config["price_p1"])
-        p2  = float(mode_config["p2"]);   p2k = float(mode_config["p2k"]);  p2m = float(mode_config["p2m"])
-        p3  = float(mode_config["p3"]);   p3k = float(mode_config["p3k"]);  p3m = float(mode_config["p3m"])
-        bp  = float(mode_config["default_breakpoint"])
-        maxw = float(mode_config["max_weight_kg"])
-    except Exception:
-        return {"available": False, "status": "Bad pricing config (missing numbers)"}
+        claims = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALG]) if token else {}
+    except jwt.InvalidTokenError:
+        claims = {}
+    if claims.get("role") != "superadmin":
+        abort(403, "X-Quote-Trace requires superadmin")
+    return True
+
+def calculate_modes(plan, quote: tuple, serving=None, traced: bool = False, debug_id: str = "-"):
+    """
+    Alla mode för en offert → (results, traces). Med traced=True körs trace_mode
+    (samma resultat) och traces innehåller per-mode stegtider och mellanvärden.
+    """
+    results, traces = {}, {}
+    for mode, mode_plan in plan.items():
+        if serving is not None and mode not in serving and not traced:
+            results[mode] = {"available": False, "status": "Not available for this request"}
+            continue
+        try:
+            if traced:
+                results[mode], traces[mode] = trace_mode(mode_plan, *quote, mode_name=mode)
+            else:
+                results[mode] = calculate_for_mode(mode_plan, *quote, mode_name=mode)
+        except Exception:
+            app.logger.exception("CALC %s %s crashed in calculate_for_mode", debug_id, mode)
+            results[mode] = {"available": False, "status": "error", "error": "internal", "mode": mode}
+    return results, traces
 
-    # Monotonicitet + positive krav
-    if not (0 < p1 < p2 < p3 < bp <= maxw):
-        return {"available": False, "status": "Bad pricing config (need 0<p1<p2<p3<breakpoint≤max_weight)"}
-    if price_p1 <= 0 or km_price <= 0:
-        return {"available": False, "status": "Bad pricing config (non-positive price)"}
+@app.route("/calculate", methods=["POST"])
+def calculate():
+    debug_id = uuid.uuid4().hex[:8]  # kort korrelations-ID
+    event = QuoteEvent(debug_id)
+    data = request.json or {}
+    try:
+        (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+         delivery_country, delivery_postal, weight) = parse_quote_input(data)
+    except (KeyError, ValueError) as e:
+        event.emit(error=f"bad input: {e}", payload=data)
+        return jsonify({"error": "Missing or invalid input", "debug_id": debug_id}), 400
 
-    # y-värden måste vara > 0
-    y1 = price_p1 / p1
-    y2 = (p2k * ftl_price + p2m) / p2
-    y3 = (p3k * ftl_price + p3m) / p3
-    y4 = ftl_price / bp
+    # Trace (superadmin): hoppa över cache/rutnät och visa motorns steg för varje mode
+    trace = quote_trace_requested()
+    org_id = request_org_id()
+    with timed_stage("config") as config_stage:
+        # Kundavtal: egen plan per org (ur JWT, utan DB-läsning) – annars den publicerade
+        plan = agreement_store.plan_for(get_pricing_plan(use="published"), org_id)
+    if trace:
+        quote = (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+                 delivery_country, delivery_postal, weight)
+        results, traces = calculate_modes(plan, quote, traced=True, debug_id=debug_id)
+        # Samma efterbearbetning som motorvägen nedan, så trace visar kundens svar
+        routing_utils.network_for(plan).apply(quote, results)
+        if plan.agreement is not None:
+            plan.agreement.apply(quote, results)
+        results = capacity_utils.rules_for(plan).adjust(quote, results)
+        event.lane(*quote, config_version=plan.version)
+        event.results(results, source="trace")
+        event.emit()
+        return jsonify({"debug_id": debug_id, **results, "trace": {
+            "config_version": plan.version, "config_us": config_stage.us, "modes": traces}})
+
+    quote = (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+             delivery_country, delivery_postal, weight)
+    event.lane(*quote, config_version=plan.version)
+
+    # Identisk förfrågan mot samma config-version nyligen → färdigt svar ur cachen
+    cache_key = quote_cache_key(
+        plan.config_id, pickup_coord, delivery_coord,
+        pickup_country, pickup_postal, delivery_country, delivery_postal, weight
+    )
+    # Kapacitetsjustering görs på vägen ut (cachen/rutnätet har opåverkade priser)
+    capacity = capacity_utils.rules_for(plan)
+
+    cached = quote_cache.get(cache_key)
+    if cached is not None:
+        cached = capacity.adjust(quote, cached)
+        event.results(cached, source="cache")
+        event.emit()
+        quote_store.record(debug_id, quote, cached, plan.version, org_id, source="cache")
+        return jsonify({"debug_id": debug_id, **quote_tokens.attach(plan.config_id, quote, cached, org_id, debug_id)})
+
+    # Förberäknat rutnät (om aktiverat och koordinaterna ligger vid zonernas centroider)
+    grid = grid_utils.active_grid(plan)
+    grid_results = grid.quote(
+        plan, pickup_coord, delivery_coord,
+        pickup_country, pickup_postal, delivery_country, delivery_postal, weight
+    ) if grid else None
+    if grid_results is not None:
+        routing_utils.network_for(plan).apply(quote, grid_results)
+        quote_cache.put(cache_key, grid_results)
+        grid_results = capacity.adjust(quote, grid_results)
+        event.results(grid_results, source="grid")
+        event.emit()
+        quote_store.record(debug_id, quote, grid_results, plan.version, org_id, source="grid")
+        return jsonify({"debug_id": debug_id, **quote_tokens.attach(plan.config_id, quote, grid_results, org_id, debug_id)})
+
+    # Omvänt zonindex: mode som inte täcker båda ändar behöver inte räknas alls
+    serving = plan.serving_modes(pickup_country, pickup_postal, delivery_country, delivery_postal)
+
+    # En andel anrop körs med trace enbart för stegthistogrammen (samma svar)
+    sampled = QUOTE_TRACE_SAMPLE_RATE > 0 and random.random() < QUOTE_TRACE_SAMPLE_RATE
+    results, _ = calculate_modes(plan, quote, serving=serving, traced=sampled, debug_id=debug_id)
+
+    # Mode med hubbnät: sträckor utanför zonerna prissätts som förbärare + huvudben + förbärare
+    routing_utils.network_for(plan).apply(quote, results)
+    # Kundavtal: rabatt och fasta sträckpriser
+    if plan.agreement is not None:
+        plan.agreement.apply(quote, results)
+
+    # Krascher cachas inte – de kan vara tillfälliga
+    if not any(r.get("status") == "error" for r in results.values()):
+        quote_cache.put(cache_key, results)
+    results = capacity.adjust(quote, results)
+
+    event.results(results)
+    event.emit()
+    quote_store.record(debug_id, quote, results, plan.version, org_id, source="engine")
+    # Offert-id per prissatt mode (efter cachen – id:t är per anropare/org)
+    return jsonify({"debug_id": debug_id, **quote_tokens.attach(plan.config_id, quote, results, org_id, debug_id)})
+
+
+@app.get("/admin/quote-cache")
+@require_auth("superadmin")
+def admin_quote_cache_stats():
+    return jsonify({**quote_cache.stats(), "quote_log": quote_log_stats(), "quote_tokens": quote_tokens.stats(),
+                    "quote_store": quote_store.stats()})
 
-    EPS = 1e-9
-    if min(y1, y2, y3, y4) <= 0:
-        return {"available": False, "status": "Bad pricing config (y <= 0 leads to log-domain error)"}
 
-    # Exponenter (skydd mot log-domain/0-division)
-    try:
-        n1 = (log(y2) - log(y1)) / (log(p2) - log(p1)); a1 = y1 / (p1 ** n1)
-        n2 = (log(y3) - log(y2)) / (log(p3) - log(p2)); a2 = y2 / (p2 ** n2)
-        n3 = (log(y4) - log(y3)) / (log(bp) - log(p3)); a3 = y3 / (p3 ** n3)
-    except Exception:
-        return {"available": False, "status": "Bad pricing config (log/ratio failure)"}
-
-    # Prissättning
-    if weight < p1:
-        total_price = round(ftl_price * weight / maxw)
-    elif p1 <= weight < p2:
-        total_price = round(min(a1 * (weight ** n1) * weight, ftl_price))
-    elif p2 <= weight < p3:
-        total_price = round(min(a2 * (weight ** n2) * weight, ftl_price))
-    elif p3 <= weight <= bp:
-        total_price = round(min(a3 * (weight ** n3) * weight, ftl_price))
-    elif bp < weight <= maxw:
-        total_price = int(ftl_price)
-    else:
-        return {"available": False, "status": "Weight exceeds max weight"}
-
-    # Transit
-    speed = float(mode_config.get("transit_speed_kmpd", 500) or 500)
-    base_transit = max(1, int(round(distance_km / max(speed, 1))))
-    transit_time_days = [base_transit, base_transit + 1]
-
-    # Tidigaste hämtning
+@app.get("/admin/reports/quote-conversion")
+@require_auth("superadmin")
+def admin_quote_conversion_report():
+    """Offerter mot bokningar: ?days=30&group=lane|mode|org&top=20"""
+    days = request.args.get("days", default=30, type=int)
+    group = request.args.get("group", default="lane")
+    if days is None or not 1 <= days <= 366:
+        return jsonify({"error": "days must be 1–366"}), 400
+    if group not in REPORT_GROUPS:
+        return jsonify({"error": f"group must be one of {', '.join(REPORT_GROUPS)}"}), 400
+    since, until = report_window(days)
+    db = SessionLocal()
     try:
-        now_utc = datetime.utcnow()
-        tz_name = pytz.country_timezones[pickup_country.upper()][0]
-        now_local = now_utc.replace(tzinfo=pytz.utc).astimezone(pytz.timezone(tz_name))
-    except Exception:
-        now_local = datetime.utcnow()
+        report = conversion_report(db, since, until, group,
+                                   top_unavailable=request.args.get("top", default=20, type=int))
+    finally:
+        db.close()
+    return jsonify({**report, "store": quote_store.stats()})
+
+@app.get("/admin/postal-index")
+@require_auth("superadmin")
+def admin_postal_index():
+    """Indexets status; med ?country=SE&postal=21145 även uppslaget för det numret."""
+    if postal_index is None:
+        return jsonify({"loaded": False})
+    out = {"loaded": True, **postal_index.stats()}
+    if request.args.get("country"):
+        hit = postal_index.lookup(request.args["country"], request.args.get("postal"))
+        out["lookup"] = {"lat": hit[0], "lon": hit[1], "matched": hit[2]} if hit else None
+    return jsonify(out)
+
+@app.get("/admin/capacity")
+@require_auth("superadmin")
+def admin_capacity_stats():
+    top = request.args.get("top", default=20, type=int)
+    plan = get_pricing_plan(use="published")
+    rules = capacity_utils.rules_for(plan)
+    return jsonify({**capacity_counters.stats(top=max(1, min(top, 500))),
+                    "modes": sorted(rules.modes), "config_version": plan.version})
 
-    cutoff_hour = int(mode_config.get("cutoff_hour", 10) or 10)
-    cutoff = now_local.replace(hour=cutoff_hour, minute=0, second=0, microsecond=0)
-    days_to_add = 1 if now_local < cutoff else 2
 
+@app.post("/admin/capacity/reconcile")
+@require_auth("superadmin")
+def admin_capacity_reconcile():
+    plan = get_pricing_plan(use="published")
+    db = SessionLocal()
     try:
-        country_holidays = holidays.country_holidays(pickup_country.upper())
-    except Exception:
-        country_holidays = []
-
-    pickup_date = now_local.date()
-    added_days = 0
-    while added_days < days_to_add:
-        pickup_date += timedelta(days=1)
-        if pickup_date.weekday() < 5 and pickup_date not in country_holidays:
-            added_days += 1
+        n = capacity_utils.reconcile(db, plan)
+    finally:
+        db.close()
+    return jsonify({"ok": True, "bookings": n, **capacity_counters.stats(top=0)})
 
-    pickup_date += timedelta(days=int(mode_config.get("extra_pickup_days", 0) or 0))
-    earliest_pickup_date = pickup_date.isoformat()
 
-    co2_grams = max(0, int(round((distance_km * weight / 1000.0) * float(mode_config.get("co2_per_ton_km", 0) or 0) * 1000)))
+CALC_BATCH_MAX = int(os.getenv("CALC_BATCH_MAX", "1000"))
 
-    return {
-        "available": True, "status": "success",
-        "total_price_eur": int(total_price), "ftl_price_eur": int(ftl_price),
-        "distance_km": distance_km, "transit_time_days": transit_time_days,
-        "earliest_pickup_date": earliest_pickup_date, "currency": "EUR",
-        "co2_emissions_grams": co2_grams, "description": mode_config.get("description", "")
+@app.route("/calculate/batch", methods=["POST"])
+def calculate_batch_endpoint():
+    """
+    Body: {"requests": [</calculate-payload>, ...]} (eller bara listan).
+    Svar: {"debug_id": ..., "results": [...]} där varje element är exakt det
+    /calculate hade svarat för motsvarande payload.
+    """
+    debug_id = uuid.uuid4().hex[:8]
+    payload = request.get_json(silent=True)
+    items = payload.get("requests") if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        return jsonify({"error": "Body must be a list or {\"requests\": [...]}", "debug_id": debug_id}), 400
+    if len(items) > CALC_BATCH_MAX:
+        return jsonify({"error": f"Max {CALC_BATCH_MAX} requests per batch", "debug_id": debug_id}), 400
+
+    quotes, slots, results = [], [], []
+    for i, data in enumerate(items):
+        try:
+            quotes.append(parse_quote_input(data if isinstance(data, dict) else {}))
+            slots.append(i)
+            results.append(None)
+        except (KeyError, ValueError, TypeError):
+            results.append({"error": "Missing or invalid input", "debug_id": debug_id})
+
+    plan = agreement_store.plan_for(get_pricing_plan(use="published"), request_org_id())
+    network = routing_utils.network_for(plan)
+    capacity = capacity_utils.rules_for(plan)
+    for i, q, r in zip(slots, quotes, calculate_batch(plan, quotes)):
+        r = network.apply(q, r)
+        if plan.agreement is not None:
+            plan.agreement.apply(q, r)
+        results[i] = {"debug_id": debug_id, **capacity.adjust(q, r)}
+
+    app.logger.info("CALC-BATCH %s done: %d requests (%d invalid)", debug_id, len(items), len(items) - len(quotes))
+    return jsonify({"debug_id": debug_id, "results": results})
+
+
+@app.route("/coverage", methods=["GET"])
+def coverage():
+    """
+    Vilka mode som trafikerar vilka zonpar (+ modes viktgränser), utan prisberäkning.
+    Förberäknas per publicerad version (se coverage_utils); stöder If-None-Match.
+    """
+    plan = get_pricing_plan(use="published")
+    cov = coverage_utils.coverage_for(plan)
+    if cov is None:
+        return jsonify({"error": "Coverage not available"}), 503
+    headers = {
+        "ETag": f'"{cov.etag}"',
+        "Cache-Control": f"public, max-age={coverage_utils.COVERAGE_MAX_AGE}",
+        "Vary": "Accept-Encoding",
     }
+    if cov.etag in request.if_none_match:
+        return Response(status=304, headers=headers)
+    return Response(cov.body, mimetype="application/json", headers=headers)
 
 
-# Koppla Flask-loggningen till Gunicorns logger (så allt syns i Render)
-gunicorn_logger = logging.getLogger("gunicorn.error")
-if gunicorn_logger.handlers:
-    app.logger.handlers = gunicorn_logger.handlers
-    app.logger.setLevel(gunicorn_logger.level)
+CURVE_MAX_POINTS = int(os.getenv("CURVE_MAX_POINTS", "2000"))
 
-@app.route("/calculate", methods=["POST"])
-def calculate():
-    debug_id = uuid.uuid4().hex[:8]  # kort korrelations-ID
-    data = request.json or {}
+@app.route("/calculate/curve", methods=["POST"])
+def calculate_curve():
+    """
+    Pris mot vikt för en sträcka i ett anrop (ersätter en skur av /calculate).
+    Body: /calculate-payload utan chargeable_weight + weight_from, weight_to, weight_step.
+    Svar: {"weights": [...], "<mode>": {"prices": [...], "breakpoints": [...], ...}}.
+    Viktlistan innehåller även alla modes p1/p2/p3/default_breakpoint inom intervallet.
+    """
+    debug_id = uuid.uuid4().hex[:8]
+    data = request.get_json(silent=True) or {}
     try:
-        pickup_coord = data["pickup_coordinate"]
-        pickup_country = data["pickup_country"]
-        pickup_postal = data["pickup_postal_prefix"]
-        delivery_coord = data["delivery_coordinate"]
-        delivery_country = data["delivery_country"]
-        delivery_postal = data["delivery_postal_prefix"]
-        weight = float(data["chargeable_weight"])
-    except (KeyError, ValueError) as e:
-        app.logger.warning("CALC %s bad input: %s | payload=%s", debug_id, e, data)
+        (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+         delivery_country, delivery_postal, _) = parse_quote_input({**data, "chargeable_weight": 0})
+        w_from = float(data.get("weight_from", 1))
+        w_to = float(data["weight_to"])
+        if not (isfinite(w_from) and isfinite(w_to)):
+            raise ValueError("weights must be finite")
+        step = float(data.get("weight_step") or max((w_to - w_from) / 100.0, 1e-9))
+        if not isfinite(step):
+            raise ValueError("weight_step must be finite")
+        if not (0 <= w_from <= w_to) or step <= 0:
+            raise ValueError("need 0 <= weight_from <= weight_to and weight_step > 0")
+        n_steps = int((w_to - w_from) / step + 1e-9) + 1
+    except (KeyError, ValueError, TypeError, OverflowError) as e:
+        app.logger.warning("CURVE %s bad input: %s", debug_id, e)
         return jsonify({"error": "Missing or invalid input", "debug_id": debug_id}), 400
 
-    active_cfg = get_active_config(use="published") or {}
-    app.logger.info(
-        "CALC %s start %s-%s %s -> %s-%s %s kg",
-        debug_id, pickup_country, pickup_postal, pickup_coord, delivery_country, delivery_postal, weight
-    )
+    if n_steps > CURVE_MAX_POINTS:
+        return jsonify({"error": f"Max {CURVE_MAX_POINTS} points per curve", "debug_id": debug_id}), 400
+
+    plan = agreement_store.plan_for(get_pricing_plan(use="published"), request_org_id())
+    weights = {round(w_from + i * step, 6) for i in range(n_steps)}
+    for _, mp in plan.items():
+        if isinstance(mp, ModePlan) and mp.config_error is None:
+            weights |= {bw for bw in (mp.p1, mp.p2, mp.p3, mp.bp) if w_from <= bw <= w_to}
+    weights = sorted(weights)
 
-    results = {}
-    for mode, cfg in active_cfg.items():
+    out = {"debug_id": debug_id, "weights": weights}
+    lane = (pickup_coord, delivery_coord, pickup_country, pickup_postal, delivery_country, delivery_postal)
+    network = routing_utils.network_for(plan)
+    for mode, mode_plan in plan.items():
         try:
-            r = calculate_for_mode(
-                cfg, pickup_coord, delivery_coord,
-                pickup_country, pickup_postal, delivery_country, delivery_postal,
-                weight, mode_name=mode
-            )
-            results[mode] = r
-            if r.get("available"):
-                app.logger.info("CALC %s %s ok price=%s dist=%s", debug_id, mode, r.get("total_price_eur"), r.get("distance_km"))
-            else:
-                app.logger.info("CALC %s %s not-available: %s", debug_id, mode, r.get("status"))
+            out[mode] = weight_curve(mode_plan, weights, *lane, mode_name=mode)
+            # Sträckor utanför zonerna: flerbensrutt per vikt, som /calculate
+            out[mode] = network.curve(mode, lane, weights, out[mode])
         except Exception:
-            app.logger.exception("CALC %s %s crashed in calculate_for_mode", debug_id, mode)
-            results[mode] = {"available": False, "status": "error", "error": "internal", "mode": mode}
+            app.logger.exception("CURVE %s %s crashed", debug_id, mode)
+            out[mode] = {"available": False, "status": "error", "error": "internal", "mode": mode}
+    # Kundavtal: samma rabatter och fasta sträckpriser som /calculate
+    if plan.agreement is not None:
+        plan.agreement.apply_curve(lane, weights, out)
+    return jsonify(out)
 
-    app.logger.info("CALC %s done", debug_id)
-    return jsonify({"debug_id": debug_id, **results})
+
+# =========================================================
+# Tender-jobb (asynkron prissättning av stora sträcklistor)
+# =========================================================
+def _tender_meta_for_user(job_id: str):
+    meta = read_tender_meta(job_id)
+    if not meta:
+        return None
+    if request.user.get("role") != "superadmin" and meta.get("org_id") != request.user.get("org_id"):
+        return None
+    return meta
+
+@app.post("/tender/jobs")
+@require_auth()
+def tender_job_create():
+    """
+    Ladda upp CSV eller NDJSON (multipart 'file' eller rå body). Format tas från
+    ?format=, filändelsen eller Content-Type. Svar 202 med jobbets id och status.
+    """
+    upload = request.files.get("file")
+    raw = upload.read() if upload else request.get_data()
+    name = (upload.filename or "").lower() if upload else ""
+    fmt = (request.args.get("format") or "").lower()
+    if not fmt:
+        ctype = (upload.mimetype if upload else request.mimetype) or ""
+        if name.endswith(".csv") or "csv" in ctype:
+            fmt = "csv"
+        elif name.endswith((".ndjson", ".jsonl")) or "ndjson" in ctype or "jsonl" in ctype:
+            fmt = "ndjson"
+    try:
+        lanes = read_lanes(raw.decode("utf-8-sig"), fmt)
+    except UnicodeDecodeError:
+        return jsonify({"error": "Upload must be UTF-8"}), 400
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    rows = []
+    for data in lanes:
+        try:
+            rows.append((parse_quote_input(data), data.get("ref")))
+        except (KeyError, ValueError, TypeError):
+            rows.append((None, data.get("ref")))
+
+    # Organisationens kundavtal gäller även tenderpriser (som /calculate och /book)
+    plan = agreement_store.plan_for(get_pricing_plan(use="published"), request.user.get("org_id"))
+    meta = start_tender_job(plan, rows, request.user.get("org_id"), request.user.get("user_id"))
+    app.logger.info("TENDER %s started: %d lanes (%d invalid), config v%s",
+                    meta["id"], meta["total"], meta["invalid"], plan.version)
+    return jsonify(tender_public_meta(meta)), 202
+
+@app.get("/tender/jobs/<job_id>")
+@require_auth()
+def tender_job_status(job_id):
+    meta = _tender_meta_for_user(job_id)
+    if not meta:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(tender_public_meta(meta))
+
+@app.get("/tender/jobs/<job_id>/results")
+@require_auth()
+def tender_job_results(job_id):
+    """
+    Strömmar färdiga chunkar i radordning. ?format=ndjson (default) eller csv.
+    ?follow=1 håller svaret öppet tills jobbet är klart.
+    """
+    meta = _tender_meta_for_user(job_id)
+    if not meta:
+        return jsonify({"error": "Not found"}), 404
+    follow = request.args.get("follow") in ("1", "true", "yes")
+    headers = {"X-Tender-Status": meta["status"], "X-Tender-Chunks-Done": str(meta["chunks_done"])}
+    if (request.args.get("format") or "ndjson").lower() == "csv":
+        headers["Content-Disposition"] = f'attachment; filename="tender-{job_id[:8]}.csv"'
+        return Response(iter_tender_csv(job_id, meta["modes"], follow), mimetype="text/csv", headers=headers)
+    return Response(iter_tender_lines(job_id, follow), mimetype="application/x-ndjson", headers=headers)
+
+@app.delete("/tender/jobs/<job_id>")
+@require_auth()
+def tender_job_cancel(job_id):
+    if not _tender_meta_for_user(job_id):
+        return jsonify({"error": "Not found"}), 404
+    if not cancel_tender_job(job_id):
+        return jsonify({"ok": False, "error": "Job is not running"}), 409
+    return jsonify({"ok": True})
 
 
 
@@ -1952,6 +2380,26 @@ def book():
         if not db.query(User.id).filter(User.id == user_id).first():
             return jsonify({"ok": False, "error": "Authenticated user not found"}), 401
 
+        # selected_mode måste finnas i den publicerade prisplanen (kompilerad, cachad per version),
+        # med organisationens kundavtal om det finns
+        plan = agreement_store.plan_for(get_pricing_plan(use="published"), org_id)
+
+        # Offert-id från /calculate: pris, transittid och CO2 tas ur offerten, inte ur payloaden
+        quoted = None
+        if data.get("quote_id"):
+            try:
+                quoted = quote_tokens.resolve(data["quote_id"], org_id=org_id, config_id=plan.config_id)
+            except QuoteTokenError as e:
+                return jsonify({"ok": False, "error": str(e)}), e.status
+            if data.get("selected_mode") and data["selected_mode"] != quoted.mode:
+                return jsonify({"ok": False, "error": "selected_mode does not match quote_id"}), 400
+            data = {**data, "selected_mode": quoted.mode}
+        elif QUOTE_ID_REQUIRED:
+            return jsonify({"ok": False, "error": "quote_id is required"}), 400
+
+        if data.get("selected_mode") not in plan:
+            return jsonify({"ok": False, "error": "Unknown selected_mode"}), 400
+
         # 2) Fältalias: acceptera sender/receiver OCH pickup/delivery (+ postal_code/country_code)
         def pick_addr(src: dict | None) -> dict:
             src = src or {}
@@ -1971,6 +2419,20 @@ def book():
         body_sender   = pick_addr(data.get("sender")   or data.get("pickup"))
         body_receiver = pick_addr(data.get("receiver") or data.get("delivery"))
 
+        if quoted is not None:
+            if not QuoteTokens.lane_matches(quoted, body_sender["country"], body_sender["postal"],
+                                            body_receiver["country"], body_receiver["postal"]):
+                return jsonify({"ok": False, "error": "Addresses do not match the quoted lane"}), 400
+            # Offerten gäller bara upp till den offererade vikten
+            goods_weight = booking_weight(data.get("goods"))
+            if goods_weight is None:
+                return jsonify({"ok": False, "error": "goods with weight are required when booking a quote_id"}), 400
+            if quoted.weight is not None and goods_weight > float(quoted.weight) + 1e-6:
+                return jsonify({"ok": False, "error": f"Goods weight {goods_weight:g} kg exceeds the quoted "
+                                                      f"{float(quoted.weight):g} kg"}), 400
+            data = {**data, "price_eur": quoted.price_eur, "transit_time_days": quoted.transit_time_days,
+                    "co2_emissions_grams": quoted.co2_emissions_grams}
+
         def mk_addr(src: dict, addr_type: str) -> Address:
             return Address(
                 user_id=user_id,
@@ -2052,6 +2514,16 @@ def book():
         booking_id = booking_obj.id
         booking_number = booking_obj.booking_number
 
+        # Bokad volym på sträckan/hämtdagen (kapacitetsprissättning)
+        try:
+            capacity_counters.add(booking_entry(booking_obj, sender, receiver, plan))
+        except Exception:
+            app.logger.exception("capacity counter update failed for %s", booking_number)
+
+        # Offerten bokades – kopplingen skrivs i bakgrunden (konverteringsrapporten)
+        if quoted is not None and quoted.debug_id:
+            quote_store.link(quoted.debug_id, quoted.mode, booking_id)
+
         # 6) Bygg XML på en payload som säkert har pickup/delivery med 'postal'/'country'
         xml_payload = dict(data)  # shallow copy räcker (bara läsning i build_booking_xml)
         xml_payload["pickup"]   = body_sender
@@ -2115,6 +2587,7 @@ def book():
 @app.patch("/bookings/<bid>")
 @require_auth(role="admin")
 def update_booking(bid):
+    plan = get_pricing_plan(use="published")
     db = SessionLocal()
     try:
         b = db.query(Booking).filter(Booking.id == bid).first()
@@ -2122,6 +2595,7 @@ def update_booking(bid):
             return jsonify({"error": "Not found"}), 404
         if request.user["role"] != "superadmin" and b.org_id != request.user["org_id"]:
             return jsonify({"error": "Forbidden"}), 403
+        capacity_before = booking_entry(b, b.sender_address, b.receiver_address, plan)
 
         data = request.get_json(force=True) or {}
 
@@ -2187,6 +2661,11 @@ def update_booking(bid):
                 return jsonify({"error": "Actual unloading cannot be before actual loading"}), 400
 
         db.commit()
+        # CANCELLED (eller ny lastdag) flyttar/frigör bokad kapacitet
+        try:
+            capacity_counters.move(capacity_before, booking_entry(b, b.sender_address, b.receiver_address, plan))
+        except Exception:
+            app.logger.exception("capacity counter update failed for %s", bid)
         return jsonify(booking_to_dict(b))
     except BadRequest as e:
         db.rollback()
@@ -2261,7 +2740,17 @@ def admin_validate():
     if cfg is None:
         cfg = get_active_config(use="draft") or get_active_config(use="published")
     ok, errs = validate_config(cfg)
-    return jsonify({"ok": ok, "errors": errs})
+    out = {"ok": ok, "errors": errs}
+    # Svep över alla landspar × avstånd × vikter (hoppa över med "sweep": false).
+    # Fel i svepet gör hela valideringen underkänd, inte bara sweep.ok
+    if payload.get("sweep", True) and isinstance(cfg, dict):
+        try:
+            out["sweep"] = sweep_config(cfg)
+        except Exception:
+            app.logger.exception("config sweep failed")
+            out["sweep"] = {"ok": False, "error": "internal"}
+        out["ok"] = ok and out["sweep"]["ok"]
+    return jsonify(out)
 
 @app.post("/admin/config/publish")
 @require_auth("superadmin")
@@ -2293,7 +2782,10 @@ def admin_publish():
         db.add(new_pub)
         db.delete(draft)
         db.commit()
-        return jsonify({"ok": True, "version": new_pub.version})
+        version = new_pub.version
+        # Kompilera nya versionen direkt (prisrutnät, täckningskarta och hubbnät byggs om)
+        get_pricing_plan(use="published")
+        return jsonify({"ok": True, "version": version})
     except Exception as e:
         db.rollback()
         app.logger.exception("publish failed")
@@ -2301,6 +2793,49 @@ def admin_publish():
     finally:
         db.close()
 
+@app.get("/admin/config/price-list")
+@require_auth("superadmin")
+def admin_price_list():
+    """
+    Prislista för alla zonpar och viktband: ?version=N (standard publicerad)
+    &format=csv|pdf&weights=100,500,...&modes=road_freight,... – cachas per version.
+    """
+    fmt = (request.args.get("format") or "csv").lower()
+    if fmt not in PRICE_LIST_FORMATS:
+        return jsonify({"error": f"format must be one of {', '.join(PRICE_LIST_FORMATS)}"}), 400
+    weights = None
+    if request.args.get("weights"):
+        try:
+            weights = sorted({float(w) for w in request.args["weights"].split(",") if w.strip()})
+        except ValueError:
+            return jsonify({"error": "weights must be comma-separated numbers"}), 400
+        if not weights or len(weights) > PRICE_LIST_MAX_BANDS or weights[0] <= 0:
+            return jsonify({"error": f"weights: 1–{PRICE_LIST_MAX_BANDS} positive values"}), 400
+    modes = [m.strip() for m in (request.args.get("modes") or "").split(",") if m.strip()] or None
+
+    plan = get_pricing_plan(use="published")
+    version = request.args.get("version", type=int)
+    if version is not None and version != plan.version:
+        db = SessionLocal()
+        try:
+            row = (db.query(PricingConfig.id, PricingConfig.data)
+                   .filter(PricingConfig.status == "published", PricingConfig.version == version)
+                   .first())
+        finally:
+            db.close()
+        if not row:
+            return jsonify({"error": "Version not found"}), 404
+        plan = PricingPlan(row.data, version=version, config_id=row.id)
+    if modes and any(m not in plan for m in modes):
+        return jsonify({"error": "Unknown mode in modes"}), 400
+
+    data, cached = price_list(plan, fmt, weights, modes)
+    return Response(data, status=200, headers={
+        "Content-Type": "text/csv; charset=utf-8" if fmt == "csv" else "application/pdf",
+        "Content-Disposition": f'attachment; filename="price-list-v{plan.version}.{fmt}"',
+        "X-Price-List-Cache": "hit" if cached else "miss",
+    })
+
 @app.get("/admin/config/history")
 @require_auth("superadmin")
 def admin_history():
@@ -2354,24 +2889,118 @@ def admin_rollback(version: int):
 def admin_calculate_preview():
     data = request.json or {}
     try:
-        pickup_coord = data["pickup_coordinate"]
-        pickup_country = data["pickup_country"]
-        pickup_postal = data["pickup_postal_prefix"]
-        delivery_coord = data["delivery_coordinate"]
-        delivery_country = data["delivery_country"]
-        delivery_postal = data["delivery_postal_prefix"]
-        weight = float(data["chargeable_weight"])
+        (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+         delivery_country, delivery_postal, weight) = parse_quote_input(data)
     except (KeyError, ValueError):
         return jsonify({"error": "Missing or invalid input"}), 400
 
-    cfg = get_active_config(use="draft") or get_active_config(use="published")
-    results = {mode: calculate_for_mode(
-        cfg[mode], pickup_coord, delivery_coord,
-        pickup_country, pickup_postal, delivery_country, delivery_postal,
-        weight, mode_name=mode
-    ) for mode in cfg}
+    trace = quote_trace_requested()
+    with timed_stage("config") as config_stage:
+        plan = get_pricing_plan(use="draft")
+    quote = (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+             delivery_country, delivery_postal, weight)
+    # Draftens hubbnät byggs utan cache av network_for (version=None)
+    network = routing_utils.network_for(plan)
+    if trace:
+        results, traces = calculate_modes(plan, quote, traced=True)
+        network.apply(quote, results)
+        return jsonify({**results, "trace": {"config_us": config_stage.us, "modes": traces}})
+    results = {mode: calculate_for_mode(mode_plan, *quote, mode_name=mode) for mode, mode_plan in plan.items()}
+    network.apply(quote, results)
     return jsonify(results)
 
+@app.get("/admin/metrics/quote-stages")
+@require_auth("superadmin")
+def admin_quote_stage_metrics():
+    """Processvida histogram över stegtider (Prometheus-text, eller ?format=json)."""
+    if request.args.get("format") == "json":
+        return jsonify(stage_histograms.to_dict())
+    return Response(stage_histograms.prometheus_text(), mimetype="text/plain; version=0.0.4")
+
+@app.post("/admin/config/replay")
+@require_auth("superadmin")
+def admin_replay_start():
+    """Startar replay av historiska bokningar mot draft vs publicerad config (bakgrundsjobb)."""
+    payload = request.get_json(silent=True) or {}
+    db = SessionLocal()
+    try:
+        has_draft = db.query(PricingConfig.id).filter(PricingConfig.status == "draft").first() is not None
+    finally:
+        db.close()
+    if not has_draft:
+        return jsonify({"ok": False, "error": "No draft to replay"}), 400
+
+    published_plan = get_pricing_plan(use="published")
+    draft_plan = get_pricing_plan(use="draft")
+    try:
+        batch_size = max(100, min(int(payload.get("batch_size") or REPLAY_BATCH_SIZE), 20000))
+        job = start_replay_job(SessionLocal.session_factory, published_plan, draft_plan,
+                               batch_size=batch_size,
+                               include_cancelled=bool(payload.get("include_cancelled")))
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    app.logger.info("REPLAY %s started (published v%s vs draft)", job["id"], published_plan.version)
+    return jsonify({"ok": True, **job}), 202
+
+@app.get("/admin/config/replay/<job_id>")
+@require_auth("superadmin")
+def admin_replay_status(job_id):
+    job = get_replay_job(job_id)
+    if not job:
+        return jsonify({"error": "Not found"}), 404
+    return jsonify(job_public(job))
+
+@app.delete("/admin/config/replay/<job_id>")
+@require_auth("superadmin")
+def admin_replay_cancel(job_id):
+    if not cancel_replay_job(job_id):
+        return jsonify({"ok": False, "error": "Not running"}), 409
+    return jsonify({"ok": True})
+
+@app.post("/admin/config/balance-proposal")
+@require_auth("superadmin")
+def admin_balance_proposal():
+    """
+    Föreslår balance_factors utifrån bokningsflöden (se balance_utils).
+    Body: {"days": 180, "dry_run": false, "overwrite": false}. Utan dry_run
+    sparas förslaget som draft; finns redan en draft krävs overwrite.
+    """
+    payload = request.get_json(silent=True) or {}
+    try:
+        days = max(7, min(int(payload.get("days") or BALANCE_WINDOW_DAYS), 3650))
+    except (TypeError, ValueError):
+        return jsonify({"ok": False, "error": "days must be an integer"}), 400
+    dry_run = bool(payload.get("dry_run"))
+
+    cfg = get_active_config(use="published")
+    db = SessionLocal()
+    try:
+        report = run_balance_proposal(db, cfg, days=days,
+                                      include_cancelled=bool(payload.get("include_cancelled")))
+        proposal = report.pop("config")
+        out = {"ok": True, "dry_run": dry_run, **report}
+        if dry_run or not report["diff"]:
+            return jsonify(out)
+
+        ok, errs = validate_config(proposal)
+        if not ok:
+            return jsonify({"ok": False, "errors": errs, **report}), 400
+        has_draft = db.query(PricingConfig.id).filter(PricingConfig.status == "draft").first() is not None
+        if has_draft and not payload.get("overwrite"):
+            return jsonify({"ok": False, "error": "Draft already exists (set overwrite)", **report}), 409
+        out["draft_id"] = write_draft(
+            db, proposal, created_by=request.user.get("user_id"),
+            comment=f"balance_factors proposal ({len(report['diff'])} changes, {days} days)")
+        app.logger.info("BALANCE proposal saved as draft: %d changes from %d bookings",
+                        len(report["diff"]), report["bookings"])
+        return jsonify(out)
+    except Exception as e:
+        db.rollback()
+        app.logger.exception("balance proposal failed")
+        return jsonify({"ok": False, "error": str(e)}), 500
+    finally:
+        db.close()
+
 # =========================================================
 # Email & XML helpers
 # =========================================================
@@ -0,0 +1,178 @@
+# balance_utils.py
+"""
+Förslag på balance_factors utifrån faktiska bokningsflöden.
+
+Flödet per (mode, avsändarland, mottagarland) aggregeras i databasen
+(GROUP BY på bookings ⨝ addresses) – inga ORM-objekt laddas, så det går på
+sekunder även med miljontals bokningar. För varje riktat landspar A-B:
+
+  ratio    = (bokningar A→B + 1) / (bokningar B→A + 1)
+  förslag  = ratio ** BALANCE_ELASTICITY, kapat till [BALANCE_MIN_FACTOR, BALANCE_MAX_FACTOR]
+
+Fronthaul (mer gods ut än hem) blir alltså dyrare och backhaul billigare.
+Par med färre än BALANCE_MIN_BOOKINGS bokningar totalt (båda riktningarna)
+behåller sin faktor, liksom förändringar mindre än BALANCE_MIN_CHANGE.
+Inrikes par och länder utanför modets available_zones berörs inte.
+
+Resultatet är en kopia av publicerad config med nya faktorer som sparas som
+draft (samma väg som PUT /admin/config/draft) + en diff mot nuvarande värden.
+Körs nattligen via CLI:t längst ned eller manuellt via
+POST /admin/config/balance-proposal.
+"""
+import copy
+from datetime import date, timedelta
+import logging
+import os
+import time
+
+from sqlalchemy import func
+from sqlalchemy.orm import aliased
+
+from models import Address, Booking, PricingConfig, generate_uuid
+
+logger = logging.getLogger(__name__)
+
+BALANCE_WINDOW_DAYS = int(os.getenv("BALANCE_WINDOW_DAYS", "180"))
+BALANCE_MIN_BOOKINGS = int(os.getenv("BALANCE_MIN_BOOKINGS", "30"))
+BALANCE_ELASTICITY = float(os.getenv("BALANCE_ELASTICITY", "0.15"))
+BALANCE_MIN_FACTOR = float(os.getenv("BALANCE_MIN_FACTOR", "0.8"))
+BALANCE_MAX_FACTOR = float(os.getenv("BALANCE_MAX_FACTOR", "1.25"))
+BALANCE_MIN_CHANGE = float(os.getenv("BALANCE_MIN_CHANGE", "0.02"))
+
+
+def aggregate_flows(db, since: date, until: date | None = None, include_cancelled: bool = False) -> dict:
+    """{(mode, från, till): (bokningar, intäkt_eur)} – grupperat i databasen."""
+    S, R = aliased(Address), aliased(Address)
+    pc, dc = func.upper(S.country_code), func.upper(R.country_code)
+    q = (db.query(Booking.selected_mode, pc, dc,
+                  func.count(Booking.id), func.coalesce(func.sum(Booking.price_eur), 0.0))
+         .join(S, Booking.sender_address_id == S.id)
+         .join(R, Booking.receiver_address_id == R.id)
+         .filter(Booking.booking_date >= since))
+    if until is not None:
+        q = q.filter(Booking.booking_date < until)
+    if not include_cancelled:
+        q = q.filter(Booking.status != "CANCELLED")
+    q = q.group_by(Booking.selected_mode, pc, dc)
+    return {(mode, a, b): (int(n), float(rev or 0))
+            for mode, a, b, n, rev in q if mode and a and b}
+
+
+def proposed_factor(out_n: int, back_n: int) -> float:
+    ratio = (out_n + 1) / (back_n + 1)
+    f = ratio ** BALANCE_ELASTICITY
+    return round(min(max(f, BALANCE_MIN_FACTOR), BALANCE_MAX_FACTOR), 2)
+
+
+def propose_balance_factors(cfg: dict, flows: dict) -> tuple:
+    """
+    (ny_config, diff, stats). cfg ändras inte. diff innehåller bara par vars
+    faktor ändras; stats räknar par som lämnades orörda och varför.
+    """
+    new_cfg = copy.deepcopy(cfg)
+    diff, stats = [], {"changed": 0, "unchanged": 0, "insufficient_data": 0}
+    for mode_key, mode in new_cfg.items():
+        if not isinstance(mode, dict):
+            continue
+        ccs = sorted((mode.get("available_zones") or {}).keys())
+        bf = mode.get("balance_factors")
+        if not isinstance(bf, dict):
+            bf = mode["balance_factors"] = {}
+        for a in ccs:
+            for b in ccs:
+                if a == b:
+                    continue
+                pair = f"{a}-{b}"
+                out_n, out_rev = flows.get((mode_key, a, b), (0, 0.0))
+                back_n, _ = flows.get((mode_key, b, a), (0, 0.0))
+                if out_n + back_n < BALANCE_MIN_BOOKINGS:
+                    stats["insufficient_data"] += 1
+                    continue
+                current = float(bf.get(pair, 1.0) or 1.0)
+                proposed = proposed_factor(out_n, back_n)
+                if abs(proposed - current) < BALANCE_MIN_CHANGE:
+                    stats["unchanged"] += 1
+                    continue
+                bf[pair] = proposed
+                stats["changed"] += 1
+                diff.append({
+                    "mode": mode_key, "pair": pair, "current": current, "proposed": proposed,
+                    "bookings": out_n, "bookings_reverse": back_n,
+                    "revenue_eur": round(out_rev, 2),
+                    "ratio": round((out_n + 1) / (back_n + 1), 3),
+                })
+    diff.sort(key=lambda d: (d["mode"], -abs(d["proposed"] - d["current"]), d["pair"]))
+    return new_cfg, diff, stats
+
+
+def run_balance_proposal(db, cfg: dict, days: int = BALANCE_WINDOW_DAYS,
+                         today: date | None = None, include_cancelled: bool = False) -> dict:
+    """Aggregerar flöden och tar fram förslaget (skriver inget)."""
+    t0 = time.perf_counter()
+    until = (today or date.today()) + timedelta(days=1)
+    since = until - timedelta(days=days + 1)
+    flows = aggregate_flows(db, since, until, include_cancelled)
+    t_sql = time.perf_counter() - t0
+    new_cfg, diff, stats = propose_balance_factors(cfg or {}, flows)
+    return {
+        "window": {"from": since.isoformat(), "to": until.isoformat(), "days": days},
+        "params": {"min_bookings": BALANCE_MIN_BOOKINGS, "elasticity": BALANCE_ELASTICITY,
+                   "min_factor": BALANCE_MIN_FACTOR, "max_factor": BALANCE_MAX_FACTOR,
+                   "min_change": BALANCE_MIN_CHANGE},
+        "flows": len(flows),
+        "bookings": sum(n for n, _ in flows.values()),
+        "stats": stats,
+        "diff": diff,
+        "config": new_cfg,
+        "seconds": {"aggregate": round(t_sql, 3), "total": round(time.perf_counter() - t0, 3)},
+    }
+
+
+def write_draft(db, cfg: dict, created_by=None, comment: str | None = None):
+    """Skriver cfg som draft (skriver över befintlig draft, som PUT /admin/config/draft)."""
+    draft = db.query(PricingConfig).filter(PricingConfig.status == "draft").first()
+    if draft:
+        draft.data = cfg
+        draft.comment = comment
+    else:
+        draft = PricingConfig(id=generate_uuid(), status="draft", version=None, data=cfg,
+                              created_by=created_by, comment=comment)
+        db.add(draft)
+    db.commit()
+    return draft.id
+
+
+if __name__ == "__main__":
+    # Nattjobb (cron): python balance_utils.py [--days 180] [--write] [--overwrite]
+    import argparse
+    import json
+    import sys
+
+    ap = argparse.ArgumentParser(description="Propose balance_factors from booking flows")
+    ap.add_argument("--days", type=int, default=BALANCE_WINDOW_DAYS)
+    ap.add_argument("--write", action="store_true", help="save the proposal as draft config")
+    ap.add_argument("--overwrite", action="store_true", help="replace an existing draft")
+    args = ap.parse_args()
+
+    from app import SessionLocal, get_active_config, validate_config
+
+    cfg = get_active_config(use="published")
+    db = SessionLocal()
+    try:
+        report = run_balance_proposal(db, cfg, days=args.days)
+        summary = {k: v for k, v in report.items() if k != "config"}
+        if args.write and report["diff"]:
+            ok, errs = validate_config(report["config"])
+            if not ok:
+                print(json.dumps({"ok": False, "errors": errs}, indent=2))
+                sys.exit(1)
+            has_draft = db.query(PricingConfig.id).filter(PricingConfig.status == "draft").first()
+            if has_draft and not args.overwrite:
+                print(json.dumps({"ok": False, "error": "Draft already exists (use --overwrite)"}))
+                sys.exit(2)
+            summary["draft_id"] = write_draft(
+                db, report["config"],
+                comment=f"balance_factors proposal ({len(report['diff'])} changes, {args.days} days)")
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+    finally:
+        db.close()
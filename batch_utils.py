@@ -0,0 +1,276 @@
+# batch_utils.py
+"""
+Vektoriserad prissättning: samma regler som pricing_utils.calculate_for_mode,
+men avstånd, FTL-pris och viktkurvans tre power-law-segment räknas som
+NumPy-arrayer över alla förfrågningar i en batch.
+
+Resultatet ska vara identiskt med skalärvägen. NumPy:s log/pow/trig kan skilja
+sig från math på sista biten, så värden som hamnar nära en .5-avrundning (och
+allt som inte är välformat) räknas om med calculate_for_mode.
+"""
+from math import isfinite
+import numpy as np
+
+import distance_utils
+from distance_utils import DETOUR_FACTOR
+from pricing_utils import (ModePlan, calculate_for_mode, earliest_pickup_date_for, delivery_dates_for,
+                           lane_terms, curve_price, transit_days)
+
+# Marginal mot .5 innan vi litar på NumPy:s avrundning (fel är ~1e-12 relativt)
+ROUND_GUARD = 1e-6
+
+# Statuskoder för curve_prices
+ST_OK, ST_BAD_Y, ST_EXCEEDS, ST_FALLBACK = 0, 1, 2, 3
+
+
+def _near_half(x: np.ndarray) -> np.ndarray:
+    frac = x - np.floor(x)
+    return np.abs(frac - 0.5) < ROUND_GUARD
+
+def _is_num(v) -> bool:
+    return type(v) in (int, float)
+
+def _is_coord(c) -> bool:
+    return type(c) in (list, tuple) and len(c) == 2 and _is_num(c[0]) and _is_num(c[1])
+
+
+def haversine_np(lat1, lon1, lat2, lon2) -> np.ndarray:
+    R = 6371
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = np.sin(dlat/2)**2 + np.cos(lat1)*np.cos(lat2)*np.sin(dlon/2)**2
+    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1 - a))
+    return R * c
+
+def road_distances_km(quotes, fast, lat1, lon1, lat2, lon2):
+    """
+    (distance_km som int-array, mask där raden måste räknas skalärt).
+    Haversine vektoriseras; med vägnätsgraf slås varje rad upp (CH-frågorna är cachade).
+    """
+    if not distance_utils.distance_provider.vectorizable:
+        km = [distance_utils.road_distance_km(q[0], q[1]) if f else 1 for q, f in zip(quotes, fast)]
+        return np.array(km, dtype=np.int64), np.zeros(len(quotes), dtype=bool)
+    raw = haversine_np(lat1, lon1, lat2, lon2) * DETOUR_FACTOR
+    km = np.maximum(1, np.rint(raw)).astype(np.int64)
+    return km, _near_half(raw) | ~np.isfinite(raw)
+
+
+def ftl_prices(mp: ModePlan, distance_km: np.ndarray, balance: np.ndarray) -> np.ndarray:
+    return np.maximum(1, np.rint(distance_km * mp.km_price * balance)).astype(np.int64)
+
+def curve_prices(mp: ModePlan, ftl: np.ndarray, weight: np.ndarray, with_raw: bool = False):
+    """
+    Viktkurvan för ett mode med kompilerad config (config_error is None).
+    Returnerar (total_price int-array, status-array med ST_*). ST_FALLBACK
+    betyder att raden ska räknas skalärt. with_raw=True lägger till det
+    okapade kurvvärdet (före avrundning och FTL-tak) som tredje element.
+    """
+    ftl = ftl.astype(np.float64)
+    p1, p2, p3, bp, maxw = mp.p1, mp.p2, mp.p3, mp.bp, mp.maxw
+    y1 = mp.y1
+    y2 = (mp.p2k * ftl + mp.p2m) / p2
+    y3 = (mp.p3k * ftl + mp.p3m) / p3
+    y4 = ftl / bp
+
+    status = np.zeros(weight.shape, dtype=np.int8)
+    bad_y = (y2 <= 0) | (y3 <= 0) | (y4 <= 0) | (y1 <= 0)
+    status[bad_y] = ST_BAD_Y
+
+    with np.errstate(all="ignore"):
+        log_y2 = np.log(y2); log_y3 = np.log(y3)
+        n1 = (log_y2 - mp.log_y1) / mp.log_p12; a1 = y1 / (p1 ** n1)
+        n2 = (log_y3 - log_y2) / mp.log_p23;    a2 = y2 / (p2 ** n2)
+        n3 = (np.log(y4) - log_y3) / mp.log_p3bp; a3 = y3 / (p3 ** n3)
+
+        seg0 = weight < p1
+        seg1 = (p1 <= weight) & (weight < p2)
+        seg2 = (p2 <= weight) & (weight < p3)
+        seg3 = (p3 <= weight) & (weight <= bp)
+        seg4 = (bp < weight) & (weight <= maxw)
+
+        raw = np.select(
+            [seg0, seg1, seg2, seg3, seg4],
+            [ftl * weight / maxw, a1 * (weight ** n1) * weight, a2 * (weight ** n2) * weight,
+             a3 * (weight ** n3) * weight, ftl],
+            default=np.nan,
+        )
+        # Segment 1–3 går via log/pow → osäker sista bit; takas av ftl_price
+        powered = seg1 | seg2 | seg3
+        capped = np.where(powered, np.minimum(raw, ftl), raw)
+        unsure = powered & (~np.isfinite(raw) | ((raw < ftl) & _near_half(raw)))
+        total = np.rint(np.where(np.isfinite(capped), capped, 0)).astype(np.int64)
+
+    # Skalärt ger overflow/0-division i exponenterna "log/ratio failure" oavsett segment
+    exp_bad = ~(np.isfinite(a1) & np.isfinite(a2) & np.isfinite(a3))
+
+    ok = status == ST_OK
+    status[ok & ~(seg0 | powered | seg4)] = ST_EXCEEDS
+    status[ok & (unsure | exp_bad)] = ST_FALLBACK
+    if with_raw:
+        return total, status, raw
+    return total, status
+
+
+def calculate_batch(plan, quotes: list) -> list:
+    """
+    quotes: lista av tupler i samma ordning som calculate_for_mode tar dem
+    (pickup_coord, delivery_coord, pickup_country, pickup_postal,
+     delivery_country, delivery_postal, weight).
+    Returnerar en lista av {mode: resultat} – samma innehåll som /calculate.
+    """
+    n = len(quotes)
+    out = [dict() for _ in range(n)]
+    if n == 0:
+        return out
+
+    # Välformade rader går vektoriserat, resten skalärt
+    fast = np.array([_is_coord(q[0]) and _is_coord(q[1]) and isfinite(q[6]) for q in quotes], dtype=bool)
+    plat = np.array([q[0][0] if f else 0.0 for q, f in zip(quotes, fast)], dtype=np.float64)
+    plon = np.array([q[0][1] if f else 0.0 for q, f in zip(quotes, fast)], dtype=np.float64)
+    dlat = np.array([q[1][0] if f else 0.0 for q, f in zip(quotes, fast)], dtype=np.float64)
+    dlon = np.array([q[1][1] if f else 0.0 for q, f in zip(quotes, fast)], dtype=np.float64)
+    weight = np.array([q[6] if f else 0.0 for q, f in zip(quotes, fast)], dtype=np.float64)
+
+    distance_km, dist_unsure = road_distances_km(quotes, fast.tolist(), plat, plon, dlat, dlon)
+    fast &= ~dist_unsure
+
+    def scalar(i, mode, mode_plan):
+        q = quotes[i]
+        try:
+            return calculate_for_mode(mode_plan, q[0], q[1], q[2], q[3], q[4], q[5], q[6], mode_name=mode)
+        except Exception:
+            return {"available": False, "status": "error", "error": "internal", "mode": mode}
+
+    for mode, mp in plan.items():
+        if not isinstance(mp, ModePlan) or not _is_num(mp.min_allowed) or not _is_num(mp.max_allowed):
+            for i in range(n):
+                out[i][mode] = scalar(i, mode, mp)
+            continue
+
+        # Zoner + vikt (zonuppslag är per rad men billiga; cache per batch)
+        zone_cache = {}
+        def zone_ok(cc, postal):
+            key = (cc, postal)
+            r = zone_cache.get(key)
+            if r is None:
+                r = zone_cache[key] = mp.zone_allowed(cc, postal)
+            return r
+
+        mode_fast = fast.tolist()
+        in_zone = [False] * n
+        for i, q in enumerate(quotes):
+            try:
+                in_zone[i] = zone_ok(q[2], q[3]) and zone_ok(q[4], q[5])
+            except Exception:
+                mode_fast[i] = False
+        weight_ok = (weight >= mp.min_allowed) & (weight <= mp.max_allowed)
+        priced = np.array(mode_fast, dtype=bool) & np.array(in_zone, dtype=bool) & weight_ok
+        weight_ok = weight_ok.tolist()
+
+        idx = np.flatnonzero(priced)
+        total = status = ftl = transit = co2 = None
+        if idx.size:
+            balance = np.array([mp.balance_factor(quotes[i][2], quotes[i][4]) for i in idx], dtype=np.float64)
+            ftl = ftl_prices(mp, distance_km[idx], balance)
+            if mp.config_error is None:
+                total, status = curve_prices(mp, ftl, weight[idx])
+                dist = distance_km[idx]
+                transit = np.maximum(1, np.rint(dist / mp.speed)).astype(np.int64)
+                co2 = np.maximum(0, np.rint((dist * weight[idx] / 1000.0) * mp.co2_per_ton_km * 1000)).astype(np.int64)
+                total, status, transit, co2 = total.tolist(), status.tolist(), transit.tolist(), co2.tolist()
+            ftl = ftl.tolist()
+
+        pickup_dates = {}
+        pos = {i: k for k, i in enumerate(idx.tolist())}
+        dist_list = distance_km.tolist()
+        for i, q in enumerate(quotes):
+            if not mode_fast[i]:
+                out[i][mode] = scalar(i, mode, mp)
+                continue
+            if not in_zone[i]:
+                out[i][mode] = {"available": False, "status": "Not available for this request"}
+                continue
+            if not weight_ok[i]:
+                out[i][mode] = {"available": False, "status": "Weight not allowed",
+                                "error": f"Allowed weight range: {mp.min_allowed}–{mp.max_allowed} kg"}
+                continue
+            if mp.config_error:
+                out[i][mode] = {"available": False, "status": mp.config_error}
+                continue
+            k = pos[i]
+            st = status[k]
+            if st == ST_FALLBACK:
+                out[i][mode] = scalar(i, mode, mp)
+            elif st == ST_BAD_Y:
+                out[i][mode] = {"available": False, "status": "Bad pricing config (y <= 0 leads to log-domain error)"}
+            elif st == ST_EXCEEDS:
+                out[i][mode] = {"available": False, "status": "Weight exceeds max weight"}
+            else:
+                pc = q[2]
+                if pc not in pickup_dates:
+                    pickup_dates[pc] = earliest_pickup_date_for(pc, mp.cutoff_hour, mp.extra_pickup_days)
+                b = transit[k]
+                delivery = delivery_dates_for(q[4], pickup_dates[pc], b, b + 1, mp.transit_calendar_days)
+                out[i][mode] = {
+                    "available": True, "status": "success",
+                    "total_price_eur": total[k], "ftl_price_eur": ftl[k],
+                    "distance_km": dist_list[i], "transit_time_days": [b, b + 1],
+                    "earliest_pickup_date": pickup_dates[pc],
+                    "earliest_delivery_date": delivery[0], "latest_delivery_date": delivery[1],
+                    "currency": "EUR",
+                    "co2_emissions_grams": co2[k], "description": mp.description
+                }
+    return out
+
+
+def weight_curve(mp, weights: list, pickup_coord, delivery_coord, pickup_country, pickup_postal,
+                 delivery_country, delivery_postal, mode_name=None) -> dict:
+    """
+    Pris mot vikt för en sträcka och ett mode. Avstånd och LaneTerms räknas en
+    gång, viktkurvan vektoriserat över alla vikter. prices[k] är exakt
+    total_price_eur som calculate_for_mode ger för weights[k], eller None om
+    vikten inte kan prissättas (utanför viktgränserna eller över max_weight_kg).
+    """
+    if not isinstance(mp, ModePlan):
+        mp = ModePlan(mp, name=mode_name)
+
+    if not (mp.zone_allowed(pickup_country, pickup_postal) and
+            mp.zone_allowed(delivery_country, delivery_postal)):
+        return {"available": False, "status": "Not available for this request"}
+
+    distance_km = distance_utils.road_distance_km(pickup_coord, delivery_coord)
+    t = lane_terms(mp, distance_km, pickup_country, delivery_country)
+    if t.status:
+        return {"available": False, "status": t.status}
+
+    w = np.asarray(weights, dtype=np.float64)
+    total, status = curve_prices(mp, np.full(w.shape, t.ftl_price, dtype=np.int64), w)
+    prices = total.tolist()
+    for k, st in enumerate(status.tolist()):
+        if not (mp.min_allowed <= weights[k] <= mp.max_allowed):
+            prices[k] = None
+        elif st == ST_FALLBACK:
+            prices[k] = curve_price(mp, t, weights[k])[0]
+        elif st != ST_OK:
+            prices[k] = None
+
+    pickup = earliest_pickup_date_for(pickup_country, mp.cutoff_hour, mp.extra_pickup_days)
+    transit = transit_days(mp, distance_km)
+    delivery = delivery_dates_for(delivery_country, pickup, transit[0], transit[1], mp.transit_calendar_days)
+    marks = [("p1", mp.p1), ("p2", mp.p2), ("p3", mp.p3),
+             ("default_breakpoint", mp.bp), ("max_weight_kg", mp.maxw)]
+    return {
+        "available": any(p is not None for p in prices),
+        "status": "success",
+        "ftl_price_eur": int(t.ftl_price), "distance_km": distance_km,
+        "transit_time_days": transit, "earliest_pickup_date": pickup,
+        "earliest_delivery_date": delivery[0], "latest_delivery_date": delivery[1],
+        "allowed_weight_kg": [mp.min_allowed, mp.max_allowed],
+        "breakpoints": [
+            {"name": name, "weight_kg": bw,
+             "price_eur": (curve_price(mp, t, bw)[0] if mp.min_allowed <= bw <= mp.max_allowed else None)}
+            for name, bw in marks
+        ],
+        "prices": prices, "currency": "EUR", "description": mp.description,
+    }
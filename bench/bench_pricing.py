@@ -0,0 +1,267 @@
+# bench/bench_pricing.py
+"""
+Prestandatest för prismotorn – kräver inga externa tjänster.
+
+Kör:  python bench/bench_pricing.py               (jämför mot bench/baseline.json)
+      python bench/bench_pricing.py --update-baseline
+      python bench/bench_pricing.py --threshold 30 --only calculate_for_mode
+
+Använder modes i config.json, en fast slumpad sträckmix över alla länder i
+available_zones (tyngd mot SE som i verkligheten) och vikter över hela
+intervallet. /calculate körs via Flask test_client mot en temporär SQLite-fil.
+Avslutas med kod 1 om något test är mer än --threshold procent långsammare
+än baslinjen. Jämförelsen görs med bästa körningen (min av --repeats) mot
+baslinjens median: min är minst känslig för brus från andra processer, och
+en regression betyder då att inte ens bästa körningen når en vanlig körning
+från baslinjen. Baslinjen är maskinberoende – uppdatera den på samma maskin
+som jämförelsen körs på, och efter varje ändring som avsiktligt ändrar vad
+/calculate gör.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+BASELINE_PATH = os.path.join(ROOT, "bench", "baseline.json")
+
+# Ungefärliga lat/lon-rutor per land (räcker för realistiska avstånd)
+COUNTRY_BOXES = {
+    "SE": (55.4, 65.0, 11.5, 20.0), "DK": (54.8, 57.5, 8.3, 12.6), "NO": (58.2, 63.5, 5.3, 11.5),
+    "FI": (60.0, 64.5, 21.5, 29.5), "DE": (47.5, 54.8, 6.0, 14.8), "FR": (43.3, 50.8, -1.5, 7.5),
+    "NL": (51.4, 53.3, 4.0, 7.0), "BE": (49.6, 51.4, 2.7, 6.2), "IT": (37.0, 46.5, 7.5, 16.5),
+    "ES": (36.5, 43.5, -8.5, 2.8), "PT": (37.2, 42.0, -8.8, -6.5), "AT": (46.5, 48.9, 9.6, 17.0),
+    "PL": (49.5, 54.6, 14.5, 23.8), "CZ": (48.6, 51.0, 12.2, 18.8), "SK": (47.8, 49.5, 17.0, 22.4),
+    "HU": (45.8, 48.5, 16.2, 22.8), "RO": (43.7, 48.2, 20.5, 29.5), "BG": (41.3, 44.1, 22.4, 28.5),
+    "HR": (42.5, 46.5, 13.5, 19.3), "SI": (45.5, 46.8, 13.5, 16.5), "GR": (37.0, 41.5, 20.5, 26.5),
+    "IE": (51.5, 55.3, -10.0, -6.0), "EE": (57.6, 59.6, 22.0, 28.0), "LV": (55.7, 57.9, 21.0, 28.0),
+    "LT": (54.0, 56.4, 21.0, 26.5), "LU": (49.5, 50.1, 5.8, 6.5), "UK": (50.5, 57.5, -5.5, 1.5),
+    "CH": (45.9, 47.7, 6.0, 10.4), "UA": (46.0, 51.5, 23.0, 38.0),
+}
+
+
+def load_config() -> dict:
+    with open(os.path.join(ROOT, "config.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def lane_mix(cfg: dict, n: int, seed: int = 42) -> list:
+    """Tupler i calculate_for_mode-ordning: (pcoord, dcoord, pc, pp, dc, dp, vikt)."""
+    rnd = random.Random(seed)
+    countries = sorted({cc for m in cfg.values() for cc in (m.get("available_zones") or {})})
+    weights = [12 if cc == "SE" else 3 if cc in ("DE", "IT", "DK", "NO", "FI") else 1 for cc in countries]
+
+    def point(cc):
+        la0, la1, lo0, lo1 = COUNTRY_BOXES.get(cc, (45.0, 55.0, 5.0, 20.0))
+        return [round(rnd.uniform(la0, la1), 5), round(rnd.uniform(lo0, lo1), 5)]
+
+    lanes = []
+    for _ in range(n):
+        pc = rnd.choices(countries, weights)[0]
+        dc = rnd.choices(countries, weights)[0]
+        # Vikt: mest styckegods, men hela skalan inkl. över max
+        w = rnd.choice([rnd.uniform(1, 300), rnd.uniform(300, 2500), rnd.uniform(2500, 26000), rnd.uniform(0, 30000)])
+        lanes.append((point(pc), point(dc), pc, f"{rnd.randint(0, 99):02d}", dc, f"{rnd.randint(0, 99):02d}", round(w, 1)))
+    return lanes
+
+
+def timed(fn, calls_per_run: int, repeats: int) -> dict:
+    fn()  # uppvärmning (kompilering, cacher)
+    per_call = []
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        per_call.append((time.perf_counter() - t0) / calls_per_run * 1e6)
+    med = statistics.median(per_call)
+    return {
+        "us_per_call": round(med, 3),
+        "us_per_call_min": round(min(per_call), 3),
+        "us_per_call_max": round(max(per_call), 3),
+        "calls_per_sec": round(1e6 / med, 1) if med else None,
+        "calls_per_run": calls_per_run,
+        "repeats": repeats,
+    }
+
+
+def build_benchmarks(n_lanes: int) -> dict:
+    from pricing_utils import haversine, is_zone_allowed, calculate_for_mode, PricingPlan
+    from batch_utils import calculate_batch
+
+    cfg = load_config()
+    plan = PricingPlan(cfg, version=0, config_id="bench")
+    lanes = lane_mix(cfg, n_lanes)
+    road = cfg.get("road_freight") or next(iter(cfg.values()))
+    road_zones = road["available_zones"]
+    road_plan = plan.modes.get("road_freight") or next(iter(plan.modes.values()))
+
+    def bench_haversine():
+        for q in lanes:
+            haversine(q[0], q[1])
+
+    def bench_is_zone_allowed():
+        for q in lanes:
+            is_zone_allowed(q[2], q[3], road_zones)
+
+    def bench_zone_allowed_compiled():
+        for q in lanes:
+            road_plan.zone_allowed(q[2], q[3])
+
+    def bench_calculate_for_mode():
+        for q in lanes:
+            for mode, mp in plan.items():
+                calculate_for_mode(mp, *q, mode_name=mode)
+
+    def bench_calculate_for_mode_raw_dict():
+        for q in lanes[: max(1, len(lanes) // 10)]:
+            for mode, mode_cfg in cfg.items():
+                calculate_for_mode(mode_cfg, *q, mode_name=mode)
+
+    def bench_calculate_batch():
+        calculate_batch(plan, lanes)
+
+    n_modes = len(plan)
+    return {
+        "haversine": (bench_haversine, len(lanes)),
+        "is_zone_allowed": (bench_is_zone_allowed, len(lanes)),
+        "zone_allowed_compiled": (bench_zone_allowed_compiled, len(lanes)),
+        "calculate_for_mode": (bench_calculate_for_mode, len(lanes) * n_modes),
+        "calculate_for_mode_raw_dict": (bench_calculate_for_mode_raw_dict, max(1, len(lanes) // 10) * n_modes),
+        "calculate_batch_per_lane": (bench_calculate_batch, len(lanes)),
+    }
+
+
+def build_handler_benchmark(n_requests: int):
+    """Hela /calculate via Flask test_client mot en temporär SQLite-databas (seedas från config.json)."""
+    tmp = tempfile.mkdtemp(prefix="efb-bench-")
+    os.environ["DATABASE_URL"] = f"sqlite:///{os.path.join(tmp, 'bench.db')}"
+    os.environ.setdefault("JWT_SECRET", "bench")
+    # Mät prissättningen, inte quote-cachen, offertloggen eller offertlagret
+    os.environ["QUOTE_CACHE_SIZE"] = "0"
+    os.environ["QUOTE_LOG_SAMPLE_RATE"] = "0"
+    os.environ["QUOTE_STORE_ENABLED"] = "false"
+    os.chdir(ROOT)
+    import app as efb_app
+
+    client = efb_app.app.test_client()
+    logging_level = efb_app.app.logger.level
+    efb_app.app.logger.setLevel("WARNING")
+    payloads = [{
+        "pickup_coordinate": q[0], "delivery_coordinate": q[1],
+        "pickup_country": q[2], "pickup_postal_prefix": q[3],
+        "delivery_country": q[4], "delivery_postal_prefix": q[5],
+        "chargeable_weight": q[6],
+    } for q in lane_mix(load_config(), n_requests, seed=7)]
+
+    def bench_calculate_handler():
+        for p in payloads:
+            r = client.post("/calculate", json=p)
+            if r.status_code != 200:
+                raise RuntimeError(f"/calculate returned {r.status_code}")
+
+    # En batch tar bara några ms – flera per körning så mätningen inte drunknar i brus
+    batch_rounds = 10
+
+    def bench_calculate_batch_handler():
+        for _ in range(batch_rounds):
+            r = client.post("/calculate/batch", json={"requests": payloads})
+            if r.status_code != 200:
+                raise RuntimeError(f"/calculate/batch returned {r.status_code}")
+
+    def restore():
+        efb_app.app.logger.setLevel(logging_level)
+
+    return {
+        "calculate_handler": (bench_calculate_handler, len(payloads)),
+        "calculate_batch_handler_per_lane": (bench_calculate_batch_handler, len(payloads) * batch_rounds),
+    }, restore
+
+
+def main(argv=None) -> int:
+    ap = argparse.ArgumentParser(description="Pricing engine benchmarks")
+    ap.add_argument("--lanes", type=int, default=2000, help="lanes per run for function benchmarks")
+    ap.add_argument("--requests", type=int, default=200, help="requests per run for the /calculate handler")
+    ap.add_argument("--repeats", type=int, default=5)
+    ap.add_argument("--threshold", type=float, default=float(os.getenv("BENCH_THRESHOLD_PCT", "25")),
+                    help="fail if slower than baseline by more than this many percent")
+    ap.add_argument("--baseline", default=BASELINE_PATH)
+    ap.add_argument("--update-baseline", action="store_true")
+    ap.add_argument("--no-handler", action="store_true", help="skip the Flask /calculate benchmarks")
+    ap.add_argument("--only", action="append", help="run only the named benchmark(s)")
+    ap.add_argument("--json", action="store_true", help="print results as JSON")
+    args = ap.parse_args(argv)
+
+    benches = build_benchmarks(args.lanes)
+    restore = None
+    if not args.no_handler:
+        handler, restore = build_handler_benchmark(args.requests)
+        benches.update(handler)
+    if args.only:
+        benches = {k: v for k, v in benches.items() if k in set(args.only)}
+
+    results = {}
+    try:
+        for name, (fn, calls) in benches.items():
+            results[name] = timed(fn, calls, args.repeats)
+    finally:
+        if restore:
+            restore()
+
+    baseline, base_host = {}, None
+    if os.path.exists(args.baseline):
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            doc = json.load(f)
+        baseline, base_host = doc.get("benchmarks", {}), doc.get("host")
+    if baseline and base_host != platform.node() and not args.update_baseline:
+        print(f"NOTE: baseline was recorded on {base_host or 'an unknown host'}, not {platform.node()} – "
+              "absolute timings are not comparable across machines; run --update-baseline here first",
+              file=sys.stderr)
+
+    regressions = []
+    for name, r in results.items():
+        b = baseline.get(name) or {}
+        base = b.get("us_per_call")
+        r["baseline_us_per_call"] = base
+        if base:
+            r["change_pct"] = round((r["us_per_call_min"] - base) / base * 100, 1)
+            if r["change_pct"] > args.threshold:
+                regressions.append(name)
+
+    if args.json:
+        print(json.dumps({"threshold_pct": args.threshold, "benchmarks": results}, indent=2))
+    else:
+        print(f"{'benchmark':34} {'µs/call':>12} {'min':>10} {'calls/s':>12} {'baseline':>10} {'change':>8}")
+        for name, r in results.items():
+            base = r["baseline_us_per_call"]
+            change = f"{r['change_pct']:+.1f}%" if base else "—"
+            flag = "  REGRESSION" if name in regressions else ""
+            print(f"{name:34} {r['us_per_call']:12.2f} {r['us_per_call_min']:10.2f} {r['calls_per_sec']:12.0f} "
+                  f"{(base if base else '—'):>10} {change:>8}{flag}")
+
+    if args.update_baseline:
+        merged = dict(baseline)
+        merged.update({k: {"us_per_call": v["us_per_call"], "us_per_call_min": v["us_per_call_min"],
+                           "calls_per_sec": v["calls_per_sec"]}
+                       for k, v in results.items()})
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump({"python": sys.version.split()[0], "host": platform.node(), "lanes": args.lanes,
+                       "requests": args.requests, "benchmarks": merged}, f, indent=2, sort_keys=True)
+            f.write("\n")
+        print(f"Baseline written to {args.baseline}")
+        return 0
+
+    if regressions:
+        print(f"FAILED: {len(regressions)} benchmark(s) slower than baseline by more than {args.threshold}%: "
+              + ", ".join(regressions))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
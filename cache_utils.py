@@ -0,0 +1,115 @@
+# cache_utils.py
+"""
+Begränsad LRU/TTL-cache för färdiga /calculate-svar.
+
+Nyckeln är den normaliserade förfrågan: land + postnummerprefix i båda ändar,
+avrundade koordinater, viktband, config-id och UTC-timme. Cutoff ligger alltid
+på hel lokal timme och alla tidszoner vi kör i har hela timmar som offset, så
+UTC-timmen bestämmer både upphämtningslandets datum och om cutoff passerats –
+earliest_pickup_date i en cachad post är alltså alltid aktuell.
+
+När en ny config publiceras (nytt config-id) töms cachen. Planer för
+kundavtal (agreement_utils) har egna config-id ovanpå basens och hamnar
+under egna nycklar i samma cache.
+"""
+from collections import OrderedDict
+from datetime import datetime
+import os
+import threading
+import time
+
+QUOTE_CACHE_SIZE = int(os.getenv("QUOTE_CACHE_SIZE", "10000"))
+QUOTE_CACHE_TTL = float(os.getenv("QUOTE_CACHE_TTL", "300"))
+# Decimaler för koordinater (5 ≈ 1 m) och viktband i kg (0 = exakt vikt)
+QUOTE_CACHE_COORD_DECIMALS = int(os.getenv("QUOTE_CACHE_COORD_DECIMALS", "5"))
+QUOTE_CACHE_WEIGHT_BAND_KG = float(os.getenv("QUOTE_CACHE_WEIGHT_BAND_KG", "0"))
+
+
+def _num_key(v, decimals):
+    if type(v) not in (int, float):
+        raise TypeError("not a number")
+    return round(float(v), decimals)
+
+
+def quote_cache_key(config_id, pickup_coord, delivery_coord, pickup_country, pickup_postal,
+                    delivery_country, delivery_postal, weight, now_utc: datetime | None = None):
+    """Tuple-nyckel, eller None om förfrågan inte går att normalisera (cachas då inte)."""
+    try:
+        d = QUOTE_CACHE_COORD_DECIMALS
+        coords = (_num_key(pickup_coord[0], d), _num_key(pickup_coord[1], d),
+                  _num_key(delivery_coord[0], d), _num_key(delivery_coord[1], d))
+        band = QUOTE_CACHE_WEIGHT_BAND_KG
+        weight_key = float(weight) if band <= 0 else int(weight // band)
+        hour = (now_utc or datetime.utcnow()).strftime("%Y%m%d%H")
+        return (config_id, str(pickup_country), str(pickup_postal), str(delivery_country),
+                str(delivery_postal), coords, weight_key, hour)
+    except (TypeError, ValueError, IndexError, KeyError):
+        return None
+
+
+class QuoteCache:
+    def __init__(self, maxsize: int = QUOTE_CACHE_SIZE, ttl: float = QUOTE_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._config_id = None
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def _check_version(self, config_id):
+        # Anropas med låset taget. Kundavtalsplaner har config_id "<bas>:org…" – de
+        # delar cachen med basversionen (nyckeln skiljer dem) och tömmer den inte.
+        config_id = str(config_id).split(":", 1)[0] if config_id is not None else None
+        if config_id != self._config_id:
+            if self._data:
+                self.invalidations += 1
+            self._data.clear()
+            self._config_id = config_id
+
+    def get(self, key):
+        if key is None:
+            return None
+        now = time.monotonic()
+        with self._lock:
+            self._check_version(key[0])
+            item = self._data.get(key)
+            if item is None or item[0] < now:
+                if item is not None:
+                    del self._data[key]
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[1]
+
+    def put(self, key, value):
+        if key is None or self.maxsize <= 0:
+            return
+        with self._lock:
+            self._check_version(key[0])
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data), "maxsize": self.maxsize, "ttl_seconds": self.ttl,
+                "hits": self.hits, "misses": self.misses,
+                "hit_ratio": round(self.hits / total, 4) if total else None,
+                "evictions": self.evictions, "invalidations": self.invalidations,
+                "config_id": self._config_id,
+            }
+
+
+quote_cache = QuoteCache()
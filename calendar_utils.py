@@ -0,0 +1,123 @@
+# calendar_utils.py
+"""
+Arbetsdagskalender per land: tidszoner och helgdagar byggs en gång per
+(land, år) och "n:te arbetsdagen efter datum d" blir ett tabelluppslag.
+
+Leveransfönster: från tidigaste hämtdag räknas transittiden i arbetsdagar i
+mottagarlandet (eller i kalenderdagar och skjuts då till nästa arbetsdag där,
+för mode som går även helger). Leverans sker alltså aldrig på helg/helgdag
+i mottagarlandet.
+"""
+from datetime import datetime, date, timedelta
+import threading
+import pytz
+import holidays
+
+
+class _YearTable:
+    """
+    Arbetsdagar för år Y och Y+1 (så att uppslag i december räcker in i januari).
+    rank[i]  = antal arbetsdagar med ordinal <= base + i
+    bdays[k] = ordinal för arbetsdag nr k (0-indexerat)
+    """
+    __slots__ = ("base", "rank", "bdays", "holiday_dates")
+
+    def __init__(self, country: str | None, year: int):
+        start = date(year, 1, 1)
+        end = date(year + 1, 12, 31)
+        try:
+            hol = holidays.country_holidays(country, years=(year, year + 1)) if country else {}
+            self.holiday_dates = frozenset(hol.keys())
+        except Exception:
+            self.holiday_dates = frozenset()
+
+        self.base = start.toordinal()
+        self.rank = []
+        self.bdays = []
+        d = start
+        while d <= end:
+            if d.weekday() < 5 and d not in self.holiday_dates:
+                self.bdays.append(d.toordinal())
+            self.rank.append(len(self.bdays))
+            d += timedelta(days=1)
+
+
+class BusinessCalendar:
+    def __init__(self):
+        self._tz: dict = {}
+        self._tables: dict = {}
+        self._lock = threading.Lock()
+
+    def timezone(self, country: str | None):
+        """Första tidszonen för landet enligt pytz, eller None (→ UTC)."""
+        if country in self._tz:
+            return self._tz[country]
+        try:
+            tz = pytz.timezone(pytz.country_timezones[country][0])
+        except Exception:
+            tz = None
+        self._tz[country] = tz
+        return tz
+
+    def _table(self, country: str | None, year: int) -> _YearTable:
+        key = (country, year)
+        t = self._tables.get(key)
+        if t is None:
+            with self._lock:
+                t = self._tables.get(key)
+                if t is None:
+                    t = self._tables[key] = _YearTable(country, year)
+        return t
+
+    def is_business_day(self, country: str | None, d: date) -> bool:
+        t = self._table(country, d.year)
+        i = d.toordinal() - t.base
+        return t.rank[i] > (t.rank[i - 1] if i > 0 else 0)
+
+    def add_business_days(self, country: str | None, d: date, n: int) -> date:
+        """Den n:te arbetsdagen efter d (n >= 1); d själv räknas aldrig."""
+        if n <= 0:
+            return d
+        t = self._table(country, d.year)
+        k = t.rank[d.toordinal() - t.base] + n - 1
+        if k < len(t.bdays):
+            return date.fromordinal(t.bdays[k])
+        # Utanför tabellen (mycket stort n) – fortsätt från tabellens sista dag
+        last = date.fromordinal(t.base + len(t.rank) - 1)
+        return self.add_business_days(country, last, k - len(t.bdays) + 1)
+
+    def next_business_day(self, country: str | None, d: date) -> date:
+        """d om d är en arbetsdag, annars nästa."""
+        return self.add_business_days(country, d - timedelta(days=1), 1)
+
+    def delivery_window(self, country: str | None, pickup: date, transit_min: int, transit_max: int,
+                        calendar_days: bool = False) -> tuple:
+        """(tidigaste, senaste) leveransdag i country för hämtning pickup och transit [min, max] dagar."""
+        if calendar_days:
+            return (self.next_business_day(country, pickup + timedelta(days=transit_min)),
+                    self.next_business_day(country, pickup + timedelta(days=transit_max)))
+        return (self.add_business_days(country, pickup, transit_min),
+                self.add_business_days(country, pickup, transit_max))
+
+    def earliest_pickup(self, country, cutoff_hour: int, extra_pickup_days: int, now_utc: datetime | None = None) -> date:
+        """
+        Nästa arbetsdag i landets lokala tid (nästnästa om cutoff passerats),
+        plus extra_pickup_days kalenderdagar.
+        """
+        try:
+            cc = country.upper()
+        except Exception:
+            cc = None
+        now_utc = now_utc or datetime.utcnow()
+        tz = self.timezone(cc)
+        now_local = now_utc.replace(tzinfo=pytz.utc).astimezone(tz) if tz else now_utc
+
+        cutoff = now_local.replace(hour=cutoff_hour, minute=0, second=0, microsecond=0)
+        days_to_add = 1 if now_local < cutoff else 2
+
+        pickup_date = self.add_business_days(cc, now_local.date(), days_to_add)
+        return pickup_date + timedelta(days=extra_pickup_days)
+
+
+# Delad instans per process (gunicorn-worker)
+business_calendar = BusinessCalendar()
@@ -0,0 +1,324 @@
+# capacity_utils.py
+"""
+Kapacitetsstyrd prissättning per sträcka och hämtdag.
+
+Räknare i processen: bokad vikt och LDM per (mode, avsändarland, prefix,
+mottagarland, prefix, hämtdag). /book lägger till, statusbyte till/från
+CANCELLED (och flyttad lastdag) justerar. Uppslag är en dict-läsning, så
+offertlatensen påverkas inte. En bakgrundstråd stämmer av mot bookings var
+CAPACITY_RECONCILE_SECONDS och ersätter räknarna – det är också så andra
+gunicorn-workers bokningar kommer in.
+
+Config per mode (valfritt):
+  "capacity": {"daily_weight_kg": 250000, "daily_ldm": 130,
+               "pricing": [{"from": 0.0, "factor": 0.95}, {"from": 0.6, "factor": 1.0},
+                           {"from": 0.85, "factor": 1.12}],
+               "block_at": 1.0}
+Beläggning = max(vikt, LDM) / dagskapacitet; vikten inkluderar den
+offererade sändningen (offerten har ingen LDM). Faktorn för högsta "from"
+≤ beläggning multipliceras på priset; vid beläggning > block_at är modet
+inte tillgängligt den dagen.
+"""
+from datetime import date, datetime, timedelta, timezone
+import logging
+import os
+import threading
+import time
+
+from sqlalchemy.orm import aliased
+
+from models import Address, Booking
+from pricing_utils import ModePlan
+from calendar_utils import business_calendar
+from replay_utils import postal_prefix, booking_weight
+
+logger = logging.getLogger(__name__)
+
+CAPACITY_RECONCILE_SECONDS = float(os.getenv("CAPACITY_RECONCILE_SECONDS", "300"))
+# Bokningar äldre än så här (bokningsdatum) antas inte ligga på kommande hämtdagar
+CAPACITY_LOOKBACK_DAYS = int(os.getenv("CAPACITY_LOOKBACK_DAYS", "90"))
+NO_CAPACITY = "No capacity for pickup date"
+
+
+def booking_ldm(goods) -> float:
+    try:
+        return sum(float(g.get("ldm") or 0) for g in (goods or []) if isinstance(g, dict))
+    except (TypeError, ValueError):
+        return 0.0
+
+
+def lane_key(mode, pickup_country, pickup_postal, delivery_country, delivery_postal, pickup_day: str):
+    pp, dp = postal_prefix(pickup_postal), postal_prefix(delivery_postal)
+    if not (mode and pickup_country and delivery_country and pp and dp and pickup_day):
+        return None
+    return (mode, pickup_country.upper(), pp, delivery_country.upper(), dp, pickup_day)
+
+
+def booking_pickup_day(b, sender_country, mode_plan=None) -> str | None:
+    """Planerad/önskad lastdag, annars (ASAP) tidigaste hämtning räknat från bokningstillfället."""
+    d = b.loading_planned_date or b.loading_requested_date or b.requested_pickup_date
+    if d is None and isinstance(mode_plan, ModePlan):
+        created = b.created_at or datetime.utcnow()
+        if created.tzinfo is not None:
+            created = created.astimezone(timezone.utc).replace(tzinfo=None)
+        d = business_calendar.earliest_pickup(sender_country, mode_plan.cutoff_hour,
+                                              mode_plan.extra_pickup_days, now_utc=created)
+    if d is None:
+        d = b.booking_date
+    return d.isoformat() if d else None
+
+
+def booking_entry(b, sender, receiver, plan) -> tuple | None:
+    """(nyckel, vikt, ldm) för en bokning som tar kapacitet, annars None."""
+    if b is None or b.status == "CANCELLED" or sender is None or receiver is None:
+        return None
+    weight = booking_weight(b.goods)
+    if weight is None:
+        return None
+    mp = plan.modes.get(b.selected_mode) if plan is not None else None
+    key = lane_key(b.selected_mode, sender.country_code, sender.postal_code,
+                   receiver.country_code, receiver.postal_code,
+                   booking_pickup_day(b, sender.country_code, mp))
+    if key is None:
+        return None
+    return key, weight, booking_ldm(b.goods)
+
+
+class CapacityCounters:
+    def __init__(self):
+        self._data: dict = {}          # nyckel → [vikt, ldm, antal]
+        self._lock = threading.Lock()
+        self.reconciled_at = None
+        self.reconcile_seconds = None
+
+    def get(self, key) -> tuple:
+        v = self._data.get(key)
+        return (v[0], v[1]) if v else (0.0, 0.0)
+
+    def add(self, entry, sign: int = 1):
+        if entry is None:
+            return
+        key, weight, ldm = entry
+        with self._lock:
+            v = self._data.get(key)
+            if v is None:
+                v = self._data[key] = [0.0, 0.0, 0]
+            v[0] = max(0.0, v[0] + sign * weight)
+            v[1] = max(0.0, v[1] + sign * ldm)
+            v[2] = max(0, v[2] + sign)
+            if v[2] == 0:
+                del self._data[key]
+
+    def move(self, before, after):
+        """Bokningen ändrades (status/lastdag): dra bort gamla posten och lägg till den nya."""
+        if before == after:
+            return
+        self.add(before, -1)
+        self.add(after, +1)
+
+    def replace(self, data: dict, seconds: float):
+        with self._lock:
+            self._data = data
+        self.reconciled_at = datetime.utcnow().isoformat() + "Z"
+        self.reconcile_seconds = round(seconds, 3)
+
+    def stats(self, top: int = 20) -> dict:
+        items = sorted(self._data.items(), key=lambda kv: -kv[1][0])[:top]
+        return {
+            "lanes": len(self._data),
+            "reconciled_at": self.reconciled_at,
+            "reconcile_seconds": self.reconcile_seconds,
+            "top": [{"mode": k[0], "lane": f"{k[1]}-{k[2]}>{k[3]}-{k[4]}", "pickup_date": k[5],
+                     "weight_kg": round(v[0], 1), "ldm": round(v[1], 2), "bookings": v[2]}
+                    for k, v in items],
+        }
+
+
+capacity_counters = CapacityCounters()
+_lock = threading.Lock()
+
+
+# =========================================================
+# Avstämning mot bookings
+# =========================================================
+def reconcile(db, plan, today: date | None = None) -> int:
+    """Räknar om alla kommande hämtdagar från bookings och ersätter räknarna. → antal bokningar."""
+    t0 = time.perf_counter()
+    since = (today or date.today()) - timedelta(days=1)
+    S, R = aliased(Address), aliased(Address)
+    q = (db.query(Booking, S, R)
+         .outerjoin(S, Booking.sender_address_id == S.id)
+         .outerjoin(R, Booking.receiver_address_id == R.id)
+         .filter(Booking.status != "CANCELLED")
+         .filter(Booking.booking_date >= since - timedelta(days=CAPACITY_LOOKBACK_DAYS)))
+    data, n = {}, 0
+    for b, s, r in q.yield_per(1000):
+        entry = booking_entry(b, s, r, plan)
+        if entry is None or entry[0][5] < since.isoformat():
+            continue
+        key, weight, ldm = entry
+        v = data.get(key)
+        if v is None:
+            v = data[key] = [0.0, 0.0, 0]
+        v[0] += weight
+        v[1] += ldm
+        v[2] += 1
+        n += 1
+    capacity_counters.replace(data, time.perf_counter() - t0)
+    return n
+
+
+_reconciler = None
+
+
+def ensure_reconciler(session_factory, get_plan, interval: float = CAPACITY_RECONCILE_SECONDS):
+    """
+    Startar avstämningstråden en gång per process (idempotent). Den stämmer av
+    direkt och sedan var interval:e sekund, men bara när något mode har capacity.
+    """
+    global _reconciler
+    if interval <= 0 or _reconciler is not None:
+        return
+    with _lock:
+        if _reconciler is not None:
+            return
+
+        def _run():
+            while True:
+                try:
+                    plan = get_plan()
+                    if rules_for(plan).modes:
+                        db = session_factory()
+                        try:
+                            n = reconcile(db, plan)
+                        finally:
+                            db.close()
+                        logger.info("Capacity reconciled: %d bookings, %d lanes in %.2fs",
+                                    n, len(capacity_counters._data), capacity_counters.reconcile_seconds)
+                except Exception:
+                    logger.exception("Capacity reconciliation failed")
+                time.sleep(interval)
+
+        _reconciler = threading.Thread(target=_run, name="capacity-reconcile", daemon=True)
+        _reconciler.start()
+
+
+# =========================================================
+# Regler + prisjustering
+# =========================================================
+class ModeCapacity:
+    __slots__ = ("daily_weight_kg", "daily_ldm", "steps", "block_at")
+
+    def __init__(self, raw: dict):
+        self.daily_weight_kg = float(raw.get("daily_weight_kg") or 0) or None
+        self.daily_ldm = float(raw.get("daily_ldm") or 0) or None
+        if self.daily_weight_kg is None and self.daily_ldm is None:
+            raise ValueError("capacity needs daily_weight_kg and/or daily_ldm")
+        self.steps = sorted((float(s["from"]), float(s["factor"])) for s in raw.get("pricing") or [])
+        block_at = raw.get("block_at", 1.0)
+        self.block_at = float(block_at) if block_at is not None else None
+
+    def utilization(self, booked_weight, booked_ldm, weight) -> float:
+        u = 0.0
+        if self.daily_weight_kg:
+            u = (booked_weight + weight) / self.daily_weight_kg
+        if self.daily_ldm:
+            u = max(u, booked_ldm / self.daily_ldm)
+        return u
+
+    def factor(self, u: float) -> float:
+        f = 1.0
+        for start, factor in self.steps:
+            if u >= start:
+                f = factor
+            else:
+                break
+        return f
+
+
+def capacity_config_errors(mode_key: str, mode: dict) -> list:
+    raw = mode.get("capacity")
+    if raw is None:
+        return []
+    if not isinstance(raw, dict):
+        return [f"{mode_key}.capacity must be object"]
+    try:
+        mc = ModeCapacity(raw)
+    except (KeyError, TypeError, ValueError) as e:
+        return [f"{mode_key}.capacity invalid: {e}"]
+    errors = []
+    if any(f <= 0 for _, f in mc.steps):
+        errors.append(f"{mode_key}.capacity.pricing factors must be > 0")
+    if any(s < 0 for s, _ in mc.steps):
+        errors.append(f"{mode_key}.capacity.pricing 'from' must be >= 0")
+    if mc.block_at is not None and mc.block_at <= 0:
+        errors.append(f"{mode_key}.capacity.block_at must be > 0")
+    return errors
+
+
+class CapacityRules:
+    def __init__(self, plan):
+        self.config_id = plan.config_id
+        self.modes: dict = {}
+        for name, mp in plan.items():
+            raw = mp.raw.get("capacity") if isinstance(mp, ModePlan) and isinstance(mp.raw, dict) else None
+            if not raw:
+                continue
+            try:
+                self.modes[name] = ModeCapacity(raw)
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Capacity %s ignored: %s", name, e)
+
+    def adjust(self, quote: tuple, results: dict) -> dict:
+        """
+        Nytt resultat-dict med kapacitetsjusterade priser (results ändras inte –
+        det kan komma ur offertcachen).
+        """
+        if not self.modes:
+            return results
+        _, _, pickup_country, pickup_postal, delivery_country, delivery_postal, weight = quote
+        out = None
+        for name, mc in self.modes.items():
+            r = results.get(name)
+            if not r or not r.get("available"):
+                continue
+            key = lane_key(name, pickup_country, pickup_postal, delivery_country, delivery_postal,
+                           r.get("earliest_pickup_date"))
+            if key is None:
+                continue
+            booked_w, booked_ldm = capacity_counters.get(key)
+            u = mc.utilization(booked_w, booked_ldm, weight)
+            if out is None:
+                out = dict(results)
+            info = {"utilization": round(u, 4), "pickup_date": key[5]}
+            if mc.block_at is not None and u > mc.block_at:
+                out[name] = {"available": False, "status": NO_CAPACITY,
+                             "earliest_pickup_date": key[5], "capacity": info}
+                continue
+            f = mc.factor(u)
+            adj = dict(r)
+            if f != 1.0:
+                adj["total_price_eur"] = int(round(r["total_price_eur"] * f))
+            info["factor"] = f
+            adj["capacity"] = info
+            out[name] = adj
+        return out if out is not None else results
+
+
+CAPACITY_RULES_CACHE_SIZE = 64
+_rules: dict = {}
+
+
+def rules_for(plan) -> CapacityRules:
+    """Reglerna för planen; publicerade planer (även kundavtalsplaner) cachas per config_id."""
+    cacheable = plan.version is not None and plan.config_id is not None
+    r = _rules.get(plan.config_id) if cacheable else None
+    if r is not None:
+        return r
+    r = CapacityRules(plan)
+    if cacheable:
+        with _lock:
+            _rules[plan.config_id] = r
+            while len(_rules) > CAPACITY_RULES_CACHE_SIZE:
+                _rules.pop(next(iter(_rules)))
+    return r
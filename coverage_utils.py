@@ -0,0 +1,174 @@
+# coverage_utils.py
+"""
+Förberäknad täckningskarta per publicerad config-version.
+
+Svarar på "vilka mode finns mellan A och B?" utan någon prisberäkning. För
+varje land delas postnummerrymden upp i zoner där samma uppsättning mode
+gäller (gränserna tas från alla modes ZoneIndex). Varje zon får en bitmask
+över modes; en sträcka trafikeras av mode i om bit i är satt både i
+avsändar- och mottagarzonen. matrix[o][d] är just den AND:en, förberäknad.
+
+Mode med hubbnät (routing_utils) räknas som tillgängliga även i
+förbärarmodets zoner, eftersom sådana sträckor prissätts som flerbensrutter.
+
+Postnummerintervall som inte finns med i zones trafikeras inte av något mode.
+Ett prefix som spänner över flera zoner trafikeras av ett mode bara om alla
+zonerna har biten.
+
+Svaret serialiseras en gång per version och skickas med ETag/Cache-Control.
+"""
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from pricing_utils import ModePlan, POSTAL_DIGITS, MIN_ZONE_DIGITS
+import routing_utils
+
+logger = logging.getLogger(__name__)
+
+# Över så här många zoner utelämnas matrisen (klienten gör AND:en själv)
+COVERAGE_MAX_MATRIX_ZONES = int(os.getenv("COVERAGE_MAX_MATRIX_ZONES", "400"))
+COVERAGE_MAX_AGE = int(os.getenv("COVERAGE_MAX_AGE", "300"))
+
+_TOP = 10 ** POSTAL_DIGITS
+
+
+def _postal_bounds(lo: int, hi: int) -> tuple:
+    """[20000, 89999] → ("20", "89"); så få siffror som intervallet tillåter (minst 2)."""
+    digits = POSTAL_DIGITS
+    while digits > MIN_ZONE_DIGITS:
+        scale = 10 ** (POSTAL_DIGITS - digits + 1)
+        if lo % scale or (hi + 1) % scale:
+            break
+        digits -= 1
+    scale = 10 ** (POSTAL_DIGITS - digits)
+    return str(lo // scale).zfill(digits), str(hi // scale).zfill(digits)
+
+
+def country_zones(indexes: list) -> list:
+    """
+    indexes: [(bit, ZoneIndex)] för ett land → [(lo, hi, mask)] sorterade,
+    disjunkta intervall med mask != 0 (angränsande med samma mask sammanslagna).
+    """
+    cuts = {0, _TOP}
+    for _, idx in indexes:
+        for lo, hi in idx.intervals():
+            cuts.add(lo)
+            cuts.add(hi + 1)
+    cuts = sorted(cuts)
+    out = []
+    for lo, nxt in zip(cuts, cuts[1:]):
+        hi = nxt - 1
+        mask = 0
+        for bit, idx in indexes:
+            if idx.covers_interval(lo, hi):
+                mask |= 1 << bit
+        if not mask:
+            continue
+        if out and out[-1][2] == mask and out[-1][1] + 1 == lo:
+            out[-1] = (out[-1][0], hi, mask)
+        else:
+            out.append((lo, hi, mask))
+    return out
+
+
+class CoverageMap:
+    def __init__(self, plan):
+        t0 = time.perf_counter()
+        self.version = plan.version
+        self.config_id = plan.config_id
+
+        mode_names = list(plan.modes)
+        network = routing_utils.network_for(plan)
+        modes = []
+        per_country: dict = {}
+        for bit, name in enumerate(mode_names):
+            mp = plan.modes[name]
+            if not isinstance(mp, ModePlan):
+                # Okompilerat mode → kan inte prissättas, märks som otillgängligt
+                modes.append({"name": name, "available": False, "config_error": "Mode could not be compiled"})
+                continue
+            raw = mp.raw if isinstance(mp.raw, dict) else {}
+            modes.append({
+                "name": name,
+                "label": raw.get("label"),
+                "description": mp.description,
+                "min_allowed_weight_kg": mp.min_allowed,
+                "max_allowed_weight_kg": mp.max_allowed,
+                "available": mp.config_error is None,
+                "config_error": mp.config_error,
+            })
+            if mp.config_error is None:
+                for cc, idx in mp.zones.items():
+                    per_country.setdefault(cc, []).append((bit, idx))
+                # Med hubbnät når modet även förbärarens zoner (förbärare → hubb → huvudben)
+                routes = network.modes.get(name)
+                if routes is not None and any(routes.feeder_ok):
+                    modes[-1]["feeder_mode"] = routes.feeder_name
+                    for cc, idx in routes.feeder.zones.items():
+                        per_country.setdefault(cc, []).append((bit, idx))
+
+        zones, countries = [], {}
+        for cc in sorted(per_country):
+            cmask = 0
+            for lo, hi, mask in country_zones(per_country[cc]):
+                p_from, p_to = _postal_bounds(lo, hi)
+                zones.append([cc, p_from, p_to, mask])
+                cmask |= mask
+            countries[cc] = cmask
+
+        masks = [z[3] for z in zones]
+        if len(zones) <= COVERAGE_MAX_MATRIX_ZONES:
+            matrix = [[o & d for d in masks] for o in masks]
+        else:
+            matrix = None
+
+        self.zone_count = len(zones)
+        doc = {
+            "version": self.version,
+            "modes": modes,
+            "countries": countries,
+            "zone_columns": ["country", "postal_from", "postal_to", "modes"],
+            "zones": zones,
+            "matrix": matrix,
+        }
+        self.body = json.dumps(doc, separators=(",", ":")).encode("utf-8")
+        self.etag = "cov-%s" % hashlib.sha1(self.body).hexdigest()[:20]
+        self.build_seconds = time.perf_counter() - t0
+
+
+# =========================================================
+# Aktiv karta (byggs om när en ny version kompileras)
+# =========================================================
+_coverage = None
+_lock = threading.Lock()
+
+
+def rebuild(plan):
+    """Bygger kartan för planen (synkront – det tar millisekunder)."""
+    global _coverage
+    if plan.config_id is None:
+        return None
+    with _lock:
+        if _coverage is not None and _coverage.config_id == plan.config_id:
+            return _coverage
+        try:
+            cov = CoverageMap(plan)
+        except Exception:
+            logger.exception("Coverage map build failed for v%s", plan.version)
+            return None
+        _coverage = cov
+    logger.info("Coverage map v%s built: %d zones, %d bytes in %.3fs",
+                cov.version, cov.zone_count, len(cov.body), cov.build_seconds)
+    return cov
+
+
+def coverage_for(plan):
+    """Kartan för just denna plan (byggs vid behov)."""
+    cov = _coverage
+    if cov is not None and cov.config_id == plan.config_id:
+        return cov
+    return rebuild(plan)
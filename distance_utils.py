@@ -0,0 +1,322 @@
+# distance_utils.py
+"""
+Avståndsberäkning för prissättningen.
+
+Standard är storcirkel (haversine) × DETOUR_FACTOR. Om ROAD_GRAPH_PATH pekar
+på en katalog byggd med `python distance_utils.py build ...` används i stället
+en lokal vägnätsgraf med contraction hierarchies (CH). Grafens arrayer öppnas
+med mmap, så alla gunicorn-workers delar samma sidor i page cache. Punkter som
+inte går att knyta till grafen (eller saknar väg) faller tillbaka på haversine.
+"""
+from math import radians, cos, sin, sqrt, atan2
+from functools import lru_cache
+import heapq
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+DETOUR_FACTOR = 1.2
+
+# Grafens snap-rutnät (grader) och max avstånd från punkt till närmaste nod
+GRID_DEG = 0.25
+MAX_SNAP_KM = float(os.getenv("ROAD_GRAPH_MAX_SNAP_KM", "60"))
+
+
+def haversine(coord1, coord2):
+    R = 6371
+    lat1, lon1 = map(radians, coord1)
+    lat2, lon2 = map(radians, coord2)
+    dlat = lat2 - lat1
+    dlon = lon2 - lon1
+    a = sin(dlat/2)**2 + cos(lat1)*cos(lat2)*sin(dlon/2)**2
+    c = 2 * atan2(sqrt(a), sqrt(1 - a))
+    return R * c
+
+
+# =========================================================
+# Providers
+# =========================================================
+class HaversineProvider:
+    """Storcirkel × omvägsfaktor – samma uppskattning som alltid använts."""
+    name = "haversine"
+    vectorizable = True
+
+    def distance(self, coord1, coord2) -> float:
+        return haversine(coord1, coord2) * DETOUR_FACTOR
+
+
+def _cell(lat: float, lon: float) -> int:
+    return int((lat + 90) // GRID_DEG) * 10000 + int((lon + 180) // GRID_DEG)
+
+
+class RoadGraphProvider:
+    """
+    Vägnät som CH: varje nod har en rank och bara "uppåt"-kanter (mot högre
+    rank) lagras, i CSR-form. Kortaste väg = dubbelriktad Dijkstra i den
+    uppåtriktade grafen från båda ändar.
+    """
+    name = "road_graph"
+    vectorizable = False
+
+    def __init__(self, path: str, cache_size: int = 65536):
+        import numpy as np
+
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.lat = load("node_lat")
+        self.lon = load("node_lon")
+        # memoryview på mmap: snabb indexering utan att kopiera in i varje worker
+        self.up_offsets = memoryview(load("up_offsets")).cast("B").cast("i")
+        self.up_targets = memoryview(load("up_targets")).cast("B").cast("i")
+        self.up_weights = memoryview(load("up_weights")).cast("B").cast("d")
+        self.cell_nodes = load("cell_nodes")
+        # Rutnätscell → (start, slut) i cell_nodes; litet nog att hålla som dict
+        keys, starts = load("cell_keys").tolist(), load("cell_starts").tolist()
+        self.cells = {k: (starts[i], starts[i + 1]) for i, k in enumerate(keys)}
+        self._np = np
+
+        self._node_distance = lru_cache(maxsize=cache_size)(self._ch_query)
+        self._snap = lru_cache(maxsize=cache_size)(self._snap_uncached)
+        logger.info("Road graph loaded from %s: %d nodes, %d up-edges",
+                    path, len(self.lat), len(self.up_targets))
+
+    # --- snap ---
+    def snap(self, coord):
+        """(nod, km från punkten till noden) eller None om ingen nod inom MAX_SNAP_KM."""
+        return self._snap(float(coord[0]), float(coord[1]))
+
+    def _snap_uncached(self, lat: float, lon: float):
+        np = self._np
+        base = _cell(lat, lon)
+        cands = []
+        for dy in (-10000, 0, 10000):
+            for dx in (-1, 0, 1):
+                span = self.cells.get(base + dy + dx)
+                if span:
+                    cands.append(self.cell_nodes[span[0]:span[1]])
+        if not cands:
+            return None
+        nodes = np.concatenate(cands)
+        la1, lo1 = radians(lat), radians(lon)
+        la2, lo2 = np.radians(self.lat[nodes]), np.radians(self.lon[nodes])
+        a = np.sin((la2 - la1) / 2) ** 2 + cos(la1) * np.cos(la2) * np.sin((lo2 - lo1) / 2) ** 2
+        d = 2 * 6371 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+        k = int(np.argmin(d))
+        if d[k] > MAX_SNAP_KM:
+            return None
+        return int(nodes[k]), float(d[k])
+
+    # --- CH-fråga ---
+    def _ch_query(self, s: int, t: int):
+        if s == t:
+            return 0.0
+        off, tgt, w = self.up_offsets, self.up_targets, self.up_weights
+        dist = ({s: 0.0}, {t: 0.0})
+        heaps = ([(0.0, s)], [(0.0, t)])
+        best = float("inf")
+        while heaps[0] or heaps[1]:
+            for side in (0, 1):
+                h = heaps[side]
+                if not h:
+                    continue
+                d, v = heapq.heappop(h)
+                if d > dist[side].get(v, float("inf")):
+                    continue
+                if d >= best:
+                    h.clear()
+                    continue
+                other = dist[1 - side].get(v)
+                if other is not None and d + other < best:
+                    best = d + other
+                ds = dist[side]
+                for e in range(off[v], off[v + 1]):
+                    u = tgt[e]
+                    nd = d + w[e]
+                    if nd < ds.get(u, float("inf")):
+                        ds[u] = nd
+                        heapq.heappush(h, (nd, u))
+        return None if best == float("inf") else best
+
+    def distance(self, coord1, coord2):
+        """Väg-km mellan två punkter, eller None → anroparen faller tillbaka."""
+        a = self.snap(coord1)
+        b = self.snap(coord2)
+        if a is None or b is None:
+            return None
+        graph_km = self._node_distance(a[0], b[0])
+        if graph_km is None:
+            return None
+        # Ansluta punkt ↔ nod uppskattas som haversine × omvägsfaktor
+        return graph_km + (a[1] + b[1]) * DETOUR_FACTOR
+
+
+def load_distance_provider():
+    path = os.getenv("ROAD_GRAPH_PATH")
+    if path:
+        try:
+            return RoadGraphProvider(path)
+        except Exception:
+            logger.exception("Could not load road graph from %s – using haversine", path)
+    return HaversineProvider()
+
+_haversine_provider = HaversineProvider()
+distance_provider = load_distance_provider()
+
+
+def road_distance_raw(coord1, coord2) -> float:
+    """Avstånd i km före avrundning: vägnät om det finns, annars haversine × 1.2."""
+    if distance_provider.vectorizable:
+        return _haversine_provider.distance(coord1, coord2)
+    try:
+        d = distance_provider.distance(coord1, coord2)
+    except (TypeError, ValueError, IndexError):
+        d = None
+    if d is None:
+        return _haversine_provider.distance(coord1, coord2)
+    return d
+
+def road_distance_km(coord1, coord2) -> int:
+    # Aldrig 0 → undvik log(0) i viktkurvan
+    return max(1, int(round(road_distance_raw(coord1, coord2))))
+
+
+# =========================================================
+# Bygga graf (offline)
+# =========================================================
+def _witness_ok(adj, contracted, u, w, v, limit, max_settled=60):
+    """True om det finns en väg u→w utan v som är <= limit (ingen genväg behövs)."""
+    dist = {u: 0.0}
+    h = [(0.0, u)]
+    settled = 0
+    while h and settled < max_settled:
+        d, x = heapq.heappop(h)
+        if d > dist.get(x, float("inf")):
+            continue
+        if x == w:
+            return d <= limit
+        if d > limit:
+            return False
+        settled += 1
+        for y, wy in adj[x].items():
+            if y == v or y in contracted:
+                continue
+            nd = d + wy
+            if nd < dist.get(y, float("inf")):
+                dist[y] = nd
+                heapq.heappush(h, (nd, y))
+    return dist.get(w, float("inf")) <= limit
+
+
+def _shortcuts(adj, contracted, v):
+    nbrs = [(u, d) for u, d in adj[v].items() if u not in contracted]
+    out = []
+    for i, (u, du) in enumerate(nbrs):
+        for w, dw in nbrs[i + 1:]:
+            limit = du + dw
+            if not _witness_ok(adj, contracted, u, w, v, limit):
+                out.append((u, w, limit))
+    return out
+
+
+def build_road_graph(nodes, edges, out_dir: str):
+    """
+    nodes: [(lat, lon), ...] (index = nod-id)
+    edges: [(a, b, km|None), ...] – oriktade; km=None → haversine × 1.2
+    Skriver meta.json + .npy-arrayer till out_dir.
+    """
+    import numpy as np
+
+    n = len(nodes)
+    adj = [dict() for _ in range(n)]
+    for a, b, km in edges:
+        if a == b:
+            continue
+        km = float(km) if km not in (None, "") else haversine(nodes[a], nodes[b]) * DETOUR_FACTOR
+        if km < adj[a].get(b, float("inf")):
+            adj[a][b] = adj[b][a] = km
+
+    # Nodordning: lat prioritetskö på edge difference (+ antal kontraherade grannar)
+    contracted = set()
+    deleted_nbrs = [0] * n
+    def priority(v):
+        return len(_shortcuts(adj, contracted, v)) - len(adj[v]) + deleted_nbrs[v]
+
+    pq = [(priority(v), v) for v in range(n)]
+    heapq.heapify(pq)
+    rank = [0] * n
+    order = 0
+    up = [dict() for _ in range(n)]
+    while pq:
+        _, v = heapq.heappop(pq)
+        if v in contracted:
+            continue
+        p = priority(v)
+        if pq and p > pq[0][0]:
+            heapq.heappush(pq, (p, v))
+            continue
+        for u, w, km in _shortcuts(adj, contracted, v):
+            if km < adj[u].get(w, float("inf")):
+                adj[u][w] = adj[w][u] = km
+        for u, km in adj[v].items():
+            if u not in contracted:
+                up[v][u] = km  # v kontraheras före u → u har högre rank
+                deleted_nbrs[u] += 1
+        contracted.add(v)
+        rank[v] = order
+        order += 1
+
+    offsets = np.zeros(n + 1, dtype=np.int32)
+    targets, weights = [], []
+    for v in range(n):
+        for u, km in sorted(up[v].items()):
+            targets.append(u); weights.append(km)
+        offsets[v + 1] = len(targets)
+
+    lat = np.array([c[0] for c in nodes], dtype=np.float64)
+    lon = np.array([c[1] for c in nodes], dtype=np.float64)
+    cells = np.array([_cell(a, b) for a, b in nodes], dtype=np.int64)
+    by_cell = np.argsort(cells, kind="stable").astype(np.int32)
+    cell_keys, cell_starts = np.unique(cells[by_cell], return_index=True)
+    cell_starts = np.append(cell_starts, n).astype(np.int64)
+
+    os.makedirs(out_dir, exist_ok=True)
+    arrays = {
+        "node_lat": lat, "node_lon": lon,
+        "up_offsets": offsets, "up_targets": np.array(targets, dtype=np.int32),
+        "up_weights": np.array(weights, dtype=np.float64),
+        "cell_keys": cell_keys.astype(np.int64), "cell_starts": cell_starts, "cell_nodes": by_cell,
+    }
+    for name, arr in arrays.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), np.ascontiguousarray(arr))
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"nodes": n, "edges": len(edges), "up_edges": len(targets),
+                   "grid_deg": GRID_DEG, "detour_factor": DETOUR_FACTOR}, f, indent=2)
+    return arrays
+
+
+if __name__ == "__main__":
+    # python distance_utils.py build nodes.csv edges.csv ut_katalog
+    #   nodes.csv: id,lat,lon      (id = 0..N-1)
+    #   edges.csv: from,to[,km]    (färjor läggs in som vanliga kanter med km)
+    import argparse
+    import csv
+
+    ap = argparse.ArgumentParser(description="Build a contraction-hierarchy road graph for pricing")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("nodes_csv"); b.add_argument("edges_csv"); b.add_argument("out_dir")
+    args = ap.parse_args()
+
+    with open(args.nodes_csv, newline="", encoding="utf-8") as f:
+        rows = sorted(csv.DictReader(f), key=lambda r: int(r["id"]))
+    nodes = [(float(r["lat"]), float(r["lon"])) for r in rows]
+    with open(args.edges_csv, newline="", encoding="utf-8") as f:
+        edges = [(int(r["from"]), int(r["to"]), r.get("km")) for r in csv.DictReader(f)]
+    build_road_graph(nodes, edges, args.out_dir)
+    print(f"Wrote road graph with {len(nodes)} nodes to {args.out_dir}")
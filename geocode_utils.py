@@ -0,0 +1,175 @@
+# geocode_utils.py
+"""
+Lokalt postnummer → koordinat-index, så /calculate klarar sig utan
+pickup_coordinate/delivery_coordinate.
+
+Indexet byggs offline (`python geocode_utils.py build ...`) från en
+GeoNames-postnummerdump (tab-separerad) eller en CSV med
+country,postal,lat,lon. För varje postnummer lagras tyngdpunkten dels för
+hela numret, dels för varje prefix ("21145" → "2", "21", "211", "2114",
+"21145"), så en fråga är en exakt sökning. Saknas numret prövas allt kortare
+prefix – aldrig bara landet.
+
+Nycklarna ("SE21145") ligger sorterade i en .npy-array med fast bredd och
+söks binärt; arrayerna öppnas med mmap, så alla gunicorn-workers delar samma
+sidor i page cache (som vägnätet i distance_utils). Uppslag cachas i en LRU.
+
+POSTAL_INDEX_PATH pekar på katalogen (standard data/postal_index). Finns den
+inte används indexet inte och koordinaterna krävs som tidigare.
+"""
+from functools import lru_cache
+import json
+import logging
+import os
+import re
+
+logger = logging.getLogger(__name__)
+
+POSTAL_INDEX_PATH = os.getenv("POSTAL_INDEX_PATH") or os.path.join(
+    os.path.dirname(os.path.abspath(__file__)), "data", "postal_index")
+# Längsta nyckel (land + postnummer); längre postnummer kortas av
+MAX_KEY_LEN = 12
+
+_country_pat = re.compile(r"^[A-Z]{2}$")
+
+
+def postal_key(country, postal) -> str | None:
+    """("se", "211 45") → "SE21145"; None om land eller postnummer inte går att tolka."""
+    cc = str(country or "").strip().upper()
+    pc = re.sub(r"[^0-9A-Z]", "", str(postal or "").upper())
+    if not _country_pat.match(cc) or not pc:
+        return None
+    return (cc + pc)[:MAX_KEY_LEN]
+
+
+class PostalIndex:
+    def __init__(self, path: str, cache_size: int = 65536):
+        import numpy as np
+
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            self.meta = json.load(f)
+
+        def load(name):
+            return np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+
+        self.keys = load("keys")
+        self.lat = load("lat")
+        self.lon = load("lon")
+        self._np = np
+        self._lookup = lru_cache(maxsize=cache_size)(self._lookup_uncached)
+        logger.info("Postal index loaded from %s: %d keys, %d countries",
+                    path, len(self.keys), len(self.meta.get("countries", [])))
+
+    def _find(self, key: bytes) -> int:
+        i = int(self._np.searchsorted(self.keys, key))
+        return i if i < len(self.keys) and self.keys[i] == key else -1
+
+    def _lookup_uncached(self, key: str):
+        # Hela numret först, sedan allt kortare prefix (minst ett tecken efter landet)
+        for n in range(len(key), 2, -1):
+            i = self._find(key[:n].encode("ascii"))
+            if i >= 0:
+                return float(self.lat[i]), float(self.lon[i]), key[2:n]
+        return None
+
+    def lookup(self, country, postal):
+        """(lat, lon, matchat postnummer/prefix) eller None."""
+        key = postal_key(country, postal)
+        return self._lookup(key) if key else None
+
+    def coordinate(self, country, postal) -> list | None:
+        hit = self.lookup(country, postal)
+        return [hit[0], hit[1]] if hit else None
+
+    def stats(self) -> dict:
+        info = self._lookup.cache_info()
+        return {"keys": len(self.keys), "countries": self.meta.get("countries", []),
+                "source": self.meta.get("source"), "cache_hits": info.hits,
+                "cache_misses": info.misses, "cache_size": info.currsize}
+
+
+def load_postal_index(path: str = POSTAL_INDEX_PATH):
+    if not path or not os.path.exists(os.path.join(path, "meta.json")):
+        return None
+    try:
+        return PostalIndex(path)
+    except Exception:
+        logger.exception("Could not load postal index from %s – coordinates required", path)
+        return None
+
+postal_index = load_postal_index()
+
+
+# =========================================================
+# Bygga index (offline)
+# =========================================================
+def build_postal_index(rows, out_dir: str, source: str | None = None) -> dict:
+    """
+    rows: [(country, postal, lat, lon), ...] – samma postnummer får förekomma
+    flera gånger (flera orter), tyngdpunkten blir medelvärdet.
+    Skriver meta.json + keys/lat/lon.npy till out_dir.
+    """
+    import numpy as np
+
+    # Först en punkt per fullständigt postnummer, sedan varje prefix som
+    # medelvärde av numren under det (inte av orterna – tätorter väger inte tyngre)
+    full: dict = {}
+    for country, postal, lat, lon in rows:
+        key = postal_key(country, postal)
+        if key is None:
+            continue
+        s = full.setdefault(key, [0.0, 0.0, 0])
+        s[0] += float(lat); s[1] += float(lon); s[2] += 1
+    sums: dict = {}
+    for key, (la, lo, n) in full.items():
+        la, lo = la / n, lo / n
+        for k in range(3, len(key) + 1):
+            s = sums.setdefault(key[:k], [0.0, 0.0, 0])
+            s[0] += la; s[1] += lo; s[2] += 1
+
+    keys = sorted(sums)
+    width = max((len(k) for k in keys), default=1)
+    arrays = {
+        "keys": np.array([k.encode("ascii") for k in keys], dtype=f"S{width}"),
+        "lat": np.array([sums[k][0] / sums[k][2] for k in keys], dtype=np.float64),
+        "lon": np.array([sums[k][1] / sums[k][2] for k in keys], dtype=np.float64),
+    }
+    os.makedirs(out_dir, exist_ok=True)
+    for name, arr in arrays.items():
+        np.save(os.path.join(out_dir, f"{name}.npy"), np.ascontiguousarray(arr))
+    countries = sorted({k[:2] for k in full})
+    with open(os.path.join(out_dir, "meta.json"), "w", encoding="utf-8") as f:
+        json.dump({"keys": len(keys), "postal_codes": len(full), "countries": countries,
+                   "source": source}, f, indent=2)
+    return arrays
+
+
+if __name__ == "__main__":
+    # python geocode_utils.py build allCountries.txt ut_katalog [--countries SE,DE,...]
+    #   GeoNames-dump (tab): land, postnummer, ort, ..., lat (kol 10), lon (kol 11)
+    #   eller CSV med rubrikrad: country,postal,lat,lon
+    import argparse
+    import csv
+
+    ap = argparse.ArgumentParser(description="Build the offline postal code → coordinate index")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    b = sub.add_parser("build")
+    b.add_argument("source"); b.add_argument("out_dir")
+    b.add_argument("--countries", help="comma-separated ISO codes to include (default: all)")
+    args = ap.parse_args()
+
+    only = {c.strip().upper() for c in args.countries.split(",")} if args.countries else None
+
+    def read_rows(path):
+        with open(path, newline="", encoding="utf-8") as f:
+            if path.lower().endswith(".csv"):
+                for r in csv.DictReader(f):
+                    yield r["country"], r["postal"], r["lat"], r["lon"]
+            else:
+                for r in csv.reader(f, delimiter="\t", quoting=csv.QUOTE_NONE):
+                    if len(r) >= 11 and r[9] and r[10]:
+                        yield r[0], r[1], r[9], r[10]
+
+    rows = (r for r in read_rows(args.source) if only is None or r[0].upper() in only)
+    arrays = build_postal_index(rows, args.out_dir, source=os.path.basename(args.source))
+    print(f"Wrote postal index with {len(arrays['keys'])} keys to {args.out_dir}")
@@ -0,0 +1,139 @@
+# grid_utils.py
+"""
+Förberäknat prisrutnät per publicerad config-version.
+
+För varje par av zoner (land + 2-siffrigt postnummerprefix) som har en
+centroid i RATE_GRID_CENTROIDS lagras avstånd, FTL-pris, transit och
+viktkurvans segmentkoefficienter (LaneTerms) per mode. En offert vars båda
+koordinater ligger inom RATE_GRID_TOLERANCE_KM från zonens centroid prissätts
+direkt från rutnätet – bara viktsegmentet återstår att räkna. Allt annat går
+den vanliga vägen via calculate_for_mode.
+
+Centroidfilen är JSON: {"SE": {"21": [55.60, 13.00], ...}, "DE": {...}}.
+"""
+import json
+import logging
+import os
+import threading
+import time
+
+from distance_utils import haversine, road_distance_km
+from pricing_utils import ModePlan, lane_terms, quote_from_terms, weight_allowed, ZONE_SLOTS
+
+logger = logging.getLogger(__name__)
+
+RATE_GRID_CENTROIDS = os.getenv("RATE_GRID_CENTROIDS")
+RATE_GRID_TOLERANCE_KM = float(os.getenv("RATE_GRID_TOLERANCE_KM", "1.0"))
+
+NOT_AVAILABLE = "Not available for this request"
+
+
+def load_centroids(path: str) -> dict:
+    """{(land, prefix-int): (lat, lon)}"""
+    with open(path, "r", encoding="utf-8") as f:
+        raw = json.load(f)
+    out = {}
+    for cc, prefixes in raw.items():
+        for prefix, coord in prefixes.items():
+            p = int(prefix)
+            if 0 <= p < ZONE_SLOTS:
+                out[(cc, p)] = (float(coord[0]), float(coord[1]))
+    return out
+
+
+class RateGrid:
+    def __init__(self, plan, centroids: dict, tolerance_km: float = RATE_GRID_TOLERANCE_KM):
+        t0 = time.perf_counter()
+        self.version = plan.version
+        self.config_id = plan.config_id
+        self.centroids = centroids
+        self.tolerance_km = tolerance_km
+        # Okompilerade mode kan inte serveras från rutnätet
+        self.complete = all(isinstance(mp, ModePlan) for _, mp in plan.items())
+
+        # (pc, pp, dc, dp) → {mode: LaneTerms}; mode som saknas täcker inte sträckan
+        self.lanes: dict = {}
+        zones = list(centroids.items())
+        for (pc, pp), pcoord in zones:
+            for (dc, dp), dcoord in zones:
+                serving = plan.serving_modes(pc, pp, dc, dp) or set()
+                if not serving:
+                    continue
+                distance_km = road_distance_km(pcoord, dcoord)
+                self.lanes[(pc, pp, dc, dp)] = {
+                    mode: lane_terms(plan.modes[mode], distance_km, pc, dc)
+                    for mode in serving if isinstance(plan.modes[mode], ModePlan)
+                }
+        self.build_seconds = time.perf_counter() - t0
+
+    def _near_centroid(self, country, prefix, coord) -> bool:
+        c = self.centroids.get((country, prefix))
+        return c is not None and haversine(coord, c) <= self.tolerance_km
+
+    def quote(self, plan, pickup_coord, delivery_coord, pickup_country, pickup_postal,
+              delivery_country, delivery_postal, weight):
+        """{mode: resultat} som /calculate, eller None om rutnätet inte kan svara."""
+        if not self.complete:
+            return None
+        try:
+            pp, dp = int(pickup_postal), int(delivery_postal)
+            lane = self.lanes.get((pickup_country, pp, delivery_country, dp))
+            if lane is None:
+                return None
+            if not (self._near_centroid(pickup_country, pp, pickup_coord) and
+                    self._near_centroid(delivery_country, dp, delivery_coord)):
+                return None
+        except (TypeError, ValueError):
+            return None
+
+        results = {}
+        for mode, mp in plan.items():
+            t = lane.get(mode)
+            if t is None:
+                results[mode] = {"available": False, "status": NOT_AVAILABLE}
+                continue
+            results[mode] = weight_allowed(mp, weight) or quote_from_terms(mp, t, weight, pickup_country, delivery_country)
+        return results
+
+
+# =========================================================
+# Aktivt rutnät + bakgrundsbygge
+# =========================================================
+_grid = None
+_building: set = set()
+_lock = threading.Lock()
+_centroids = None
+
+
+def active_grid(plan):
+    """Rutnätet om det hör till just denna plan, annars None."""
+    g = _grid
+    if g is not None and g.config_id == plan.config_id:
+        return g
+    return None
+
+
+def schedule_rebuild(plan):
+    """Bygg rutnätet för planen i en bakgrundstråd (no-op om avstängt eller redan på gång)."""
+    if not RATE_GRID_CENTROIDS or plan.config_id is None:
+        return
+    with _lock:
+        if plan.config_id in _building or (_grid is not None and _grid.config_id == plan.config_id):
+            return
+        _building.add(plan.config_id)
+
+    def _run():
+        global _grid, _centroids
+        try:
+            if _centroids is None:
+                _centroids = load_centroids(RATE_GRID_CENTROIDS)
+            g = RateGrid(plan, _centroids)
+            _grid = g
+            logger.info("Rate grid v%s built: %d lanes in %.2fs", g.version, len(g.lanes), g.build_seconds)
+        except Exception:
+            logger.exception("Rate grid build failed for v%s", plan.version)
+        finally:
+            with _lock:
+                _building.discard(plan.config_id)
+
+    threading.Thread(target=_run, name=f"rate-grid-v{plan.version}", daemon=True).start()
@@ -179,7 +179,7 @@ from sqlalchemy.sql import func
 # ...
 
 # models.py (lägg till)
-from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, UniqueConstraint, Text, Index
 from sqlalchemy.orm import relationship
 
 class OrgAddress(Base):
@@ -225,3 +225,52 @@ class PricingConfig(Base):
     comment = Column(Text, nullable=True)
     effective_at = Column(DateTime(timezone=True), nullable=True)
 
+
+
+class PriceAgreement(Base):
+    """Kundavtal: overlay på publicerad PricingConfig för en organisation (se agreement_utils)."""
+    __tablename__ = "price_agreements"
+
+    id = Column(String, primary_key=True, default=generate_uuid)
+    org_id = Column(Integer, ForeignKey("organizations.id", ondelete="CASCADE"),
+                    nullable=False, unique=True, index=True)
+    data = Column(JSON, nullable=False)
+    # Räknas upp vid varje ändring – ingår i den kompilerade planens cache-nyckel
+    revision = Column(Integer, nullable=False, default=1)
+
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now())
+    updated_by = Column(Integer, ForeignKey("users.id"), nullable=True)
+    comment = Column(Text, nullable=True)
+
+
+class Quote(Base):
+    """
+    En rad per (offertförfrågan, mode) från /calculate – för konverteringsanalys.
+    Skrivs i batch av quote_store_utils; booking_id sätts när offerten bokas via quote_id.
+    """
+    __tablename__ = "quotes"
+
+    id = Column(Integer, primary_key=True, autoincrement=True)
+    created_at = Column(DateTime(timezone=True), nullable=False, index=True)
+    debug_id = Column(String(16), nullable=False)
+    org_id = Column(Integer, nullable=True, index=True)
+    config_version = Column(Integer, nullable=True)
+    source = Column(String(16), nullable=True)
+
+    pickup_country = Column(String(2), nullable=True)
+    pickup_postal = Column(String(16), nullable=True)
+    delivery_country = Column(String(2), nullable=True)
+    delivery_postal = Column(String(16), nullable=True)
+    weight = Column(Float, nullable=True)
+
+    mode = Column(String(32), nullable=False)
+    available = Column(Boolean, nullable=False)
+    status = Column(String(128), nullable=True)
+    price_eur = Column(Float, nullable=True)
+    distance_km = Column(Integer, nullable=True)
+
+    booking_id = Column(String, nullable=True, index=True)
+
+    __table_args__ = (
+        Index("ix_quotes_debug_mode", "debug_id", "mode"),
+    )
@@ -0,0 +1,252 @@
+# pricelist_utils.py
+"""
+Prislistor (CSV/PDF) för en publicerad config-version.
+
+Varje post i ett modes available_zones ("SE": ["20-89", "90"]) är en zon.
+För varje ordnat zonpar räknas avstånd och LaneTerms en gång och viktkurvan
+vektoriserat över alla viktband (batch_utils.weight_curve) – samma priser som
+/calculate ger för zonernas tyngdpunkter.
+
+Zonens tyngdpunkt = medelvärdet av 2-siffriga prefixens centroider, ur
+RATE_GRID_CENTROIDS (samma fil som prisrutnätet) eller postnummerindexet
+(geocode_utils). Zoner utan någon centroid hoppas över och listas i svaret.
+
+Färdiga filer sparas i PRICE_LIST_DIR per (config, viktband, modes, format),
+så en ny nedladdning av samma version bara läser filen. Skrivningen är
+atomisk, så alla gunicorn-workers kan dela katalogen.
+"""
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+
+from reportlab.lib import colors
+from reportlab.lib.pagesizes import A4, landscape
+from reportlab.lib.styles import getSampleStyleSheet
+from reportlab.lib.units import mm
+from reportlab.platypus import LongTable, PageBreak, Paragraph, SimpleDocTemplate, Spacer, TableStyle
+
+from batch_utils import weight_curve
+from geocode_utils import postal_index
+from grid_utils import RATE_GRID_CENTROIDS, load_centroids
+from pricing_utils import ModePlan, parse_zone_entry
+
+logger = logging.getLogger(__name__)
+
+PRICE_LIST_DIR = os.getenv("PRICE_LIST_DIR") or os.path.join(tempfile.gettempdir(), "efb-price-lists")
+PRICE_LIST_WEIGHTS = [float(w) for w in
+                      os.getenv("PRICE_LIST_WEIGHTS", "100,300,500,1000,2000,3000,5000,10000,15000,20000,25000").split(",")]
+PRICE_LIST_MAX_BANDS = 30
+FORMATS = ("csv", "pdf")
+
+_SLOT = 1000  # ett 2-siffrigt prefix i 5-siffrigt rum
+_centroids = None
+_build_locks: dict = {}
+_build_locks_lock = threading.Lock()
+
+
+class Zone:
+    __slots__ = ("country", "label", "postal", "coord")
+
+    def __init__(self, country: str, label: str, postal: str, coord):
+        self.country = country
+        self.label = label
+        self.postal = postal      # representativt prefix för zonkontrollen
+        self.coord = coord
+
+
+def _grid_centroids() -> dict:
+    global _centroids
+    if _centroids is None:
+        _centroids = load_centroids(RATE_GRID_CENTROIDS) if RATE_GRID_CENTROIDS else {}
+    return _centroids
+
+
+def zone_centroid(country: str, start: str, lo: int, hi: int):
+    """(lat, lon) för zonen eller None."""
+    # Smalare än ett 2-siffrigt prefix: slå upp zonens eget prefix direkt
+    if len(start) > 2 and postal_index is not None:
+        c = postal_index.coordinate(country, start)
+        if c is not None:
+            return tuple(c)
+    grid = _grid_centroids()
+    pts = []
+    for p in range(lo // _SLOT, hi // _SLOT + 1):
+        c = grid.get((country, p))
+        if c is None and postal_index is not None:
+            c = postal_index.coordinate(country, f"{p:02d}")
+        if c is not None:
+            pts.append(c)
+    if not pts:
+        return None
+    return (sum(c[0] for c in pts) / len(pts), sum(c[1] for c in pts) / len(pts))
+
+
+def mode_zones(mp: ModePlan) -> tuple:
+    """(zoner, zoner utan centroid) för ett mode, i configens ordning."""
+    zones, missing = [], []
+    for cc, entries in (mp.raw.get("available_zones") or {}).items():
+        for entry in entries:
+            s = str(entry).strip()
+            try:
+                lo, hi, exclude = parse_zone_entry(s)
+            except ValueError:
+                continue
+            if exclude:
+                continue
+            start = s.partition("-")[0].strip()
+            if not mp.zone_allowed(cc, start):
+                continue
+            label = f"{cc} {s}"
+            coord = zone_centroid(cc, start, lo, hi)
+            if coord is None:
+                missing.append(label)
+            else:
+                zones.append(Zone(cc, label, start, coord))
+    return zones, missing
+
+
+def price_matrix(plan, weights: list, modes: list | None = None) -> dict:
+    """
+    {"modes": {mode: {"label", "zones", "missing_zones", "lanes": [...]}}}
+    där varje lane har från/till-zon, distance_km, transit och prices[k] för weights[k].
+    """
+    t0 = time.perf_counter()
+    out = {}
+    for name, mp in plan.items():
+        if modes and name not in modes:
+            continue
+        if not isinstance(mp, ModePlan) or mp.config_error:
+            out[name] = {"label": name, "error": getattr(mp, "config_error", None) or "not compiled", "lanes": []}
+            continue
+        zones, missing = mode_zones(mp)
+        lanes = []
+        for a in zones:
+            for b in zones:
+                if a is b:
+                    continue
+                r = weight_curve(mp, weights, a.coord, b.coord, a.country, a.postal, b.country, b.postal)
+                if not r.get("available"):
+                    continue
+                lanes.append({
+                    "from_country": a.country, "from_zone": a.label,
+                    "to_country": b.country, "to_zone": b.label,
+                    "distance_km": r["distance_km"], "transit_time_days": r["transit_time_days"],
+                    "prices": r["prices"],
+                })
+        out[name] = {"label": mp.raw.get("label") or name, "zones": len(zones),
+                     "missing_zones": missing, "lanes": lanes}
+    return {"version": plan.version, "weights": weights, "modes": out,
+            "seconds": round(time.perf_counter() - t0, 3)}
+
+
+# =========================================================
+# Rendering
+# =========================================================
+def _weight_label(w: float) -> str:
+    return f"{int(w)}" if float(w).is_integer() else f"{w:g}"
+
+
+def render_csv(matrix: dict) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["mode", "from_country", "from_zone", "to_country", "to_zone", "distance_km",
+                "transit_days_min", "transit_days_max"]
+               + [f"price_eur_{_weight_label(x)}kg" for x in matrix["weights"]])
+    for name, m in matrix["modes"].items():
+        for l in m["lanes"]:
+            w.writerow([name, l["from_country"], l["from_zone"], l["to_country"], l["to_zone"],
+                        l["distance_km"], *l["transit_time_days"]]
+                       + ["" if p is None else p for p in l["prices"]])
+    return buf.getvalue().encode("utf-8")
+
+
+def render_pdf(matrix: dict) -> bytes:
+    buf = io.BytesIO()
+    doc = SimpleDocTemplate(buf, pagesize=landscape(A4), topMargin=12*mm, bottomMargin=12*mm,
+                            leftMargin=12*mm, rightMargin=12*mm,
+                            title=f"Price list v{matrix['version']}")
+    styles = getSampleStyleSheet()
+    weights = matrix["weights"]
+    header = ["To", "km", "Days"] + [f"{_weight_label(x)} kg" for x in weights]
+    style = TableStyle([
+        ("FONTSIZE", (0, 0), (-1, -1), 7),
+        ("FONTNAME", (0, 0), (-1, 0), "Helvetica-Bold"),
+        ("BACKGROUND", (0, 0), (-1, 0), colors.HexColor("#e8edf3")),
+        ("ALIGN", (1, 0), (-1, -1), "RIGHT"),
+        ("GRID", (0, 0), (-1, -1), 0.25, colors.HexColor("#b8c2cc")),
+        ("ROWBACKGROUNDS", (0, 1), (-1, -1), [colors.white, colors.HexColor("#f7f9fb")]),
+        ("TOPPADDING", (0, 0), (-1, -1), 1.5), ("BOTTOMPADDING", (0, 0), (-1, -1), 1.5),
+    ])
+
+    elems = []
+    for name, m in matrix["modes"].items():
+        if not m["lanes"]:
+            continue
+        if elems:
+            elems.append(PageBreak())
+        elems.append(Paragraph(f"<b>{m['label']}</b> – price list, config v{matrix['version']} (EUR)",
+                               styles["Title"]))
+        by_origin: dict = {}
+        for l in m["lanes"]:
+            by_origin.setdefault(l["from_zone"], []).append(l)
+        for origin, lanes in by_origin.items():
+            elems.append(Paragraph(f"From {origin}", styles["Heading3"]))
+            rows = [header] + [
+                [l["to_zone"], l["distance_km"], "–".join(str(d) for d in l["transit_time_days"])]
+                + ["–" if p is None else f"{p:,}".replace(",", " ") for p in l["prices"]]
+                for l in lanes
+            ]
+            elems.append(LongTable(rows, repeatRows=1, style=style, hAlign="LEFT"))
+            elems.append(Spacer(1, 4*mm))
+    if not elems:
+        elems.append(Paragraph("No priced lanes in this configuration.", styles["Normal"]))
+    doc.build(elems)
+    return buf.getvalue()
+
+
+# =========================================================
+# Cache på disk
+# =========================================================
+def cache_path(plan, weights: list, modes: list | None, fmt: str) -> str:
+    spec = json.dumps({"w": weights, "m": sorted(modes) if modes else None}, separators=(",", ":"))
+    h = hashlib.sha1(f"{plan.config_id}|{spec}".encode("utf-8")).hexdigest()[:16]
+    return os.path.join(PRICE_LIST_DIR, f"price-list-v{plan.version}-{h}.{fmt}")
+
+
+def price_list(plan, fmt: str = "csv", weights: list | None = None, modes: list | None = None) -> tuple:
+    """(filinnehåll, cachad) – bygger och sparar filen om den saknas."""
+    if fmt not in FORMATS:
+        raise ValueError(f"format must be one of {', '.join(FORMATS)}")
+    weights = list(weights or PRICE_LIST_WEIGHTS)
+    path = cache_path(plan, weights, modes, fmt)
+    if os.path.exists(path):
+        with open(path, "rb") as f:
+            return f.read(), True
+
+    with _build_locks_lock:
+        lock = _build_locks.setdefault(path, threading.Lock())
+    with lock:
+        # En annan tråd kan ha byggt klart medan vi väntade
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                return f.read(), True
+        t0 = time.perf_counter()
+        matrix = price_matrix(plan, weights, modes)
+        data = render_csv(matrix) if fmt == "csv" else render_pdf(matrix)
+        os.makedirs(PRICE_LIST_DIR, exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+        os.replace(tmp, path)
+        logger.info("Price list v%s (%s) built: %d lanes in %.2fs (matrix %.2fs)",
+                    plan.version, fmt, sum(len(m["lanes"]) for m in matrix["modes"].values()),
+                    time.perf_counter() - t0, matrix["seconds"])
+    with _build_locks_lock:
+        _build_locks.pop(path, None)
+    return data, False
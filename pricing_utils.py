@@ -0,0 +1,518 @@
+# pricing_utils.py
+from bisect import bisect_right
+from datetime import date
+from functools import lru_cache
+from math import log
+import logging
+
+from calendar_utils import business_calendar
+from distance_utils import haversine, road_distance_km
+
+logger = logging.getLogger(__name__)
+
+
+# =========================================================
+# Geometri + zoner
+# =========================================================
+def is_zone_allowed(country, postal_prefix, available_zones):
+    if country not in available_zones:
+        return False
+    return zone_index(available_zones[country]).covers(postal_prefix)
+
+# Zoner anges med 2–5 siffror ("20-89", "123", "12300-12499") och kan
+# undantas med "!" ("!123"). Internt räknas allt om till 5-siffriga
+# intervall: "20-89" → [20000, 89999], "123" → [12300, 12399].
+POSTAL_DIGITS = 5
+MIN_ZONE_DIGITS = 2
+
+# Snabbspår för 2-siffriga prefix → 100 platser per land
+ZONE_SLOTS = 100
+_SLOT_WIDTH = 10 ** (POSTAL_DIGITS - 2)
+
+def normalize_postal(postal) -> str | None:
+    """"211 45" → "21145"; None om det inte bara är siffror."""
+    s = str(postal).strip().replace(" ", "") if postal is not None else ""
+    if not (s.isascii() and s.isdigit()):
+        return None
+    return s
+
+def postal_interval(postal) -> tuple | None:
+    """
+    Postnummer/prefix → (lo, hi) över alla 5-siffriga postnummer det täcker.
+    Kortare än 2 siffror tolkas som tal ("5" = "05", som int() gjorde förut),
+    längre än 5 kortas av.
+    """
+    s = normalize_postal(postal)
+    if s is None:
+        return None
+    if len(s) < MIN_ZONE_DIGITS:
+        s = s.zfill(MIN_ZONE_DIGITS)
+    s = s[:POSTAL_DIGITS]
+    scale = 10 ** (POSTAL_DIGITS - len(s))
+    lo = int(s) * scale
+    return lo, lo + scale - 1
+
+def parse_zone_entry(zone) -> tuple:
+    """
+    "20-89" / "90" / "123-125" / "!12345" → (lo, hi, exclude) i 5-siffrigt rum.
+    Båda ändarna i ett intervall måste ha lika många siffror (2–5).
+    Kastar ValueError på trasiga intervall.
+    """
+    s = str(zone).strip()
+    exclude = s.startswith("!")
+    if exclude:
+        s = s[1:].strip()
+    start, sep, end = s.partition("-")
+    if not sep:
+        end = start
+    start, end = start.strip(), end.strip()
+    for part in (start, end):
+        if not (part.isascii() and part.isdigit() and MIN_ZONE_DIGITS <= len(part) <= POSTAL_DIGITS):
+            raise ValueError(f"bad postal range '{zone}' (use 2–5 digits)")
+    if len(start) != len(end):
+        raise ValueError(f"bad postal range '{zone}' (both ends need the same number of digits)")
+    if int(start) > int(end):
+        raise ValueError(f"bad postal range '{zone}' (start > end)")
+    scale = 10 ** (POSTAL_DIGITS - len(start))
+    return int(start) * scale, (int(end) + 1) * scale - 1, exclude
+
+def _merge(intervals) -> list:
+    """Sorterar och slår ihop överlappande/angränsande intervall."""
+    out = []
+    for lo, hi in sorted(intervals):
+        if out and lo <= out[-1][1] + 1:
+            if hi > out[-1][1]:
+                out[-1] = (out[-1][0], hi)
+        else:
+            out.append((lo, hi))
+    return out
+
+def _subtract(intervals: list, cuts: list) -> list:
+    """intervals minus cuts (båda sorterade och disjunkta), i ett svep."""
+    out = []
+    j = 0
+    for lo, hi in intervals:
+        while j < len(cuts) and cuts[j][1] < lo:
+            j += 1
+        k = j
+        while lo <= hi and k < len(cuts) and cuts[k][0] <= hi:
+            if cuts[k][0] > lo:
+                out.append((lo, cuts[k][0] - 1))
+            lo = max(lo, cuts[k][1] + 1)
+            k += 1
+        if lo <= hi:
+            out.append((lo, hi))
+    return out
+
+class ZoneIndex:
+    """
+    Ett lands zoner som sorterade, disjunkta intervall (starts/ends) i
+    5-siffrigt rum – inkluderingar minus undantag, sammanslagna. Ett
+    postnummer/prefix är tillåtet om hela dess intervall ryms i ett av dem,
+    vilket avgörs med bisect (O(log n) även med tusentals intervall).
+    """
+    __slots__ = ("starts", "ends", "slot_bits")
+
+    def __init__(self, zones):
+        include, exclude = [], []
+        for zone in zones:
+            lo, hi, ex = parse_zone_entry(zone)
+            (exclude if ex else include).append((lo, hi))
+
+        merged = _subtract(_merge(include), _merge(exclude))
+
+        self.starts = [a for a, _ in merged]
+        self.ends = [b for _, b in merged]
+
+        # Bit p satt om hela 2-siffriga prefixet p täcks
+        bits = 0
+        for lo, hi in merged:
+            first, last = -(-lo // _SLOT_WIDTH), (hi + 1) // _SLOT_WIDTH
+            if last > first:
+                bits |= ((1 << (last - first)) - 1) << first
+        self.slot_bits = bits
+
+    def covers_interval(self, lo: int, hi: int) -> bool:
+        i = bisect_right(self.starts, lo) - 1
+        return i >= 0 and hi <= self.ends[i]
+
+    def covers(self, postal) -> bool:
+        slot = _SLOT_OF.get(postal) if type(postal) is str else None
+        if slot is not None:
+            return (self.slot_bits >> slot) & 1 == 1
+        iv = postal_interval(postal)
+        return iv is not None and self.covers_interval(*iv)
+
+    def intervals(self) -> list:
+        return list(zip(self.starts, self.ends))
+
+    def __len__(self):
+        return len(self.starts)
+
+
+@lru_cache(maxsize=1024)
+def _zone_index_cached(zones: tuple) -> ZoneIndex:
+    return ZoneIndex(zones)
+
+def zone_index(zones) -> ZoneIndex:
+    """ZoneIndex för en zonlista; samma lista byggs bara en gång (indexet ändras aldrig)."""
+    try:
+        return _zone_index_cached(tuple(zones))
+    except TypeError:
+        return ZoneIndex(zones)
+
+# "00"–"99" → plats i bitmappen (snabbare än int() + kontroller per anrop)
+_SLOT_OF = {f"{p:02d}": p for p in range(ZONE_SLOTS)}
+
+
+# =========================================================
+# Kompilerad prisplan (en per publicerad config-version)
+# =========================================================
+class ModePlan:
+    """
+    Ett mode ur PricingConfig.data, färdigparsat: alla tal är float/int,
+    zoner är intervall-tupler och balance_factors en tät landsmatris.
+    Objektet ändras aldrig efter __init__ och kan delas mellan trådar.
+    """
+    __slots__ = (
+        "name", "raw", "zones", "zone_bits", "country_index", "balance",
+        "min_allowed", "max_allowed", "km_price", "config_error",
+        "p1", "p2", "p3", "bp", "maxw", "p2k", "p2m", "p3k", "p3m",
+        "y1", "log_y1", "log_p12", "log_p23", "log_p3bp",
+        "speed", "cutoff_hour", "extra_pickup_days", "transit_calendar_days", "co2_per_ton_km", "description",
+    )
+
+    def __init__(self, mode_config: dict, name: str | None = None, country_index: dict | None = None):
+        self.name = name
+        self.raw = mode_config
+
+        # Zoner → {"SE": ZoneIndex, ...} + bitmapp över 2-siffriga prefix för snabbspåret
+        self.zones = {cc: zone_index(r) for cc, r in mode_config["available_zones"].items()}
+        self.zone_bits = {cc: idx.slot_bits for cc, idx in self.zones.items()}
+
+        # Viktgränser (råa värden – används även i felmeddelandet)
+        self.min_allowed = mode_config.get("min_allowed_weight_kg", 0)
+        self.max_allowed = mode_config.get("max_allowed_weight_kg", 999999)
+
+        # Balansfaktorer → tät matris över country_index (saknad nyckel = 1.0)
+        bf = mode_config.get("balance_factors", {}) or {}
+        if country_index is None:
+            country_index = build_country_index([mode_config])
+        self.country_index = country_index
+        n = len(country_index)
+        self.balance = [[1.0] * n for _ in range(n)]
+        for pair, val in bf.items():
+            a, _, b = pair.partition("-")
+            i, j = country_index.get(a), country_index.get(b)
+            if i is not None and j is not None:
+                self.balance[i][j] = float(val or 1.0)
+
+        self.km_price = float(mode_config.get("km_price_eur", 0) or 0)
+
+        self.speed = max(float(mode_config.get("transit_speed_kmpd", 500) or 500), 1)
+        self.cutoff_hour = int(mode_config.get("cutoff_hour", 10) or 10)
+        self.extra_pickup_days = int(mode_config.get("extra_pickup_days", 0) or 0)
+        # "business" (standard): transit räknas i arbetsdagar i mottagarlandet; "calendar": i kalenderdagar
+        self.transit_calendar_days = mode_config.get("transit_day_type") == "calendar"
+        self.co2_per_ton_km = float(mode_config.get("co2_per_ton_km", 0) or 0)
+        self.description = mode_config.get("description", "")
+
+        # Kurvparametrar + monotonicitet valideras en gång här i stället för per anrop
+        self.config_error = None
+        try:
+            self.p1  = float(mode_config["p1"]);   price_p1 = float(mode_config["price_p1"])
+            self.p2  = float(mode_config["p2"]);   self.p2k = float(mode_config["p2k"]);  self.p2m = float(mode_config["p2m"])
+            self.p3  = float(mode_config["p3"]);   self.p3k = float(mode_config["p3k"]);  self.p3m = float(mode_config["p3m"])
+            self.bp  = float(mode_config["default_breakpoint"])
+            self.maxw = float(mode_config["max_weight_kg"])
+        except Exception:
+            self.config_error = "Bad pricing config (missing numbers)"
+            return
+
+        if not (0 < self.p1 < self.p2 < self.p3 < self.bp <= self.maxw):
+            self.config_error = "Bad pricing config (need 0<p1<p2<p3<breakpoint≤max_weight)"
+            return
+        if price_p1 <= 0 or self.km_price <= 0:
+            self.config_error = "Bad pricing config (non-positive price)"
+            return
+
+        # Allt som inte beror på ftl_price
+        self.y1 = price_p1 / self.p1
+        self.log_y1 = log(self.y1)
+        self.log_p12 = log(self.p2) - log(self.p1)
+        self.log_p23 = log(self.p3) - log(self.p2)
+        self.log_p3bp = log(self.bp) - log(self.p3)
+
+    def zone_allowed(self, country, postal_prefix) -> bool:
+        bits = self.zone_bits.get(country)
+        if bits is None:
+            return False
+        slot = _SLOT_OF.get(postal_prefix)
+        if slot is not None:
+            return (bits >> slot) & 1 == 1
+        # Längre (eller udda) postnummer – sök i intervallindexet
+        return self.zones[country].covers(postal_prefix)
+
+    def balance_factor(self, pickup_country, delivery_country) -> float:
+        i = self.country_index.get(pickup_country)
+        j = self.country_index.get(delivery_country)
+        if i is None or j is None:
+            return 1.0
+        return self.balance[i][j]
+
+
+def build_country_index(modes) -> dict:
+    """Alla landskoder i available_zones/balance_factors → radindex i balansmatrisen."""
+    ccs = set()
+    for m in modes:
+        if not isinstance(m, dict):
+            continue
+        ccs |= set((m.get("available_zones") or {}).keys())
+        for pair in (m.get("balance_factors") or {}):
+            a, _, b = str(pair).partition("-")
+            ccs.update((a, b))
+    return {cc: i for i, cc in enumerate(sorted(ccs))}
+
+
+class PricingPlan:
+    """
+    Hela PricingConfig.data kompilerad till ModePlan-objekt.
+    Mode som inte går att kompilera ligger kvar som rå dict så att
+    calculate_for_mode beter sig (och fallerar) precis som tidigare.
+    """
+
+    def __init__(self, cfg: dict | None, version: int | None = None, config_id: str | None = None):
+        cfg = cfg or {}
+        self.version = version
+        self.config_id = config_id
+        self.raw = cfg
+        # Kundavtal (agreement_utils) för planer kompilerade per organisation
+        self.agreement = None
+        self.country_index = build_country_index(cfg.values())
+        self.modes: dict = {}
+        for name, mode_cfg in cfg.items():
+            try:
+                self.modes[name] = ModePlan(mode_cfg, name=name, country_index=self.country_index)
+            except Exception as e:
+                logger.warning("Pricing plan v%s: mode %s could not be compiled: %s", version, name, e)
+                self.modes[name] = mode_cfg
+
+        # Omvänt zonindex: land → 100 bitmasker över mode-index (bit i = self.mode_names[i])
+        self.mode_names = tuple(self.modes)
+        self.uncompiled_mask = 0
+        self.zone_modes: dict = {}
+        for i, (name, mp) in enumerate(self.modes.items()):
+            if not isinstance(mp, ModePlan):
+                self.uncompiled_mask |= 1 << i
+                continue
+            for cc, bits in mp.zone_bits.items():
+                row = self.zone_modes.setdefault(cc, [0] * ZONE_SLOTS)
+                for p in range(ZONE_SLOTS):
+                    if (bits >> p) & 1:
+                        row[p] |= 1 << i
+
+    def _modes_at(self, country, postal_prefix):
+        """Bitmask över mode som täcker (land, prefix), eller None om okänt."""
+        try:
+            row = self.zone_modes.get(country)
+        except Exception:
+            return None
+        if row is None:
+            return 0
+        iv = postal_interval(postal_prefix)
+        if iv is None:
+            return 0
+        lo, hi = iv
+        if hi - lo + 1 == _SLOT_WIDTH:
+            return row[lo // _SLOT_WIDTH]
+        # Finare än 2 siffror: zonerna kan skilja inom prefixet – låt mode avgöra
+        return None
+
+    def serving_modes(self, pickup_country, pickup_postal, delivery_country, delivery_postal):
+        """
+        Mode som kan vara tillgängliga för sträckan enligt zonerna. None betyder
+        "vet inte" (udda prefix) – då får calculate_for_mode avgöra för alla mode.
+        Okompilerade mode tas alltid med så att de fallerar som tidigare.
+        """
+        a = self._modes_at(pickup_country, pickup_postal)
+        b = self._modes_at(delivery_country, delivery_postal)
+        if a is None or b is None:
+            return None
+        mask = (a & b) | self.uncompiled_mask
+        return {name for i, name in enumerate(self.mode_names) if (mask >> i) & 1}
+
+    def items(self):
+        return self.modes.items()
+
+    def __contains__(self, mode_name):
+        return mode_name in self.modes
+
+    def __len__(self):
+        return len(self.modes)
+
+
+# =========================================================
+# Pricing calculation
+# =========================================================
+def earliest_pickup_date_for(pickup_country, cutoff_hour: int, extra_pickup_days: int) -> str:
+    """Nästa arbetsdag (2 om cutoff passerats) i upphämtningslandets lokala tid, + extra dagar."""
+    return business_calendar.earliest_pickup(pickup_country, cutoff_hour, extra_pickup_days).isoformat()
+
+@lru_cache(maxsize=8192)
+def delivery_dates_for(delivery_country, earliest_pickup_date: str, transit_min: int, transit_max: int,
+                       calendar_days: bool = False) -> tuple:
+    """
+    (tidigaste, senaste) leveransdag som ISO-strängar, hoppar över helger/helgdagar
+    i mottagarlandet. Nyckeln innehåller hämtdagen, så cachen åldras av sig själv.
+    """
+    try:
+        cc = delivery_country.upper()
+    except Exception:
+        cc = None
+    lo, hi = business_calendar.delivery_window(cc, date.fromisoformat(earliest_pickup_date),
+                                               transit_min, transit_max, calendar_days)
+    return lo.isoformat(), hi.isoformat()
+
+
+class LaneTerms:
+    """
+    Allt i prisberäkningen som beror på sträckan men inte på vikten:
+    avstånd, FTL-pris och viktkurvans segmentkoefficienter. status sätts om
+    config/kurva inte går att använda för sträckan.
+    """
+    __slots__ = ("distance_km", "balance_factor", "ftl_price", "status",
+                 "y", "n1", "a1", "n2", "a2", "n3", "a3")
+
+    def __init__(self, distance_km, balance_factor, ftl_price, status=None):
+        self.distance_km = distance_km
+        self.balance_factor = balance_factor
+        self.ftl_price = ftl_price
+        self.status = status
+
+
+def lane_terms(mp: ModePlan, distance_km: int, pickup_country, delivery_country) -> LaneTerms:
+    balance_factor = mp.balance_factor(pickup_country, delivery_country)
+    ftl_price = max(1, int(round(distance_km * mp.km_price * balance_factor)))
+    t = LaneTerms(distance_km, balance_factor, ftl_price)
+
+    # Kurvparametrar (validerade vid kompilering)
+    if mp.config_error:
+        t.status = mp.config_error
+        return t
+    p1, p2, p3, bp = mp.p1, mp.p2, mp.p3, mp.bp
+
+    # y-värden måste vara > 0
+    y1 = mp.y1
+    y2 = (mp.p2k * ftl_price + mp.p2m) / p2
+    y3 = (mp.p3k * ftl_price + mp.p3m) / p3
+    y4 = ftl_price / bp
+    t.y = (y1, y2, y3, y4)
+
+    if min(y1, y2, y3, y4) <= 0:
+        t.status = "Bad pricing config (y <= 0 leads to log-domain error)"
+        return t
+
+    # Exponenter (skydd mot log-domain/0-division)
+    try:
+        log_y2 = log(y2); log_y3 = log(y3)
+        t.n1 = (log_y2 - mp.log_y1) / mp.log_p12; t.a1 = y1 / (p1 ** t.n1)
+        t.n2 = (log_y3 - log_y2) / mp.log_p23;    t.a2 = y2 / (p2 ** t.n2)
+        t.n3 = (log(y4) - log_y3) / mp.log_p3bp;  t.a3 = y3 / (p3 ** t.n3)
+    except Exception:
+        t.status = "Bad pricing config (log/ratio failure)"
+    return t
+
+
+# Viktkurvans grenar (namnen syns i trace-läget)
+BRANCH_LINEAR = "linear (<p1)"
+BRANCH_SEG1 = "segment 1 (p1–p2)"
+BRANCH_SEG2 = "segment 2 (p2–p3)"
+BRANCH_SEG3 = "segment 3 (p3–breakpoint)"
+BRANCH_FTL = "ftl (breakpoint–max_weight)"
+BRANCH_EXCEEDS = "exceeds max_weight"
+
+
+def curve_price(mp: ModePlan, t: LaneTerms, weight):
+    """(totalpris, gren) för vikten; totalpris är None om vikten överstiger max_weight_kg."""
+    ftl_price = t.ftl_price
+    if weight < mp.p1:
+        return round(ftl_price * weight / mp.maxw), BRANCH_LINEAR
+    elif mp.p1 <= weight < mp.p2:
+        return round(min(t.a1 * (weight ** t.n1) * weight, ftl_price)), BRANCH_SEG1
+    elif mp.p2 <= weight < mp.p3:
+        return round(min(t.a2 * (weight ** t.n2) * weight, ftl_price)), BRANCH_SEG2
+    elif mp.p3 <= weight <= mp.bp:
+        return round(min(t.a3 * (weight ** t.n3) * weight, ftl_price)), BRANCH_SEG3
+    elif mp.bp < weight <= mp.maxw:
+        return int(ftl_price), BRANCH_FTL
+    return None, BRANCH_EXCEEDS
+
+
+def transit_days(mp: ModePlan, distance_km) -> list:
+    base_transit = max(1, int(round(distance_km / mp.speed)))
+    return [base_transit, base_transit + 1]
+
+
+def co2_grams(mp: ModePlan, distance_km, weight) -> int:
+    return max(0, int(round((distance_km * weight / 1000.0) * mp.co2_per_ton_km * 1000)))
+
+
+def success_result(mp: ModePlan, t: LaneTerms, total_price, transit_time_days, earliest_pickup_date, co2,
+                   delivery_country) -> dict:
+    delivery = delivery_dates_for(delivery_country, earliest_pickup_date, transit_time_days[0],
+                                  transit_time_days[1], mp.transit_calendar_days)
+    return {
+        "available": True, "status": "success",
+        "total_price_eur": int(total_price), "ftl_price_eur": int(t.ftl_price),
+        "distance_km": t.distance_km, "transit_time_days": transit_time_days,
+        "earliest_pickup_date": earliest_pickup_date,
+        "earliest_delivery_date": delivery[0], "latest_delivery_date": delivery[1],
+        "currency": "EUR",
+        "co2_emissions_grams": co2, "description": mp.description
+    }
+
+
+def quote_from_terms(mp: ModePlan, t: LaneTerms, weight, pickup_country, delivery_country) -> dict:
+    """Resultat för en vikt givet sträckans LaneTerms (zon + viktgränser redan kontrollerade)."""
+    if t.status:
+        return {"available": False, "status": t.status}
+
+    # Prissättning
+    total_price, _ = curve_price(mp, t, weight)
+    if total_price is None:
+        return {"available": False, "status": "Weight exceeds max weight"}
+
+    # Transit, tidigaste hämtning/leverans, CO2
+    return success_result(
+        mp, t, total_price, transit_days(mp, t.distance_km),
+        earliest_pickup_date_for(pickup_country, mp.cutoff_hour, mp.extra_pickup_days),
+        co2_grams(mp, t.distance_km, weight), delivery_country,
+    )
+
+
+def weight_allowed(mp: ModePlan, weight):
+    """None om vikten är ok, annars resultatet för "Weight not allowed"."""
+    if weight < mp.min_allowed or weight > mp.max_allowed:
+        return {"available": False, "status": "Weight not allowed", "error": f"Allowed weight range: {mp.min_allowed}–{mp.max_allowed} kg"}
+    return None
+
+
+def calculate_for_mode(mode_config, pickup_coord, delivery_coord, pickup_country, pickup_postal, delivery_country, delivery_postal, weight, mode_name=None):
+    # Rå dict (t.ex. ad hoc-config) kompileras i farten
+    mp = mode_config if isinstance(mode_config, ModePlan) else ModePlan(mode_config, name=mode_name)
+
+    # Zoner
+    if not (mp.zone_allowed(pickup_country, pickup_postal) and
+            mp.zone_allowed(delivery_country, delivery_postal)):
+        return {"available": False, "status": "Not available for this request"}
+
+    # Viktgränser
+    rejected = weight_allowed(mp, weight)
+    if rejected:
+        return rejected
+
+    # Avstånd: vägnätsgraf om den finns, annars haversine × 1.2 (aldrig 0)
+    distance_km = road_distance_km(pickup_coord, delivery_coord)
+
+    t = lane_terms(mp, distance_km, pickup_country, delivery_country)
+    return quote_from_terms(mp, t, weight, pickup_country, delivery_country)
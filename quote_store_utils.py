@@ -0,0 +1,292 @@
+# quote_store_utils.py
+"""
+Offerter till tabellen quotes (write-behind) + konverteringsrapport.
+
+/calculate lägger varje svar (en rad per mode) på en begränsad buffert i
+processen och går vidare direkt; requesten väntar aldrig på databasen. En
+skrivartråd tömmer bufferten med flerradiga INSERT (executemany) när
+QUOTE_STORE_BATCH_SIZE rader samlats eller QUOTE_STORE_FLUSH_MS gått.
+
+Full buffert: posten släpps och räknas i dropped. Med QUOTE_STORE_BLOCK_MS > 0
+väntar requesten i stället högst så länge på plats i bufferten (backpressure)
+innan posten släpps – fortfarande aldrig på själva skrivningen.
+
+Bokas en offert via quote_id läggs en koppling (debug_id, mode → booking_id)
+på samma buffert; den skrivs efter offertens INSERT eftersom bufferten är FIFO.
+"""
+from datetime import date, datetime, timedelta, timezone
+import atexit
+import logging
+import os
+import queue
+import threading
+import time
+
+from sqlalchemy import bindparam, case, func, insert, update
+from sqlalchemy.orm import aliased
+
+from models import Address, Booking, Quote
+
+logger = logging.getLogger(__name__)
+
+QUOTE_STORE_ENABLED = os.getenv("QUOTE_STORE_ENABLED", "true").lower() in ("1", "true", "yes")
+QUOTE_STORE_BUFFER_SIZE = int(os.getenv("QUOTE_STORE_BUFFER_SIZE", "20000"))
+QUOTE_STORE_BATCH_SIZE = int(os.getenv("QUOTE_STORE_BATCH_SIZE", "500"))
+QUOTE_STORE_FLUSH_MS = int(os.getenv("QUOTE_STORE_FLUSH_MS", "1000"))
+QUOTE_STORE_BLOCK_MS = int(os.getenv("QUOTE_STORE_BLOCK_MS", "0"))
+
+
+def _short(v, n: int):
+    return str(v)[:n] if v is not None else None
+
+
+def quote_rows(created_at: datetime, debug_id: str, quote: tuple, results: dict, config_version=None,
+               org_id=None, source: str | None = None) -> list:
+    """Ett /calculate-svar → rader för quotes (en per mode)."""
+    _, _, pc, pp, dc, dp, weight = quote
+    base = {
+        "created_at": created_at, "debug_id": debug_id, "org_id": org_id,
+        "config_version": config_version, "source": source,
+        "pickup_country": _short(pc, 2), "pickup_postal": _short(pp, 16),
+        "delivery_country": _short(dc, 2), "delivery_postal": _short(dp, 16),
+        "weight": weight,
+    }
+    rows = []
+    for mode, r in results.items():
+        if not isinstance(r, dict):
+            continue
+        ok = bool(r.get("available"))
+        rows.append({
+            **base, "mode": mode, "available": ok, "status": _short(r.get("status"), 128),
+            "price_eur": r.get("total_price_eur") if ok else None,
+            "distance_km": r.get("distance_km") if ok else None,
+        })
+    return rows
+
+
+class QuoteStore:
+    def __init__(self, maxsize: int = QUOTE_STORE_BUFFER_SIZE, batch_size: int = QUOTE_STORE_BATCH_SIZE,
+                 flush_ms: int = QUOTE_STORE_FLUSH_MS, block_ms: int = QUOTE_STORE_BLOCK_MS):
+        self._q: queue.Queue = queue.Queue(maxsize=maxsize)
+        self.batch_size = batch_size
+        self.flush_ms = flush_ms
+        self.block_ms = block_ms
+        self._session_factory = None
+        self._thread = None
+        self._lock = threading.Lock()          # en flush åt gången (tråd / atexit)
+        self.enqueued = 0
+        self.dropped = 0
+        self.written = 0
+        self.linked = 0
+        self.failed = 0
+        self.flushes = 0
+        self.last_flush_ms = None
+
+    # --- request-sidan ---
+    def _put(self, item) -> bool:
+        if self._thread is None:
+            return False
+        try:
+            if self.block_ms > 0:
+                self._q.put(item, timeout=self.block_ms / 1000.0)
+            else:
+                self._q.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        self.enqueued += 1
+        return True
+
+    def record(self, debug_id: str, quote: tuple, results: dict, config_version=None,
+               org_id=None, source: str | None = None) -> bool:
+        if self._thread is None:
+            return False
+        # Raderna byggs i skrivartråden – results ändras inte efter att svaret skapats
+        return self._put(("quote", (datetime.now(timezone.utc), debug_id, quote, results,
+                                    config_version, org_id, source)))
+
+    def link(self, debug_id: str, mode: str, booking_id: str) -> bool:
+        return self._put(("link", {"b_debug": debug_id, "b_mode": mode, "b_booking": booking_id}))
+
+    # --- skrivarsidan ---
+    def start(self, session_factory):
+        """Startar skrivartråden (idempotent)."""
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._session_factory = session_factory
+            self._thread = threading.Thread(target=self._run, name="quote-store", daemon=True)
+            self._thread.start()
+        atexit.register(self.flush)
+
+    def _drain(self, first=None, deadline: float | None = None) -> tuple:
+        """Hämtar upp till batch_size rader (väntar till deadline om den är satt)."""
+        rows, links = [], []
+        item = first
+        while True:
+            if item is not None:
+                kind, payload = item
+                if kind == "quote":
+                    rows.extend(quote_rows(*payload))
+                else:
+                    links.append(payload)
+                if len(rows) + len(links) >= self.batch_size:
+                    break
+            try:
+                if deadline is None:
+                    item = self._q.get_nowait()
+                else:
+                    item = self._q.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+        return rows, links
+
+    def _write(self, rows: list, links: list):
+        if not rows and not links:
+            return
+        t0 = time.perf_counter()
+        db = self._session_factory()
+        try:
+            if rows:
+                db.execute(insert(Quote.__table__), rows)
+            if links:
+                t = Quote.__table__
+                db.execute(update(t)
+                           .where(t.c.debug_id == bindparam("b_debug"), t.c.mode == bindparam("b_mode"))
+                           .values(booking_id=bindparam("b_booking")), links)
+            db.commit()
+            self.written += len(rows)
+            self.linked += len(links)
+        except Exception:
+            db.rollback()
+            self.failed += len(rows) + len(links)
+            logger.exception("Quote store flush failed (%d quotes, %d links dropped)", len(rows), len(links))
+        finally:
+            db.close()
+        self.flushes += 1
+        self.last_flush_ms = round((time.perf_counter() - t0) * 1000, 2)
+
+    def _run(self):
+        while True:
+            first = self._q.get()
+            try:
+                with self._lock:
+                    rows, links = self._drain(first, time.monotonic() + self.flush_ms / 1000.0)
+                    self._write(rows, links)
+            except Exception:
+                # Tråden får aldrig dö – då skulle bufferten bara fyllas och allt släppas
+                logger.exception("Quote store writer error")
+
+    def flush(self):
+        """Skriver allt som ligger i bufferten nu (vid avslut och i admin/test)."""
+        if self._session_factory is None:
+            return
+        with self._lock:
+            while True:
+                rows, links = self._drain()
+                if not rows and not links:
+                    break
+                self._write(rows, links)
+
+    def stats(self) -> dict:
+        return {"enabled": self._thread is not None, "buffered": self._q.qsize(),
+                "buffer_max": self._q.maxsize, "batch_size": self.batch_size,
+                "flush_ms": self.flush_ms, "block_ms": self.block_ms,
+                "enqueued": self.enqueued, "dropped": self.dropped, "written": self.written,
+                "linked": self.linked, "failed": self.failed, "flushes": self.flushes,
+                "last_flush_ms": self.last_flush_ms}
+
+
+quote_store = QuoteStore()
+
+
+# =========================================================
+# Rapport
+# =========================================================
+REPORT_GROUPS = ("mode", "lane", "org")
+
+
+def conversion_report(db, since: date, until: date, group: str = "lane", top_unavailable: int = 20) -> dict:
+    """
+    Offerter mot bokningar i [since, until), grupperat per mode, sträcka
+    (mode + länder) eller org. booked_quotes = offerter bokade via quote_id;
+    bookings = alla bokningar i gruppen (även utan quote_id).
+    """
+    if group not in REPORT_GROUPS:
+        raise ValueError(f"group must be one of {', '.join(REPORT_GROUPS)}")
+    t_from = datetime.combine(since, datetime.min.time(), tzinfo=timezone.utc)
+    t_to = datetime.combine(until, datetime.min.time(), tzinfo=timezone.utc)
+
+    S, R = aliased(Address), aliased(Address)
+    if group == "mode":
+        q_keys, b_keys, names = [Quote.mode], [Booking.selected_mode], ["mode"]
+    elif group == "lane":
+        q_keys = [Quote.mode, func.upper(Quote.pickup_country), func.upper(Quote.delivery_country)]
+        b_keys = [Booking.selected_mode, func.upper(S.country_code), func.upper(R.country_code)]
+        names = ["mode", "pickup_country", "delivery_country"]
+    else:
+        q_keys, b_keys, names = [Quote.org_id, Quote.mode], [Booking.org_id, Booking.selected_mode], ["org_id", "mode"]
+
+    avail = case((Quote.available.is_(True), 1), else_=0)
+    quotes = (db.query(*q_keys, func.count(Quote.id), func.sum(avail), func.count(Quote.booking_id),
+                       func.avg(case((Quote.available.is_(True), Quote.price_eur))))
+              .filter(Quote.created_at >= t_from, Quote.created_at < t_to)
+              .group_by(*q_keys))
+
+    bq = db.query(*b_keys, func.count(Booking.id), func.coalesce(func.sum(Booking.price_eur), 0.0))
+    if group == "lane":
+        bq = (bq.join(S, Booking.sender_address_id == S.id)
+                .join(R, Booking.receiver_address_id == R.id))
+    bookings = {tuple(r[:-2]): (int(r[-2]), float(r[-1] or 0))
+                for r in (bq.filter(Booking.booking_date >= since, Booking.booking_date < until,
+                                    Booking.status != "CANCELLED")
+                            .group_by(*b_keys))}
+
+    rows = []
+    for r in quotes:
+        key = tuple(r[:len(names)])
+        n, n_avail, n_booked, avg_price = r[len(names):]
+        n_avail = int(n_avail or 0)
+        b_n, b_rev = bookings.pop(key, (0, 0.0))
+        rows.append({
+            **dict(zip(names, key)), "quotes": int(n), "available": n_avail,
+            "unavailable": int(n) - n_avail, "booked_quotes": int(n_booked),
+            "bookings": b_n, "booked_revenue_eur": round(b_rev, 2),
+            "avg_quoted_price_eur": round(float(avg_price), 2) if avg_price is not None else None,
+            "quote_conversion": round(n_booked / n_avail, 4) if n_avail else None,
+            "bookings_per_quote": round(b_n / n_avail, 4) if n_avail else None,
+        })
+    # Bokningar utan någon offert i fönstret (t.ex. innan tabellen fanns)
+    for key, (b_n, b_rev) in bookings.items():
+        rows.append({**dict(zip(names, key)), "quotes": 0, "available": 0, "unavailable": 0,
+                     "booked_quotes": 0, "bookings": b_n, "booked_revenue_eur": round(b_rev, 2),
+                     "avg_quoted_price_eur": None, "quote_conversion": None, "bookings_per_quote": None})
+    rows.sort(key=lambda x: (-x["quotes"], -x["bookings"]))
+
+    # Vilka "ej tillgänglig"-svar vi tappar affärer på
+    u_keys = [Quote.mode, func.upper(Quote.pickup_country), func.upper(Quote.delivery_country), Quote.status]
+    lost = (db.query(*u_keys, func.count(Quote.id))
+            .filter(Quote.created_at >= t_from, Quote.created_at < t_to, Quote.available.is_(False))
+            .group_by(*u_keys)
+            .order_by(func.count(Quote.id).desc())
+            .limit(top_unavailable))
+
+    return {
+        "window": {"from": since.isoformat(), "to": until.isoformat(), "days": (until - since).days},
+        "group": group,
+        "totals": {
+            "quotes": sum(x["quotes"] for x in rows),
+            "available": sum(x["available"] for x in rows),
+            "booked_quotes": sum(x["booked_quotes"] for x in rows),
+            "bookings": sum(x["bookings"] for x in rows),
+        },
+        "rows": rows,
+        "unavailable": [{"mode": m, "pickup_country": a, "delivery_country": b, "status": s, "quotes": int(n)}
+                        for m, a, b, s, n in lost],
+    }
+
+
+def report_window(days: int, today: date | None = None) -> tuple:
+    """(since, until) för de senaste days dagarna inklusive idag."""
+    until = (today or date.today()) + timedelta(days=1)
+    return until - timedelta(days=days), until
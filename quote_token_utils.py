@@ -0,0 +1,147 @@
+# quote_token_utils.py
+"""
+Offert-id (quote_id) för /calculate → /book.
+
+Varje prissatt mode i /calculate-svaret får ett quote_id. /book tar pris,
+transittid och CO2 ur offerten i stället för ur payloaden – klienten behöver
+inte litas på och inget prissätts om.
+
+Offerten ligger i en begränsad LRU-cache i processen (uppslag O(1)). Id:t är
+dessutom självbärande och HMAC-signerat (planens config_id, mode, siffror,
+sträcka, org, utgångstid), så en annan gunicorn-worker eller en omstartad
+process kan verifiera det utan cachen. Ingen DB-läsning i något fall.
+
+Offerten gäller QUOTE_TOKEN_TTL sekunder, bara för samma plan (publicerad
+config och ev. avtalsrevision, se agreement_utils), samma organisation (om den togs fram inloggad) och samma
+sträcka (land + postnummer som offererades).
+"""
+import base64
+from collections import OrderedDict
+import hashlib
+import hmac
+import json
+import os
+import threading
+import time
+
+from pricing_utils import normalize_postal
+
+QUOTE_TOKEN_TTL = int(os.getenv("QUOTE_TOKEN_TTL", "1800"))
+QUOTE_TOKEN_CACHE_SIZE = int(os.getenv("QUOTE_TOKEN_CACHE_SIZE", "20000"))
+_SIG_BYTES = 12
+
+
+def _b64(b: bytes) -> str:
+    return base64.urlsafe_b64encode(b).rstrip(b"=").decode("ascii")
+
+
+def _unb64(s: str) -> bytes:
+    return base64.urlsafe_b64decode(s + "=" * (-len(s) % 4))
+
+
+class QuoteTokenError(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+class QuotedPrice:
+    __slots__ = ("config_id", "mode", "price_eur", "transit_time_days", "co2_emissions_grams",
+                 "earliest_pickup_date", "pickup_country", "pickup_postal",
+                 "delivery_country", "delivery_postal", "weight", "org_id", "expires_at", "debug_id")
+
+    _FIELDS = __slots__
+
+    def __init__(self, *values):
+        # Fält som saknas (id från före ett tillagt fält) blir None
+        values = values + (None,) * (len(self._FIELDS) - len(values))
+        for k, v in zip(self._FIELDS, values):
+            setattr(self, k, v)
+
+    def values(self) -> list:
+        return [getattr(self, k) for k in self._FIELDS]
+
+    def to_dict(self) -> dict:
+        return {k: getattr(self, k) for k in self._FIELDS}
+
+
+class QuoteTokens:
+    def __init__(self, secret: str, ttl: int = QUOTE_TOKEN_TTL, maxsize: int = QUOTE_TOKEN_CACHE_SIZE):
+        self._key = hashlib.sha256(("quote:" + secret).encode("utf-8")).digest()
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self._data: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.issued = 0
+        self.cache_hits = 0
+        self.verified = 0
+
+    def _sign(self, payload: bytes) -> str:
+        return _b64(hmac.new(self._key, payload, hashlib.sha256).digest()[:_SIG_BYTES])
+
+    def issue(self, config_id, mode: str, result: dict, quote: tuple, org_id=None, debug_id=None) -> str:
+        _, _, pc, pp, dc, dp, weight = quote
+        q = QuotedPrice(config_id, mode, result["total_price_eur"], result.get("transit_time_days"),
+                        result.get("co2_emissions_grams"), result.get("earliest_pickup_date"),
+                        str(pc).upper(), normalize_postal(pp) or str(pp), str(dc).upper(), normalize_postal(dp) or str(dp),
+                        weight, org_id, int(time.time()) + self.ttl, debug_id)
+        payload = json.dumps(q.values(), separators=(",", ":")).encode("utf-8")
+        token = f"{_b64(payload)}.{self._sign(payload)}"
+        with self._lock:
+            self._data[token] = q
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+            self.issued += 1
+        return token
+
+    def attach(self, config_id, quote: tuple, results: dict, org_id=None, debug_id=None) -> dict:
+        """Nytt resultat-dict där varje tillgängligt mode har quote_id (results kan vara cachat)."""
+        out = dict(results)
+        for mode, r in results.items():
+            if isinstance(r, dict) and r.get("available") and r.get("total_price_eur") is not None:
+                out[mode] = {**r, "quote_id": self.issue(config_id, mode, r, quote, org_id, debug_id)}
+        return out
+
+    def _lookup(self, token: str) -> QuotedPrice:
+        with self._lock:
+            q = self._data.get(token)
+            if q is not None:
+                self._data.move_to_end(token)
+                self.cache_hits += 1
+                return q
+        # Annan worker/omstart: verifiera signaturen
+        try:
+            body, sig = token.split(".", 1)
+            payload = _unb64(body)
+            if not hmac.compare_digest(sig, self._sign(payload)):
+                raise ValueError("bad signature")
+            q = QuotedPrice(*json.loads(payload))
+        except (ValueError, TypeError, UnicodeDecodeError):
+            raise QuoteTokenError("Invalid quote_id")
+        self.verified += 1
+        return q
+
+    def resolve(self, token, org_id=None, config_id=None) -> QuotedPrice:
+        """Offerten för token, eller QuoteTokenError (status 400/403/409)."""
+        if not isinstance(token, str) or "." not in token or len(token) > 1024:
+            raise QuoteTokenError("Invalid quote_id")
+        q = self._lookup(token)
+        if q.expires_at < time.time():
+            raise QuoteTokenError("Quote expired, please request a new quote", 409)
+        if q.org_id is not None and q.org_id != org_id:
+            raise QuoteTokenError("Quote belongs to another organization", 403)
+        if config_id is not None and q.config_id != config_id:
+            raise QuoteTokenError("Prices have changed since the quote, please request a new quote", 409)
+        return q
+
+    @staticmethod
+    def lane_matches(q: QuotedPrice, pickup_country, pickup_postal, delivery_country, delivery_postal) -> bool:
+        """Adresserna ligger på den offererade sträckan (postnumret börjar med det offererade)."""
+        pp = normalize_postal(pickup_postal) or ""
+        dp = normalize_postal(delivery_postal) or ""
+        return ((pickup_country or "").upper() == q.pickup_country and pp.startswith(q.pickup_postal) and
+                (delivery_country or "").upper() == q.delivery_country and dp.startswith(q.delivery_postal))
+
+    def stats(self) -> dict:
+        return {"size": len(self._data), "maxsize": self.maxsize, "ttl_seconds": self.ttl,
+                "issued": self.issued, "cache_hits": self.cache_hits, "verified": self.verified}
@@ -0,0 +1,140 @@
+# quotelog_utils.py
+"""
+Strukturerad, samplad och icke-blockerande loggning av offerter.
+
+/calculate skriver EN post per förfrågan (debug_id, sträcka, vikt, källa,
+tid och utfallet för varje mode) till loggern "efb.quotes". Posten läggs på
+en begränsad kö; en QueueListener-tråd serialiserar till JSON och skriver
+via appens vanliga handlers, så request-tråden väntar aldrig på I/O.
+Är kön full släpps posten (räknas i dropped) hellre än att requesten blockeras.
+
+Lyckade offerter samplas med QUOTE_LOG_SAMPLE_RATE (0–1); fel och ogiltig
+input loggas alltid.
+"""
+from datetime import datetime
+from logging.handlers import QueueHandler, QueueListener
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import time
+
+QUOTE_LOG_SAMPLE_RATE = float(os.getenv("QUOTE_LOG_SAMPLE_RATE", "1.0"))
+QUOTE_LOG_QUEUE_SIZE = int(os.getenv("QUOTE_LOG_QUEUE_SIZE", "10000"))
+
+quote_logger = logging.getLogger("efb.quotes")
+
+
+class _JsonMessage:
+    """Serialiseras först när listener-tråden formaterar posten."""
+    __slots__ = ("payload",)
+
+    def __init__(self, payload: dict):
+        self.payload = payload
+
+    def __str__(self):
+        return json.dumps(self.payload, separators=(",", ":"), default=str)
+
+
+class _DroppingQueueHandler(QueueHandler):
+    def __init__(self, q):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record):
+        # Ingen formatering i request-tråden – posten ägs av oss och ändras inte efteråt
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+_handler: _DroppingQueueHandler | None = None
+_listener: QueueListener | None = None
+
+
+def setup_quote_logging(handlers, level=logging.INFO):
+    """Kopplar efb.quotes till kön och startar listenern (idempotent)."""
+    global _handler, _listener
+    if _listener is not None:
+        return
+    q = queue.Queue(maxsize=QUOTE_LOG_QUEUE_SIZE)
+    _handler = _DroppingQueueHandler(q)
+    quote_logger.handlers = [_handler]
+    quote_logger.setLevel(level)
+    quote_logger.propagate = False
+    _listener = QueueListener(q, *handlers, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def quote_log_stats() -> dict:
+    return {
+        "sample_rate": QUOTE_LOG_SAMPLE_RATE,
+        "queue_size": _handler.queue.qsize() if _handler else 0,
+        "queue_max": QUOTE_LOG_QUEUE_SIZE,
+        "dropped": _handler.dropped if _handler else 0,
+    }
+
+
+def _mode_summary(r: dict) -> dict:
+    out = {"available": bool(r.get("available")), "status": r.get("status")}
+    if r.get("available"):
+        out["price"] = r.get("total_price_eur")
+        out["km"] = r.get("distance_km")
+    elif r.get("error"):
+        out["error"] = r.get("error")
+    return out
+
+
+class QuoteEvent:
+    """Samlar en förfrågans utfall; emit() skriver (eller samplar bort) posten."""
+    __slots__ = ("debug_id", "endpoint", "t0", "fields", "modes", "source", "error")
+
+    def __init__(self, debug_id: str, endpoint: str = "/calculate"):
+        self.debug_id = debug_id
+        self.endpoint = endpoint
+        self.t0 = time.perf_counter()
+        self.fields: dict = {}
+        self.modes: dict = {}
+        self.source = "engine"
+        self.error = None
+
+    def lane(self, pickup_coord, delivery_coord, pickup_country, pickup_postal,
+             delivery_country, delivery_postal, weight, config_version=None):
+        self.fields.update({
+            "pickup": f"{pickup_country}-{pickup_postal}", "delivery": f"{delivery_country}-{delivery_postal}",
+            "pickup_coord": pickup_coord, "delivery_coord": delivery_coord,
+            "weight": weight, "config_version": config_version,
+        })
+
+    def results(self, results: dict, source: str | None = None):
+        if source:
+            self.source = source
+        for mode, r in results.items():
+            self.modes[mode] = _mode_summary(r)
+
+    def emit(self, error: str | None = None, **extra):
+        if error:
+            self.error = error
+        failed = self.error is not None or any(m.get("status") == "error" for m in self.modes.values())
+        if not failed and QUOTE_LOG_SAMPLE_RATE < 1.0 and random.random() >= QUOTE_LOG_SAMPLE_RATE:
+            return
+        payload = {
+            "event": "quote", "debug_id": self.debug_id, "endpoint": self.endpoint,
+            "ts": datetime.utcnow().isoformat(timespec="milliseconds") + "Z",
+            "ms": round((time.perf_counter() - self.t0) * 1000, 3),
+            "source": self.source, **self.fields, **extra,
+        }
+        if self.modes:
+            payload["modes"] = self.modes
+        if self.error:
+            payload["error"] = self.error
+        if not failed:
+            payload["sample_rate"] = QUOTE_LOG_SAMPLE_RATE
+        quote_logger.log(logging.WARNING if failed else logging.INFO, _JsonMessage(payload))
@@ -0,0 +1,344 @@
+# replay_utils.py
+"""
+Replay av historiska bokningar mot publicerad och draft-prisplan.
+
+Bokningarna strömmas med server-side cursor (yield_per) och prissätts i
+batchar med calculate_batch – samma resultat som calculate_for_mode – mot
+båda planerna, med respektive plans hubbnät (routing_utils) som i /calculate.
+Rapporten summerar intäktseffekt per mode och per sträcka (zon → zon) samt
+listar sträckor där ett mode blir tillgängligt/otillgängligt.
+
+Booking sparar varken koordinater eller fraktdragande vikt, så:
+  - koordinater = zonens centroid (samma fil som prisrutnätet, RATE_GRID_CENTROIDS)
+  - vikt        = summan av goods[].weight
+Bokningar som inte går att återskapa räknas under "skipped" med orsak.
+
+Jobbstatus och rapport ligger på disk (som tenderjobben), så vilken
+gunicorn-worker som helst kan svara på status eller avbryta:
+REPLAY_JOB_DIR/<job_id>/{meta.json, cancel}
+
+Medan jobbet kör skrivs meta.json om (med updated_at) minst var
+REPLAY_HEARTBEAT_SECONDS, även under den första, långsamma frågan. Ett jobb
+som står som running men inte uppdaterats på REPLAY_STALE_SECONDS (workern
+dog eller startades om) rapporteras som failed och kan inte avbrytas.
+"""
+from collections import defaultdict
+from datetime import datetime
+import json
+import logging
+import os
+import re
+import shutil
+import tempfile
+import threading
+import uuid
+
+from sqlalchemy.orm import aliased
+
+from models import Address, Booking
+from batch_utils import calculate_batch
+from grid_utils import RATE_GRID_CENTROIDS, load_centroids
+from routing_utils import network_for
+from pricing_utils import POSTAL_DIGITS, normalize_postal
+
+logger = logging.getLogger(__name__)
+
+REPLAY_BATCH_SIZE = int(os.getenv("REPLAY_BATCH_SIZE", "2000"))
+REPLAY_TOP_LANES = int(os.getenv("REPLAY_TOP_LANES", "200"))
+REPLAY_MAX_JOBS = 20
+REPLAY_JOB_DIR = os.getenv("REPLAY_JOB_DIR") or os.path.join(tempfile.gettempdir(), "efb-replays")
+REPLAY_HEARTBEAT_SECONDS = float(os.getenv("REPLAY_HEARTBEAT_SECONDS", "5"))
+REPLAY_STALE_SECONDS = float(os.getenv("REPLAY_STALE_SECONDS", "60"))
+
+_digits = re.compile(r"\d")
+_JOB_ID_CHARS = set("0123456789abcdef")
+
+
+def postal_prefix(postal) -> str | None:
+    """De två första siffrorna i postnumret ("211 45" → "21"), annars None."""
+    d = _digits.findall(str(postal or ""))
+    return "".join(d[:2]) if len(d) >= 2 else None
+
+
+def booking_weight(goods) -> float | None:
+    """Summa av goods[].weight (vikten per rad är radens totalvikt, som i XML:en)."""
+    try:
+        w = sum(float(g.get("weight") or 0) for g in (goods or []) if isinstance(g, dict))
+    except (TypeError, ValueError):
+        return None
+    return w if w > 0 else None
+
+
+def iter_booking_batches(db, batch_size: int = REPLAY_BATCH_SIZE, include_cancelled: bool = False):
+    """Bokningsrader i batchar via server-side cursor – hela tabellen laddas aldrig."""
+    S, R = aliased(Address), aliased(Address)
+    q = (db.query(Booking.id, Booking.selected_mode, Booking.price_eur, Booking.goods,
+                  S.country_code, S.postal_code, R.country_code, R.postal_code)
+         .outerjoin(S, Booking.sender_address_id == S.id)
+         .outerjoin(R, Booking.receiver_address_id == R.id))
+    if not include_cancelled:
+        q = q.filter(Booking.status != "CANCELLED")
+    batch = []
+    for row in q.yield_per(batch_size):
+        batch.append(row)
+        if len(batch) >= batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def _money():
+    return {"bookings": 0, "stored_eur": 0.0, "published_eur": 0.0, "draft_eur": 0.0,
+            "unavailable_published": 0, "unavailable_draft": 0}
+
+
+def _price(r):
+    return r.get("total_price_eur") if r and r.get("available") else None
+
+
+class ReplayReport:
+    def __init__(self, published_version, draft_id):
+        self.published_version = published_version
+        self.draft_id = draft_id
+        self.seen = 0
+        self.evaluated = 0
+        self.skipped: dict = defaultdict(int)
+        self.by_mode: dict = defaultdict(_money)
+        self.by_lane: dict = defaultdict(_money)        # (lane, mode)
+        self.availability: dict = {}                     # (lane, mode) → [published, draft, bookings]
+
+    def add(self, lane: str, mode: str, stored, pub_results: dict, draft_results: dict):
+        self.evaluated += 1
+        p, d = _price(pub_results.get(mode)), _price(draft_results.get(mode))
+        for acc in (self.by_mode[mode], self.by_lane[(lane, mode)]):
+            acc["bookings"] += 1
+            acc["stored_eur"] += float(stored or 0)
+            if p is None:
+                acc["unavailable_published"] += 1
+            else:
+                acc["published_eur"] += p
+            if d is None:
+                acc["unavailable_draft"] += 1
+            else:
+                acc["draft_eur"] += d
+
+        # Tillgänglighet för alla mode på sträckan, inte bara det bokade
+        for m in set(pub_results) | set(draft_results):
+            key = (lane, m)
+            a = self.availability.get(key)
+            if a is None:
+                a = self.availability[key] = [
+                    bool((pub_results.get(m) or {}).get("available")),
+                    bool((draft_results.get(m) or {}).get("available")), 0]
+            a[2] += 1
+
+    @staticmethod
+    def _fmt(acc: dict) -> dict:
+        out = dict(acc)
+        for k in ("stored_eur", "published_eur", "draft_eur"):
+            out[k] = round(out[k], 2)
+        out["delta_eur"] = round(acc["draft_eur"] - acc["published_eur"], 2)
+        out["delta_pct"] = (round((acc["draft_eur"] - acc["published_eur"]) / acc["published_eur"] * 100, 2)
+                            if acc["published_eur"] else None)
+        return out
+
+    def to_dict(self, top_lanes: int = REPLAY_TOP_LANES) -> dict:
+        lanes = sorted(self.by_lane.items(),
+                       key=lambda kv: abs(kv[1]["draft_eur"] - kv[1]["published_eur"]), reverse=True)
+        changed = [
+            {"lane": lane, "mode": mode, "published": a[0], "draft": a[1],
+             "change": "gained" if a[1] else "lost", "bookings": a[2]}
+            for (lane, mode), a in self.availability.items() if a[0] != a[1]
+        ]
+        changed.sort(key=lambda x: x["bookings"], reverse=True)
+        totals = _money()
+        for acc in self.by_mode.values():
+            for k in totals:
+                totals[k] += acc[k]
+        return {
+            "published_version": self.published_version,
+            "draft_id": self.draft_id,
+            "bookings_seen": self.seen,
+            "bookings_evaluated": self.evaluated,
+            "skipped": dict(self.skipped),
+            "totals": self._fmt(totals),
+            "by_mode": {m: self._fmt(acc) for m, acc in sorted(self.by_mode.items())},
+            "by_lane": [{"lane": lane, "mode": mode, **self._fmt(acc)} for (lane, mode), acc in lanes[:top_lanes]],
+            "lanes_total": len(self.by_lane),
+            "availability_changes": changed,
+        }
+
+
+def run_replay(db, published_plan, draft_plan, centroids: dict, batch_size: int = REPLAY_BATCH_SIZE,
+               include_cancelled: bool = False, progress=None, cancelled=None) -> ReplayReport:
+    report = ReplayReport(published_plan.version, draft_plan.config_id)
+    # Hubbrouting som i /calculate – annars syns inte en ändring av bara hubbnätet
+    pub_network, draft_network = network_for(published_plan), network_for(draft_plan)
+    for rows in iter_booking_batches(db, batch_size, include_cancelled):
+        if cancelled and cancelled():
+            break
+        quotes, meta = [], []
+        for (_bid, mode, stored, goods, pc, ppostal, dc, dpostal) in rows:
+            report.seen += 1
+            pp, dp = postal_prefix(ppostal), postal_prefix(dpostal)
+            pc, dc = (pc or "").upper(), (dc or "").upper()
+            if not (pc and dc and pp and dp):
+                report.skipped["missing_address"] += 1
+                continue
+            pcoord, dcoord = centroids.get((pc, int(pp))), centroids.get((dc, int(dp)))
+            if pcoord is None or dcoord is None:
+                report.skipped["no_centroid"] += 1
+                continue
+            weight = booking_weight(goods)
+            if weight is None:
+                report.skipped["no_weight"] += 1
+                continue
+            # Zonkontrollen får hela postnumret (zoner kan vara finare än 2 siffror)
+            pz = (normalize_postal(ppostal) or pp)[:POSTAL_DIGITS]
+            dz = (normalize_postal(dpostal) or dp)[:POSTAL_DIGITS]
+            quotes.append((list(pcoord), list(dcoord), pc, pz, dc, dz, weight))
+            meta.append((f"{pc}-{pp}>{dc}-{dp}", mode, stored))
+
+        if quotes:
+            pub = calculate_batch(published_plan, quotes)
+            draft = calculate_batch(draft_plan, quotes)
+            for q, p, d in zip(quotes, pub, draft):
+                pub_network.apply(q, p)
+                draft_network.apply(q, d)
+            for (lane, mode, stored), p, d in zip(meta, pub, draft):
+                report.add(lane, mode, stored, p, d)
+        if progress:
+            progress(report.seen)
+    return report
+
+
+# =========================================================
+# Bakgrundsjobb (en tråd per replay, senaste REPLAY_MAX_JOBS sparas på disk)
+# =========================================================
+def _job_dir(job_id: str) -> str:
+    return os.path.join(REPLAY_JOB_DIR, job_id)
+
+
+_meta_lock = threading.Lock()     # jobbtråden och heartbeat-tråden delar tmp-filen
+
+
+def _write_meta(job: dict):
+    path = os.path.join(_job_dir(job["id"]), "meta.json")
+    tmp = f"{path}.tmp"
+    with _meta_lock:
+        job["updated_at"] = datetime.utcnow().isoformat() + "Z"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(job, f)
+        os.replace(tmp, path)
+
+
+def _is_stale(job: dict) -> bool:
+    try:
+        beat = datetime.fromisoformat(job["updated_at"].rstrip("Z"))
+    except (KeyError, AttributeError, ValueError):
+        return False
+    return (datetime.utcnow() - beat).total_seconds() > REPLAY_STALE_SECONDS
+
+
+def _cancel_requested(job_id: str) -> bool:
+    return os.path.exists(os.path.join(_job_dir(job_id), "cancel"))
+
+
+def _cleanup_old_jobs():
+    """Behåller de REPLAY_MAX_JOBS senaste jobbkatalogerna."""
+    try:
+        dirs = [os.path.join(REPLAY_JOB_DIR, n) for n in os.listdir(REPLAY_JOB_DIR)]
+        dirs = sorted((d for d in dirs if os.path.isdir(d)), key=os.path.getmtime, reverse=True)
+    except OSError:
+        return
+    for path in dirs[REPLAY_MAX_JOBS:]:
+        shutil.rmtree(path, ignore_errors=True)
+
+
+def start_replay_job(session_factory, published_plan, draft_plan, batch_size: int = REPLAY_BATCH_SIZE,
+                     include_cancelled: bool = False, on_done=None) -> dict:
+    """Startar replay i en daemon-tråd. Kastar ValueError om centroider saknas."""
+    if not RATE_GRID_CENTROIDS:
+        raise ValueError("RATE_GRID_CENTROIDS is not configured")
+    os.makedirs(REPLAY_JOB_DIR, exist_ok=True)
+    _cleanup_old_jobs()
+    job = {
+        "id": uuid.uuid4().hex[:12], "status": "running", "processed": 0,
+        "started_at": datetime.utcnow().isoformat() + "Z", "finished_at": None,
+        "published_version": published_plan.version, "report": None, "error": None,
+    }
+    os.makedirs(_job_dir(job["id"]))
+    _write_meta(job)
+
+    finished = threading.Event()
+
+    def _progress(n):
+        job["processed"] = n
+        _write_meta(job)
+
+    def _heartbeat():
+        # Egen tråd: run_replay kan stå länge i första frågan utan att anropa _progress
+        while not finished.wait(REPLAY_HEARTBEAT_SECONDS):
+            try:
+                _write_meta(job)
+            except OSError:
+                logger.exception("Replay %s: heartbeat failed", job["id"])
+
+    def _run():
+        db = session_factory()
+        try:
+            centroids = load_centroids(RATE_GRID_CENTROIDS)
+            def cancelled():
+                return _cancel_requested(job["id"])
+
+            report = run_replay(db, published_plan, draft_plan, centroids, batch_size, include_cancelled,
+                                progress=_progress, cancelled=cancelled)
+            job["report"] = report.to_dict()
+            job["status"] = "cancelled" if cancelled() else "done"
+            logger.info("Replay %s %s: %d bookings, %d evaluated", job["id"], job["status"],
+                        report.seen, report.evaluated)
+        except Exception as e:
+            logger.exception("Replay %s failed", job["id"])
+            job["status"], job["error"] = "failed", str(e)
+        finally:
+            job["finished_at"] = datetime.utcnow().isoformat() + "Z"
+            db.close()
+            finished.set()
+            try:
+                _write_meta(job)
+            except OSError:
+                logger.exception("Replay %s: could not write status", job["id"])
+            if on_done:
+                on_done()
+
+    threading.Thread(target=_heartbeat, name=f"replay-{job['id']}-hb", daemon=True).start()
+    threading.Thread(target=_run, name=f"replay-{job['id']}", daemon=True).start()
+    return job_public(job)
+
+
+def get_replay_job(job_id: str) -> dict | None:
+    """meta.json för jobbet; ett running-jobb utan heartbeat rapporteras som failed."""
+    if not job_id or set(job_id) - _JOB_ID_CHARS:
+        return None
+    try:
+        with open(os.path.join(_job_dir(job_id), "meta.json"), "r", encoding="utf-8") as f:
+            job = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if job.get("status") == "running" and _is_stale(job):
+        job["status"] = "failed"
+        job["error"] = f"Job stopped responding (no heartbeat for {int(REPLAY_STALE_SECONDS)}s)"
+    return job
+
+
+def cancel_replay_job(job_id: str) -> bool:
+    job = get_replay_job(job_id)
+    if not job or job["status"] != "running":
+        return False
+    open(os.path.join(_job_dir(job_id), "cancel"), "w").close()
+    return True
+
+
+def job_public(job: dict) -> dict:
+    return {k: v for k, v in job.items() if not k.startswith("_")}
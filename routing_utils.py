@@ -0,0 +1,333 @@
+# routing_utils.py
+"""
+Flerbensrutter via hubbar för mode med smala zoner (intermodal/conventional rail, ocean).
+
+Är avsändaren eller mottagaren utanför huvudmodets zoner prissätts i stället
+  förbärare (feeder_mode, t.ex. road_freight) → hubb → huvudben → hubb → förbärare.
+En ände som ligger inom huvudmodets zoner hämtas/levereras direkt av huvudmodet.
+Varje ben prissätts med sitt modes vanliga viktkurva (lane_terms + curve_price),
+alltså exakt som en /calculate för just den sträckan.
+
+Config per huvudmode (valfritt):
+  "hubs": [{"id": "SE-GOT", "name": "Göteborg", "country": "SE", "postal_prefix": "41",
+            "coordinate": [57.71, 11.97], "handling_days": 1}, ...],
+  "feeder_mode": "road_freight"
+
+Per config-version förberäknas huvudbenen hubb → hubb (avstånd, LaneTerms,
+transit) för alla hubbpar. Per offert återstår bara förbärarbenen till/från
+varje hubb och viktkurvan, och billigaste kombinationen väljs.
+"""
+import logging
+import os
+import threading
+import time
+
+from distance_utils import haversine, road_distance_km
+from pricing_utils import (
+    ModePlan, lane_terms, curve_price, transit_days, co2_grams, weight_allowed,
+    earliest_pickup_date_for, delivery_dates_for, parse_zone_entry, is_zone_allowed,
+)
+
+logger = logging.getLogger(__name__)
+
+NOT_AVAILABLE = "Not available for this request"
+DEFAULT_FEEDER_MODE = "road_freight"
+DEFAULT_HANDLING_DAYS = 1
+# Förbärarben prövas bara mot de N närmaste hubbarna (fågelvägen) – håller offerten billig med stora nät
+ROUTING_MAX_FEEDER_HUBS = int(os.getenv("ROUTING_MAX_FEEDER_HUBS", "4"))
+
+
+class Hub:
+    __slots__ = ("id", "name", "country", "postal", "coord", "handling_days")
+
+    def __init__(self, raw: dict):
+        self.id = str(raw["id"])
+        self.name = raw.get("name") or self.id
+        self.country = str(raw["country"]).upper()
+        self.postal = str(raw["postal_prefix"])
+        lat, lon = raw["coordinate"]
+        self.coord = (float(lat), float(lon))
+        self.handling_days = int(raw.get("handling_days", DEFAULT_HANDLING_DAYS))
+
+    def public(self) -> dict:
+        return {"id": self.id, "name": self.name, "country": self.country, "postal_prefix": self.postal}
+
+
+def hub_config_errors(mode_key: str, mode: dict, cfg: dict) -> list:
+    """Valideringsfel för "hubs"/"feeder_mode" i ett mode (tom lista om allt är ok eller inga hubbar)."""
+    errors = []
+    hubs = mode.get("hubs")
+    if hubs is None:
+        return errors
+    if not isinstance(hubs, list):
+        return [f"{mode_key}.hubs must be list"]
+    feeder = mode.get("feeder_mode", DEFAULT_FEEDER_MODE)
+    if feeder not in cfg or feeder == mode_key:
+        errors.append(f"{mode_key}.feeder_mode '{feeder}' must be another mode in the config")
+    zones = mode.get("available_zones") or {}
+    seen = set()
+    for i, raw in enumerate(hubs):
+        where = f"{mode_key}.hubs[{i}]"
+        try:
+            hub = Hub(raw)
+            parse_zone_entry(hub.postal)
+        except (KeyError, TypeError, ValueError):
+            errors.append(f"{where} needs id, country, postal_prefix (2–5 digits) and coordinate [lat, lon]")
+            continue
+        if hub.id in seen:
+            errors.append(f"{where} duplicate id '{hub.id}'")
+        seen.add(hub.id)
+        if not (-90 <= hub.coord[0] <= 90 and -180 <= hub.coord[1] <= 180):
+            errors.append(f"{where} coordinate out of range")
+        if hub.handling_days < 0:
+            errors.append(f"{where}.handling_days must be >= 0")
+        try:
+            inside = is_zone_allowed(hub.country, hub.postal, zones)
+        except (TypeError, ValueError):
+            inside = True   # trasiga zoner rapporteras redan av validate_config
+        if not inside:
+            errors.append(f"{where} ({hub.id}) is outside {mode_key}.available_zones")
+    return errors
+
+
+class _Leg:
+    __slots__ = ("mode", "mp", "frm", "to", "terms", "price", "transit")
+
+    def __init__(self, mode, mp, frm, to, terms, price):
+        self.mode, self.mp, self.frm, self.to = mode, mp, frm, to
+        self.terms, self.price = terms, price
+        self.transit = transit_days(mp, terms.distance_km)
+
+
+def _price(mp, t, weight):
+    """Benets pris, eller None om det inte går att prissätta."""
+    if t.status:
+        return None
+    return curve_price(mp, t, weight)[0]
+
+
+class ModeRoutes:
+    """Hubbnät för ett huvudmode, förberäknat för en config-version."""
+
+    def __init__(self, name: str, mp: ModePlan, feeder_name: str, feeder: ModePlan, hubs: list):
+        self.name, self.mp = name, mp
+        self.feeder_name, self.feeder = feeder_name, feeder
+        # Hubbar som huvudmodet faktiskt når; feeder_ok = förbäraren når också hubben
+        self.hubs = [h for h in hubs if mp.zone_allowed(h.country, h.postal)]
+        if len(self.hubs) < len(hubs):
+            logger.warning("Routing %s: %d hub(s) outside available_zones ignored", name, len(hubs) - len(self.hubs))
+        self.feeder_ok = [feeder.zone_allowed(h.country, h.postal) for h in self.hubs]
+
+        # Huvudben hubb i → hubb j (viktoberoende del)
+        self.main: dict = {}
+        for i, a in enumerate(self.hubs):
+            for j, b in enumerate(self.hubs):
+                if i != j:
+                    t = lane_terms(mp, road_distance_km(a.coord, b.coord), a.country, b.country)
+                    if not t.status:
+                        self.main[(i, j)] = t
+
+    def _feeder_prices(self, coord, country, postal, weight, outbound: bool) -> dict:
+        """{hubbindex: (pris, LaneTerms)} för förbärarbenen mellan dörren och varje nåbar hubb."""
+        f = self.feeder
+        if not f.zone_allowed(country, postal) or weight_allowed(f, weight):
+            return {}
+        near = [i for i, ok in enumerate(self.feeder_ok) if ok]
+        if len(near) > ROUTING_MAX_FEEDER_HUBS:
+            near = sorted(near, key=lambda i: haversine(coord, self.hubs[i].coord))[:ROUTING_MAX_FEEDER_HUBS]
+        out = {}
+        for i in near:
+            h = self.hubs[i]
+            if outbound:
+                t = lane_terms(f, road_distance_km(coord, h.coord), country, h.country)
+            else:
+                t = lane_terms(f, road_distance_km(h.coord, coord), h.country, country)
+            price = _price(f, t, weight)
+            if price is not None:
+                out[i] = (price, t)
+        return out
+
+    def quote(self, pickup_coord, delivery_coord, pickup_country, pickup_postal,
+              delivery_country, delivery_postal, weight):
+        """Resultat som /calculate för billigaste rutten, eller None om ingen rutt finns."""
+        mp = self.mp
+        if weight_allowed(mp, weight) or not self.hubs:
+            return None
+        o_in = mp.zone_allowed(pickup_country, pickup_postal)
+        d_in = mp.zone_allowed(delivery_country, delivery_postal)
+        if o_in and d_in:
+            return None     # direkt sträcka – calculate_for_mode gäller
+
+        # Start/slut: None = dörren (inom huvudmodets zoner), annars hubbindex nådd med förbäraren
+        no_leg = (0, None)
+        pre = {None: no_leg} if o_in else self._feeder_prices(pickup_coord, pickup_country, pickup_postal, weight, True)
+        on = {None: no_leg} if d_in else self._feeder_prices(delivery_coord, delivery_country, delivery_postal, weight, False)
+        if not pre or not on:
+            return None
+
+        # Bara priser i loopen; benen byggs för vinnaren
+        best = None
+        for s, (pre_price, pre_t) in pre.items():
+            for e, (on_price, on_t) in on.items():
+                if s == e:
+                    continue
+                if s is not None and e is not None:
+                    t = self.main.get((s, e))
+                    if t is None:
+                        continue
+                elif s is None:
+                    h = self.hubs[e]
+                    t = lane_terms(mp, road_distance_km(pickup_coord, h.coord), pickup_country, h.country)
+                else:
+                    h = self.hubs[s]
+                    t = lane_terms(mp, road_distance_km(h.coord, delivery_coord), h.country, delivery_country)
+                main_price = _price(mp, t, weight)
+                if main_price is None:
+                    continue
+                total = pre_price + main_price + on_price
+                dist = t.distance_km + (pre_t.distance_km if pre_t else 0) + (on_t.distance_km if on_t else 0)
+                if best is None or (total, dist) < best[:2]:
+                    best = (total, dist, s, e, main_price, t)
+        if best is None:
+            return None
+
+        _, _, s, e, main_price, t = best
+        frm = "pickup" if s is None else self.hubs[s]
+        to = "delivery" if e is None else self.hubs[e]
+        legs = []
+        if s is not None:
+            legs.append(_Leg(self.feeder_name, self.feeder, "pickup", frm, pre[s][1], pre[s][0]))
+        legs.append(_Leg(self.name, mp, frm, to, t, main_price))
+        if e is not None:
+            legs.append(_Leg(self.feeder_name, self.feeder, to, "delivery", on[e][1], on[e][0]))
+        return self._result(legs, pickup_country, delivery_country, weight)
+
+    def _result(self, legs: list, pickup_country, delivery_country, weight) -> dict:
+        hubs = [l.to for l in legs[:-1]]
+        handling = sum(h.handling_days for h in hubs)
+        lo = sum(l.transit[0] for l in legs) + handling
+        hi = sum(l.transit[1] for l in legs) + handling
+        first = legs[0].mp
+        co2 = [co2_grams(l.mp, l.terms.distance_km, weight) for l in legs]
+        pickup = earliest_pickup_date_for(pickup_country, first.cutoff_hour, first.extra_pickup_days)
+        # Leveransdagen styrs av sista benets kalender (arbets- eller kalenderdagar)
+        delivery = delivery_dates_for(delivery_country, pickup, lo, hi, legs[-1].mp.transit_calendar_days)
+
+        def end(x):
+            return x if isinstance(x, str) else x.id
+
+        return {
+            "available": True, "status": "success",
+            "total_price_eur": int(sum(l.price for l in legs)),
+            "ftl_price_eur": int(sum(l.terms.ftl_price for l in legs)),
+            "distance_km": sum(l.terms.distance_km for l in legs),
+            "transit_time_days": [lo, hi],
+            "earliest_pickup_date": pickup,
+            "earliest_delivery_date": delivery[0], "latest_delivery_date": delivery[1],
+            "currency": "EUR",
+            "co2_emissions_grams": sum(co2),
+            "description": self.mp.description,
+            "route": {
+                "type": "multi_leg",
+                "hubs": [h.public() for h in hubs],
+                "legs": [{
+                    "mode": l.mode, "from": end(l.frm), "to": end(l.to),
+                    "distance_km": l.terms.distance_km, "price_eur": int(l.price),
+                    "transit_time_days": l.transit, "co2_emissions_grams": c,
+                } for l, c in zip(legs, co2)],
+            },
+        }
+
+
+class HubNetwork:
+    """Alla mode med "hubs" i en PricingPlan."""
+
+    def __init__(self, plan):
+        t0 = time.perf_counter()
+        self.config_id = plan.config_id
+        self.version = plan.version
+        self.modes: dict = {}
+        for name, mp in plan.items():
+            if not isinstance(mp, ModePlan) or mp.config_error or not (mp.raw or {}).get("hubs"):
+                continue
+            feeder_name = mp.raw.get("feeder_mode", DEFAULT_FEEDER_MODE)
+            feeder = plan.modes.get(feeder_name)
+            if not isinstance(feeder, ModePlan) or feeder.config_error or feeder_name == name:
+                logger.warning("Routing %s: feeder mode %s not usable", name, feeder_name)
+                continue
+            try:
+                hubs = [Hub(h) for h in mp.raw["hubs"]]
+            except (KeyError, TypeError, ValueError) as e:
+                logger.warning("Routing %s: bad hubs: %s", name, e)
+                continue
+            self.modes[name] = ModeRoutes(name, mp, feeder_name, feeder, hubs)
+        self.build_seconds = time.perf_counter() - t0
+
+    def apply(self, quote: tuple, results: dict) -> dict:
+        """Ersätter "Not available" för mode med hubbar med billigaste flerbensrutten (in place)."""
+        for name, routes in self.modes.items():
+            r = results.get(name)
+            if r is None or r.get("available") or r.get("status") != NOT_AVAILABLE:
+                continue
+            try:
+                routed = routes.quote(*quote)
+            except Exception:
+                logger.exception("Routing %s crashed", name)
+                continue
+            if routed is not None:
+                results[name] = routed
+        return results
+
+    def curve(self, name: str, lane: tuple, weights: list, result: dict) -> dict:
+        """
+        /calculate/curve för ett mode med hubbar: är den direkta kurvan "Not
+        available" prissätts varje vikt som flerbensrutt (samma som apply per vikt).
+        lane = quote-tupeln utan vikt.
+        """
+        routes = self.modes.get(name)
+        if routes is None or result.get("available") or result.get("status") != NOT_AVAILABLE:
+            return result
+        prices, hubs = [], []
+        for w in weights:
+            try:
+                r = routes.quote(*lane, w)
+            except Exception:
+                logger.exception("Routing %s crashed", name)
+                r = None
+            prices.append(r["total_price_eur"] if r else None)
+            hubs.append([h["id"] for h in r["route"]["hubs"]] if r else None)
+        if not any(p is not None for p in prices):
+            return result
+        return {"available": True, "status": "success", "prices": prices, "currency": "EUR",
+                "description": routes.mp.description,
+                "route": {"type": "multi_leg", "hubs_per_weight": hubs}}
+
+
+# =========================================================
+# Nät per plan (publicerad version + kundavtalsplaner, byggs när planen kompileras)
+# =========================================================
+ROUTING_CACHE_SIZE = int(os.getenv("ROUTING_CACHE_SIZE", "64"))
+_networks: dict = {}
+_lock = threading.Lock()
+
+
+def network_for(plan) -> HubNetwork:
+    """Nätet för planen. Bara publicerade versioner cachas (draften kan skrivas över på samma id)."""
+    cacheable = plan.version is not None and plan.config_id is not None
+    if cacheable:
+        n = _networks.get(plan.config_id)
+        if n is not None:
+            return n
+    with _lock:
+        n = _networks.get(plan.config_id) if cacheable else None
+        if n is not None:
+            return n
+        n = HubNetwork(plan)
+        if cacheable:
+            _networks[plan.config_id] = n
+            while len(_networks) > ROUTING_CACHE_SIZE:
+                _networks.pop(next(iter(_networks)))
+    if n.modes:
+        logger.info("Hub network v%s built: %s in %.3fs", n.version,
+                    {m: len(r.hubs) for m, r in n.modes.items()}, n.build_seconds)
+    return n
@@ -0,0 +1,202 @@
+# sweep_utils.py
+"""
+Sanity-svep av en hel prisconfig.
+
+För ett mode beror priset på en sträcka bara på ftl_price, alltså på
+avståndet och balansfaktorn för landsparet – vilka postnummerzoner som
+används påverkar bara OM modet är tillgängligt. Svepet tar därför alla
+landspar som kan förekomma mellan modets zoner, grupperar dem per
+balansfaktor och räknar viktkurvan med batch_utils.curve_prices (samma
+kurva som /calculate) över (balansfaktor × avståndsrutnät) × (tätt viktrutnät).
+
+Rapporterar:
+  - bad_config      "Bad pricing config"-utfall (modet i sig eller för vissa sträckor)
+  - non_monotonic   pris som sjunker när vikten ökar (efter avrundning)
+  - discontinuity   hopp i priset vid p1/p2/p3/default_breakpoint
+  - exceeds_ftl     kurvsegment som går över FTL-priset och därför kapas
+"""
+import os
+import time
+import numpy as np
+
+from batch_utils import ST_BAD_Y, curve_prices
+from pricing_utils import ModePlan, build_country_index
+
+SWEEP_DISTANCES_KM = np.unique(np.rint(np.geomspace(1, 5000, 48)))
+SWEEP_WEIGHT_POINTS = int(os.getenv("SWEEP_WEIGHT_POINTS", "600"))
+# Hopp vid brytpunkt rapporteras om det är större än max(1 EUR, X % av priset)
+SWEEP_JUMP_TOLERANCE_PCT = float(os.getenv("SWEEP_JUMP_TOLERANCE_PCT", "1.0"))
+SWEEP_MAX_PAIRS_IN_EXAMPLE = 10
+
+
+def _weight_grid(mp: ModePlan) -> np.ndarray:
+    lo = max(float(mp.min_allowed), 0.0)
+    hi = min(float(mp.max_allowed), mp.maxw)
+    if hi <= lo:
+        return np.array([], dtype=np.float64)
+    pts = [np.linspace(lo, hi, SWEEP_WEIGHT_POINTS // 2),
+           np.geomspace(max(lo, 1.0), hi, SWEEP_WEIGHT_POINTS // 2) if hi > max(lo, 1.0) else np.array([])]
+    # Brytpunkterna och punkten strax under dem, så att hopp syns
+    bps = np.array([mp.p1, mp.p2, mp.p3, mp.bp])
+    pts += [bps, bps * (1 - 1e-9)]
+    w = np.unique(np.concatenate(pts))
+    return w[(w >= lo) & (w <= hi)]
+
+
+def _segments(mp: ModePlan, w: np.ndarray):
+    return (w < mp.p1,
+            (mp.p1 <= w) & (w < mp.p2),
+            (mp.p2 <= w) & (w < mp.p3),
+            (mp.p3 <= w) & (w <= mp.bp),
+            (mp.bp < w) & (w <= mp.maxw))
+
+
+SEGMENT_NAMES = ("linear (<p1)", "segment 1 (p1–p2)", "segment 2 (p2–p3)",
+                 "segment 3 (p3–breakpoint)", "ftl (breakpoint–max_weight)")
+
+
+def _lane_groups(mp: ModePlan) -> list:
+    """[(balansfaktor, [landspar])] för alla landspar mellan modets zoner."""
+    ccs = sorted(mp.zones)
+    groups: dict = {}
+    for a in ccs:
+        for b in ccs:
+            groups.setdefault(mp.balance_factor(a, b), []).append(f"{a}-{b}")
+    return sorted(groups.items())
+
+
+def _issue(mode, kind, severity, message, rows, bf, dist, pairs_by_bf, **example):
+    r = int(rows[0])
+    return {
+        "mode": mode, "kind": kind, "severity": severity, "message": message,
+        "lanes": int(len(rows)),
+        "example": {"balance_factor": float(bf[r]), "distance_km": int(dist[r]), **example},
+        "country_pairs": pairs_by_bf[float(bf[r])][:SWEEP_MAX_PAIRS_IN_EXAMPLE],
+    }
+
+
+def _curve(mp: ModePlan, ftl: np.ndarray, w: np.ndarray) -> tuple:
+    """curve_prices över (sträcka × vikt) → (pris, status, okapat värde), form (len(ftl), len(w))."""
+    F, W = np.broadcast_arrays(ftl[:, None].astype(np.float64), w[None, :])
+    return curve_prices(mp, F, W, with_raw=True)
+
+
+def sweep_mode(name: str, mp) -> tuple:
+    """(issues, stats) för ett mode."""
+    if not isinstance(mp, ModePlan):
+        return [{"mode": name, "kind": "bad_config", "severity": "error",
+                 "message": "Mode could not be compiled", "lanes": None}], {"points": 0}
+    if mp.config_error:
+        return [{"mode": name, "kind": "bad_config", "severity": "error",
+                 "message": mp.config_error, "lanes": None}], {"points": 0}
+
+    groups = _lane_groups(mp)
+    if not groups:
+        return [], {"points": 0}
+    pairs_by_bf = {float(k): v for k, v in groups}
+    bfs = np.array([g[0] for g in groups], dtype=np.float64)
+    bf = np.repeat(bfs, len(SWEEP_DISTANCES_KM))
+    dist = np.tile(SWEEP_DISTANCES_KM, len(bfs))
+    ftl = np.maximum(1, np.rint(dist * mp.km_price * bf))
+
+    # Brytpunkterna och punkten strax under dem: vänster- och högergräns per brytpunkt
+    breakpoints = (("p1", mp.p1), ("p2", mp.p2), ("p3", mp.p3), ("default_breakpoint", mp.bp))
+    bps = np.array([b for _, b in breakpoints], dtype=np.float64)
+    edge_price, edge_status, edge_raw = _curve(mp, ftl, np.concatenate([bps * (1 - 1e-9), bps]))
+
+    issues = []
+    bad_y = (edge_status == ST_BAD_Y).any(axis=1)
+    if bad_y.any():
+        rows = np.flatnonzero(bad_y)
+        f = float(ftl[rows[0]])
+        issues.append(_issue(name, "bad_config", "error",
+                             "Bad pricing config (y <= 0 leads to log-domain error)",
+                             rows, bf, dist, pairs_by_bf, ftl_price=int(f),
+                             y2=float((mp.p2k * f + mp.p2m) / mp.p2), y3=float((mp.p3k * f + mp.p3m) / mp.p3),
+                             distance_range_km=[int(dist[rows].min()), int(dist[rows].max())]))
+
+    # Kantpunkterna täcker alla tre potenssegmenten – icke-ändligt värde = log/kvot-fel
+    exp_bad = ~bad_y & ~np.isfinite(edge_raw).all(axis=1)
+    if exp_bad.any():
+        rows = np.flatnonzero(exp_bad)
+        issues.append(_issue(name, "bad_config", "error", "Bad pricing config (log/ratio failure)",
+                             rows, bf, dist, pairs_by_bf, ftl_price=int(ftl[rows[0]])))
+
+    valid = ~(bad_y | exp_bad)
+    w = _weight_grid(mp)
+    if not valid.any() or w.size < 2:
+        return issues, {"points": 0}
+
+    F = ftl[valid][:, None]
+    vbf, vdist = bf[valid], dist[valid]
+    segs = _segments(mp, w)
+    price, _, raw = _curve(mp, ftl[valid], w)
+    powered = (segs[1] | segs[2] | segs[3])[None, :]
+
+    # Pris som sjunker med vikten
+    drop = np.diff(price, axis=1) < 0
+    for k in range(5):
+        in_seg = drop & segs[k][1:][None, :]
+        if in_seg.any():
+            rows = np.flatnonzero(in_seg.any(axis=1))
+            r = rows[0]
+            j = int(np.flatnonzero(in_seg[r])[0])
+            issues.append(_issue(name, "non_monotonic", "error",
+                                 f"Price decreases with weight in {SEGMENT_NAMES[k]}",
+                                 rows, vbf, vdist, pairs_by_bf,
+                                 weights_kg=[float(w[j]), float(w[j + 1])],
+                                 prices_eur=[int(price[r, j]), int(price[r, j + 1])]))
+
+    # Hopp vid brytpunkterna: vänstergräns (lägre segmentets formel) mot priset i punkten
+    n_bp = len(breakpoints)
+    for k, (label, b) in enumerate(breakpoints):
+        left = edge_price[valid, k].astype(np.float64)
+        right = edge_price[valid, n_bp + k].astype(np.float64)
+        jump = right - left
+        tol = np.maximum(1.0, np.abs(left) * SWEEP_JUMP_TOLERANCE_PCT / 100.0)
+        big = np.abs(jump) > tol
+        if big.any():
+            rows = np.flatnonzero(big)
+            down = jump[rows] < 0
+            sev = "error" if down.any() else "warning"
+            issues.append(_issue(name, "discontinuity", sev,
+                                 f"Price jumps at {label} ({b:g} kg)" + (" downwards" if down.any() else ""),
+                                 rows, vbf, vdist, pairs_by_bf, weight_kg=float(b),
+                                 price_left_eur=int(left[rows[0]]),
+                                 price_right_eur=int(right[rows[0]]),
+                                 jump_range_eur=[int(jump[rows].min()), int(jump[rows].max())]))
+
+    # Segment som går över FTL och kapas innan breakpoint
+    over = powered & (raw > F) & np.isfinite(raw)
+    if over.any():
+        rows = np.flatnonzero(over.any(axis=1))
+        first_w = [float(w[np.flatnonzero(over[r])[0]]) for r in rows]
+        r = rows[0]
+        issues.append(_issue(name, "exceeds_ftl", "warning",
+                             "Weight curve exceeds the FTL price before default_breakpoint (capped)",
+                             rows, vbf, vdist, pairs_by_bf, ftl_price=int(F[r, 0]),
+                             first_capped_weight_kg=first_w[0],
+                             lowest_capped_weight_kg=min(first_w)))
+
+    return issues, {"points": int(price.size), "lanes": int(valid.sum()), "weights": int(w.size)}
+
+
+def sweep_config(cfg: dict) -> dict:
+    """Svep över alla mode i en config → {"ok", "issues", "stats", "seconds"}."""
+    t0 = time.perf_counter()
+    cfg = cfg or {}
+    country_index = build_country_index(cfg.values())
+    issues, stats = [], {}
+    for name, mode_cfg in cfg.items():
+        try:
+            mp = ModePlan(mode_cfg, name=name, country_index=country_index)
+        except Exception:
+            mp = None
+        mode_issues, stats[name] = sweep_mode(name, mp)
+        issues += mode_issues
+    return {
+        "ok": not any(i["severity"] == "error" for i in issues),
+        "issues": issues,
+        "stats": stats,
+        "seconds": round(time.perf_counter() - t0, 3),
+    }
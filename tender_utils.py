@@ -0,0 +1,364 @@
+# tender_utils.py
+"""
+Asynkrona tenderjobb (RFQ med 10k–50k sträckor).
+
+Uppladdningen delas i chunkar som prissätts i en process-pool med
+calculate_batch (samma resultat som calculate_for_mode per sträcka).
+En koordinatortråd i webbprocessen matar poolen och skriver varje färdig
+chunk som NDJSON-fil i jobbets katalog; status ligger i meta.json. Allt
+jobbtillstånd finns alltså på disk, så vilken gunicorn-worker som helst kan
+svara på status, strömma resultat eller avbryta.
+
+Koordinatorn skriver updated_at i meta.json minst var
+TENDER_HEARTBEAT_SECONDS. Ett jobb som står som running men inte uppdaterats
+på TENDER_STALE_SECONDS (processen dog, t.ex. vid omstart av workern)
+rapporteras som failed.
+
+Katalog: TENDER_JOB_DIR/<job_id>/{meta.json, chunk-000000.ndjson, ..., cancel}
+"""
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from datetime import datetime
+import csv
+import io
+import json
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import threading
+import time
+import uuid
+
+logger = logging.getLogger(__name__)
+
+TENDER_JOB_DIR = os.getenv("TENDER_JOB_DIR") or os.path.join(tempfile.gettempdir(), "efb-tenders")
+TENDER_MAX_LANES = int(os.getenv("TENDER_MAX_LANES", "100000"))
+TENDER_CHUNK_SIZE = int(os.getenv("TENDER_CHUNK_SIZE", "500"))
+TENDER_WORKERS = int(os.getenv("TENDER_WORKERS", str(max(1, (os.cpu_count() or 2) - 1))))
+TENDER_JOB_TTL_HOURS = float(os.getenv("TENDER_JOB_TTL_HOURS", "24"))
+TENDER_HEARTBEAT_SECONDS = float(os.getenv("TENDER_HEARTBEAT_SECONDS", "5"))
+TENDER_STALE_SECONDS = float(os.getenv("TENDER_STALE_SECONDS", "60"))
+
+# CSV-kolumner för uppladdning (ref är valfri)
+CSV_COLUMNS = ("pickup_country", "pickup_postal_prefix", "pickup_lat", "pickup_lon",
+               "delivery_country", "delivery_postal_prefix", "delivery_lat", "delivery_lon",
+               "chargeable_weight", "ref")
+
+_JOB_ID_CHARS = set("0123456789abcdef")
+
+
+# =========================================================
+# Inläsning
+# =========================================================
+def _csv_payload(row: dict) -> dict:
+    def coord(lat, lon):
+        try:
+            return [float(row[lat]), float(row[lon])]
+        except (KeyError, TypeError, ValueError):
+            return None
+    return {
+        "pickup_coordinate": coord("pickup_lat", "pickup_lon"),
+        "delivery_coordinate": coord("delivery_lat", "delivery_lon"),
+        "pickup_country": (row.get("pickup_country") or "").strip().upper() or None,
+        "pickup_postal_prefix": (row.get("pickup_postal_prefix") or "").strip() or None,
+        "delivery_country": (row.get("delivery_country") or "").strip().upper() or None,
+        "delivery_postal_prefix": (row.get("delivery_postal_prefix") or "").strip() or None,
+        "chargeable_weight": row.get("chargeable_weight"),
+        "ref": row.get("ref"),
+    }
+
+
+def read_lanes(text: str, fmt: str) -> list:
+    """
+    CSV (med rubrikrad, se CSV_COLUMNS) eller NDJSON med /calculate-payloads
+    → lista av payload-dictar. Rader som inte går att tolka blir {}.
+    Kastar ValueError om formatet är okänt eller filen för stor.
+    """
+    lanes = []
+    if fmt == "csv":
+        for row in csv.DictReader(io.StringIO(text)):
+            lanes.append(_csv_payload({k.strip(): v for k, v in row.items() if k}))
+            if len(lanes) > TENDER_MAX_LANES:
+                break
+    elif fmt == "ndjson":
+        for line in text.splitlines():
+            if not line.strip():
+                continue
+            try:
+                obj = json.loads(line)
+            except ValueError:
+                obj = None
+            lanes.append(obj if isinstance(obj, dict) else {})
+            if len(lanes) > TENDER_MAX_LANES:
+                break
+    else:
+        raise ValueError("Unsupported format (use csv or ndjson)")
+    if len(lanes) > TENDER_MAX_LANES:
+        raise ValueError(f"Max {TENDER_MAX_LANES} lanes per tender")
+    if not lanes:
+        raise ValueError("No lanes in upload")
+    return lanes
+
+
+# =========================================================
+# Process-pool (delas av alla jobb i webbprocessen)
+# =========================================================
+_pool = None
+_pool_lock = threading.Lock()
+_worker_plans: dict = {}
+
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: webbprocessen har trådar, fork av en sådan process är inte säkert
+            _pool = ProcessPoolExecutor(max_workers=TENDER_WORKERS,
+                                        mp_context=multiprocessing.get_context("spawn"))
+        return _pool
+
+
+def _price_chunk(config_id, version, cfg, quotes, agreement=None):
+    """
+    Körs i poolprocessen. Plan + hubbnät (+ kundavtal) byggs en gång per
+    config_id och process. cfg är avtalsplanens overlay-config om org har avtal;
+    agreement = (org_id, revision, data) för rabatter och fasta sträckpriser.
+    """
+    from pricing_utils import PricingPlan
+    from batch_utils import calculate_batch
+    from routing_utils import HubNetwork
+    from agreement_utils import Agreement
+
+    cached = _worker_plans.get(config_id)
+    if cached is None:
+        _worker_plans.clear()
+        plan = PricingPlan(cfg, version=version, config_id=config_id)
+        cached = _worker_plans[config_id] = (plan, HubNetwork(plan),
+                                             Agreement(*agreement) if agreement else None)
+    plan, network, a = cached
+    out = []
+    for q, r in zip(quotes, calculate_batch(plan, quotes)):
+        network.apply(q, r)
+        out.append(a.apply(q, r) if a is not None else r)
+    return out
+
+
+# =========================================================
+# Jobbkatalog
+# =========================================================
+def _job_dir(job_id: str) -> str:
+    return os.path.join(TENDER_JOB_DIR, job_id)
+
+
+def _chunk_path(job_id: str, i: int) -> str:
+    return os.path.join(_job_dir(job_id), f"chunk-{i:06d}.ndjson")
+
+
+def _write_atomic(path: str, data: str):
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        f.write(data)
+    os.replace(tmp, path)
+
+
+def _is_stale(meta: dict) -> bool:
+    try:
+        beat = datetime.fromisoformat(meta["updated_at"].rstrip("Z"))
+    except (KeyError, AttributeError, ValueError):
+        return False
+    return (datetime.utcnow() - beat).total_seconds() > TENDER_STALE_SECONDS
+
+
+def read_meta(job_id: str) -> dict | None:
+    """meta.json för jobbet; ett running-jobb utan heartbeat rapporteras som failed."""
+    if not job_id or set(job_id) - _JOB_ID_CHARS:
+        return None
+    try:
+        with open(os.path.join(_job_dir(job_id), "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get("status") in ("queued", "running") and _is_stale(meta):
+        meta["status"] = "failed"
+        meta["error"] = f"Job stopped responding (no heartbeat for {int(TENDER_STALE_SECONDS)}s)"
+    return meta
+
+
+def _write_meta(meta: dict):
+    meta["updated_at"] = datetime.utcnow().isoformat() + "Z"
+    _write_atomic(os.path.join(_job_dir(meta["id"]), "meta.json"), json.dumps(meta))
+
+
+def cancel_job(job_id: str) -> bool:
+    meta = read_meta(job_id)
+    if not meta or meta["status"] not in ("queued", "running"):
+        return False
+    open(os.path.join(_job_dir(job_id), "cancel"), "w").close()
+    return True
+
+
+def _cancel_requested(job_id: str) -> bool:
+    return os.path.exists(os.path.join(_job_dir(job_id), "cancel"))
+
+
+def _cleanup_old_jobs():
+    cutoff = time.time() - TENDER_JOB_TTL_HOURS * 3600
+    try:
+        for name in os.listdir(TENDER_JOB_DIR):
+            path = os.path.join(TENDER_JOB_DIR, name)
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+    except OSError:
+        pass
+
+
+def public_meta(meta: dict) -> dict:
+    out = {k: v for k, v in meta.items() if k not in ("org_id", "user_id")}
+    out["progress"] = round(meta["done"] / meta["total"], 4) if meta["total"] else 1.0
+    return out
+
+
+# =========================================================
+# Start + koordinator
+# =========================================================
+def start_tender_job(plan, rows: list, org_id, user_id) -> dict:
+    """
+    rows: [(quote-tupel eller None, ref)] i uppladdningens ordning.
+    Startar koordinatortråden och returnerar meta.
+    """
+    os.makedirs(TENDER_JOB_DIR, exist_ok=True)
+    _cleanup_old_jobs()
+
+    job_id = uuid.uuid4().hex
+    os.makedirs(_job_dir(job_id))
+    chunks = [rows[i:i + TENDER_CHUNK_SIZE] for i in range(0, len(rows), TENDER_CHUNK_SIZE)]
+    meta = {
+        "id": job_id, "org_id": org_id, "user_id": user_id, "status": "running",
+        "total": len(rows), "done": 0, "invalid": sum(1 for q, _ in rows if q is None),
+        "chunks_total": len(chunks), "chunks_done": 0,
+        "config_version": plan.version, "modes": [m for m, _ in plan.items()],
+        # Listpriser eller organisationens kundavtal (agreement_utils)
+        "prices": "agreement" if plan.agreement is not None else "list",
+        "agreement_revision": plan.agreement.revision if plan.agreement is not None else None,
+        "created_at": datetime.utcnow().isoformat() + "Z", "finished_at": None, "error": None,
+    }
+    _write_meta(meta)
+    threading.Thread(target=_coordinate, args=(meta, plan, chunks),
+                     name=f"tender-{job_id[:8]}", daemon=True).start()
+    return meta
+
+
+def _chunk_lines(offset: int, chunk: list, priced: list) -> str:
+    it = iter(priced)
+    out = []
+    for i, (q, ref) in enumerate(chunk):
+        if q is None:
+            rec = {"row": offset + i, "ref": ref, "error": "Missing or invalid input"}
+        else:
+            rec = {"row": offset + i, "ref": ref, "results": next(it)}
+        out.append(json.dumps(rec, separators=(",", ":")))
+    return "\n".join(out) + "\n"
+
+
+def _coordinate(meta: dict, plan, chunks: list):
+    job_id = meta["id"]
+    t0 = time.perf_counter()
+    a = plan.agreement
+    agreement = (a.org_id, a.revision, a.data) if a is not None else None
+    try:
+        pool = _get_pool()
+        pending = {}
+        next_chunk = 0
+        finished = set()
+        max_inflight = TENDER_WORKERS * 2
+        last_beat = time.monotonic()
+
+        while next_chunk < len(chunks) or pending:
+            if _cancel_requested(job_id):
+                for f in pending:
+                    f.cancel()
+                meta["status"] = "cancelled"
+                break
+            while next_chunk < len(chunks) and len(pending) < max_inflight:
+                quotes = [q for q, _ in chunks[next_chunk] if q is not None]
+                f = pool.submit(_price_chunk, plan.config_id, plan.version, plan.raw, quotes, agreement)
+                pending[f] = next_chunk
+                next_chunk += 1
+            done, _ = wait(list(pending), timeout=1.0, return_when=FIRST_COMPLETED)
+            for f in done:
+                i = pending.pop(f)
+                _write_atomic(_chunk_path(job_id, i),
+                              _chunk_lines(i * TENDER_CHUNK_SIZE, chunks[i], f.result()))
+                finished.add(i)
+                meta["done"] += len(chunks[i])
+            # chunks_done = sammanhängande prefix – det som kan strömmas i ordning
+            while meta["chunks_done"] in finished:
+                meta["chunks_done"] += 1
+            # Heartbeat även när ingen chunk blev klar, så långa chunkar inte ser döda ut
+            if done or time.monotonic() - last_beat >= TENDER_HEARTBEAT_SECONDS:
+                _write_meta(meta)
+                last_beat = time.monotonic()
+        else:
+            meta["status"] = "done"
+    except Exception as e:
+        logger.exception("Tender %s failed", job_id)
+        meta["status"], meta["error"] = "failed", str(e)
+    meta["finished_at"] = datetime.utcnow().isoformat() + "Z"
+    meta["seconds"] = round(time.perf_counter() - t0, 2)
+    _write_meta(meta)
+    logger.info("Tender %s %s: %d/%d lanes in %.1fs", job_id, meta["status"], meta["done"], meta["total"], meta["seconds"])
+
+
+# =========================================================
+# Strömning av resultat
+# =========================================================
+def iter_result_lines(job_id: str, follow: bool = False, poll_seconds: float = 0.5):
+    """NDJSON-rader chunk för chunk i radordning. follow=True väntar in resten av jobbet."""
+    i = 0
+    while True:
+        path = _chunk_path(job_id, i)
+        meta = read_meta(job_id)
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    yield line
+            i += 1
+            continue
+        # read_meta ger failed för ett jobb utan heartbeat – då slutar vi vänta
+        if not follow or meta is None or meta["status"] != "running":
+            return
+        time.sleep(poll_seconds)
+
+
+def csv_header(modes: list) -> list:
+    cols = ["row", "ref", "error"]
+    for m in modes:
+        cols += [f"{m}_available", f"{m}_price_eur", f"{m}_transit_days", f"{m}_earliest_pickup", f"{m}_status"]
+    return cols
+
+
+def iter_result_csv(job_id: str, modes: list, follow: bool = False):
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(csv_header(modes))
+    for line in iter_result_lines(job_id, follow):
+        rec = json.loads(line)
+        row = [rec["row"], rec.get("ref") or "", rec.get("error") or ""]
+        res = rec.get("results") or {}
+        for m in modes:
+            r = res.get(m) or {}
+            tt = r.get("transit_time_days")
+            row += [
+                "" if not res else int(bool(r.get("available"))),
+                r.get("total_price_eur", ""),
+                f"{tt[0]}-{tt[1]}" if isinstance(tt, list) and len(tt) == 2 else "",
+                r.get("earliest_pickup_date", ""),
+                r.get("status", ""),
+            ]
+        w.writerow(row)
+        if buf.tell() > 64 * 1024:
+            yield buf.getvalue()
+            buf.seek(0)
+            buf.truncate()
+    yield buf.getvalue()
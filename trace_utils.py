@@ -0,0 +1,172 @@
+# trace_utils.py
+"""
+Steg-för-steg-trace av calculate_for_mode.
+
+trace_mode() kör exakt samma steg som calculate_for_mode (samma funktioner
+i pricing_utils) men mäter varje steg i mikrosekunder och sparar
+mellanvärdena: balansfaktor, ftl_price, y1–y4, n1–n3/a1–a3 och vilken gren
+av viktkurvan som användes. Resultatet är identiskt med calculate_for_mode.
+
+Alla stegtider läggs även i processvida histogram (stage_histograms) som
+kan skrapas i Prometheus-format.
+"""
+import os
+import threading
+import time
+
+from distance_utils import road_distance_km
+from pricing_utils import (
+    ModePlan, lane_terms, weight_allowed, curve_price, transit_days, co2_grams,
+    success_result, earliest_pickup_date_for,
+)
+
+# Andel vanliga /calculate-anrop som körs med trace i bakgrunden (bara histogram, svaret påverkas inte)
+QUOTE_TRACE_SAMPLE_RATE = float(os.getenv("QUOTE_TRACE_SAMPLE_RATE", "0"))
+
+STAGE_BUCKETS_US = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 25000, 50000, 100000)
+
+
+class StageHistograms:
+    """Kumulativa histogram per steg (µs), trådsäkra."""
+
+    def __init__(self, buckets=STAGE_BUCKETS_US):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self._data: dict = {}     # stage → [bucket_counts (+inf sist), sum_us, count]
+
+    def observe(self, stage: str, us: float):
+        with self._lock:
+            h = self._data.get(stage)
+            if h is None:
+                h = self._data[stage] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if us <= b:
+                    h[0][i] += 1
+                    break
+            else:
+                h[0][-1] += 1
+            h[1] += us
+            h[2] += 1
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            out = {}
+            for stage, (counts, total, n) in sorted(self._data.items()):
+                cum, acc = {}, 0
+                for b, c in zip(self.buckets + ("+Inf",), counts):
+                    acc += c
+                    cum[str(b)] = acc
+                out[stage] = {"count": n, "sum_us": round(total, 3),
+                              "mean_us": round(total / n, 3) if n else None, "buckets": cum}
+            return out
+
+    def prometheus_text(self, name: str = "efb_quote_stage_duration_microseconds") -> str:
+        lines = [f"# HELP {name} Duration of calculate_for_mode stages in microseconds",
+                 f"# TYPE {name} histogram"]
+        for stage, h in self.to_dict().items():
+            for b, c in h["buckets"].items():
+                lines.append(f'{name}_bucket{{stage="{stage}",le="{b}"}} {c}')
+            lines.append(f'{name}_sum{{stage="{stage}"}} {h["sum_us"]}')
+            lines.append(f'{name}_count{{stage="{stage}"}} {h["count"]}')
+        return "\n".join(lines) + "\n"
+
+
+stage_histograms = StageHistograms()
+
+
+class _Stages:
+    __slots__ = ("items", "_t")
+
+    def __init__(self):
+        self.items = []
+        self._t = time.perf_counter_ns()
+
+    def mark(self, stage: str):
+        now = time.perf_counter_ns()
+        us = (now - self._t) / 1000.0
+        self.items.append({"stage": stage, "us": round(us, 3)})
+        stage_histograms.observe(stage, us)
+        self._t = time.perf_counter_ns()
+
+
+class timed_stage:
+    """with timed_stage("config") as ts: ... → ts.us, och steget hamnar i histogrammen."""
+    __slots__ = ("stage", "us", "_t")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+        self.us = None
+
+    def __enter__(self):
+        self._t = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc):
+        self.us = round((time.perf_counter_ns() - self._t) / 1000.0, 3)
+        stage_histograms.observe(self.stage, self.us)
+        return False
+
+
+def _terms_values(t) -> dict:
+    out = {"distance_km": t.distance_km, "balance_factor": t.balance_factor, "ftl_price": t.ftl_price}
+    y = getattr(t, "y", None)
+    if y is not None:
+        out.update({"y1": y[0], "y2": y[1], "y3": y[2], "y4": y[3]})
+    for k in ("n1", "a1", "n2", "a2", "n3", "a3"):
+        v = getattr(t, k, None)
+        if v is not None:
+            out[k] = v
+    return out
+
+
+def trace_mode(mode_config, pickup_coord, delivery_coord, pickup_country, pickup_postal,
+               delivery_country, delivery_postal, weight, mode_name=None):
+    """(resultat, trace) – resultatet är detsamma som calculate_for_mode ger."""
+    st = _Stages()
+    trace = {"stages": st.items, "values": {}, "branch": None, "outcome": None}
+
+    def done(result, outcome):
+        trace["outcome"] = outcome
+        trace["total_us"] = round(sum(s["us"] for s in st.items), 3)
+        return result, trace
+
+    if isinstance(mode_config, ModePlan):
+        mp = mode_config
+    else:
+        mp = ModePlan(mode_config, name=mode_name)
+        st.mark("compile")
+
+    in_zone = (mp.zone_allowed(pickup_country, pickup_postal) and
+               mp.zone_allowed(delivery_country, delivery_postal))
+    st.mark("zones")
+    if not in_zone:
+        return done({"available": False, "status": "Not available for this request"}, "zones")
+
+    rejected = weight_allowed(mp, weight)
+    st.mark("weight_limits")
+    if rejected:
+        return done(rejected, "weight_limits")
+
+    distance_km = road_distance_km(pickup_coord, delivery_coord)
+    st.mark("distance")
+
+    t = lane_terms(mp, distance_km, pickup_country, delivery_country)
+    st.mark("lane_terms")
+    trace["values"] = _terms_values(t)
+    if t.status:
+        return done({"available": False, "status": t.status}, "lane_terms")
+
+    total_price, branch = curve_price(mp, t, weight)
+    st.mark("curve")
+    trace["branch"] = branch
+    if total_price is None:
+        return done({"available": False, "status": "Weight exceeds max weight"}, "curve")
+    trace["values"]["total_price"] = total_price
+
+    tt = transit_days(mp, t.distance_km)
+    st.mark("transit")
+    pickup = earliest_pickup_date_for(pickup_country, mp.cutoff_hour, mp.extra_pickup_days)
+    st.mark("earliest_pickup")
+    co2 = co2_grams(mp, t.distance_km, weight)
+    st.mark("co2")
+    return done(success_result(mp, t, total_price, tt, pickup, co2, delivery_country), "success")